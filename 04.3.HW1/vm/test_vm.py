@@ -0,0 +1,859 @@
+import dis
+import gc
+import io
+import marshal
+import os
+import types
+import typing as tp
+
+import pytest
+
+from . import cases
+from . import vm
+from . import vm_runner
+from . import vm_scorer
+
+
+class MachineOptions(tp.TypedDict, total=False):
+    """
+    Keyword arguments of `vm.VirtualMachine` which tests are parametrized with
+    """
+    superinstructions: bool
+    quickening: bool
+    optimise: bool
+    profile: bool
+    max_instructions: int
+
+
+CALLS_CODE = r"""
+def f():
+    print('call')
+f()
+f()
+f()
+"""
+
+
+def test_decode_cache_is_shared_between_frames_and_machines() -> None:
+    code = vm_runner.compile_code(CALLS_CODE)
+    vm.DECODE_CACHE.clear()
+
+    for _ in range(2):
+        out, err, exc = vm_runner.execute(code, vm.VirtualMachine().run)
+        assert out == 'call\n' * 3
+        assert exc is None
+
+    # every function object keeps its decoded code, so calls don't query the cache
+    assert vm.DECODE_CACHE.info() == vm.DecodeCacheInfo(hits=2, misses=2, size=2)
+
+
+def test_decode_cache_does_not_keep_code_alive() -> None:
+    code = vm_runner.compile_code(CALLS_CODE)
+    vm.DECODE_CACHE.clear()
+    vm_runner.execute(code, vm.VirtualMachine().run)
+    assert vm.DECODE_CACHE.info().size == 2
+
+    del code
+    gc.collect()
+    assert vm.DECODE_CACHE.info().size == 0
+
+
+def test_long_lived_machine_does_not_keep_decoded_code_alive() -> None:
+    machine = vm.VirtualMachine()
+    vm.DECODE_CACHE.clear()
+    for _ in range(3):
+        vm_runner.execute(vm_runner.compile_code(CALLS_CODE), machine.run)
+    gc.collect()
+    assert vm.DECODE_CACHE.info().size == 0
+    assert len(machine.adaptive_streams) == 0
+
+
+def test_decode_cache_keeps_equal_code_objects_apart() -> None:
+    first = compile(CALLS_CODE, 'first.py', 'exec')
+    second = compile(CALLS_CODE, 'second.py', 'exec')  # equal code object of another file
+    assert first == second and first is not second
+    vm.DECODE_CACHE.clear()
+    first_decoded = vm.DECODE_CACHE.get(first)
+    assert vm.DECODE_CACHE.get(second) is not first_decoded
+    assert vm.DECODE_CACHE.get(first) is first_decoded
+
+    del second
+    gc.collect()
+    assert vm.DECODE_CACHE.info().size == 1
+
+
+def _signature(a, b, /, c=1, *args, d, e=5, **kwargs):  # type: ignore
+    pass
+
+
+@pytest.mark.parametrize('args,kwargs,expected', [
+    ((1, 2), {'d': 4}, {'a': 1, 'b': 2, 'c': 1, 'args': (), 'd': 4, 'e': 5, 'kwargs': {}}),
+    ((1, 2, 3, 4), {'d': 4, 'b': 0, 'x': 1},
+     {'a': 1, 'b': 2, 'c': 3, 'args': (4,), 'd': 4, 'e': 5, 'kwargs': {'b': 0, 'x': 1}}),
+    ((1,), {'d': 4}, vm.ERR_MISSING_POS_ARGS),
+    ((1, 2), {}, vm.ERR_MISSING_KWONLY_ARGS),
+    ((1, 2, 3), {'c': 3, 'd': 4}, vm.ERR_MULT_VALUES_FOR_ARG),
+])
+def test_binding_plan(args: tuple[tp.Any, ...], kwargs: dict[str, tp.Any], expected: tp.Any) -> None:
+    code = _signature.__code__
+    plan = vm.BindingPlan(code, _signature.__defaults__, _signature.__kwdefaults__)
+    if isinstance(expected, str):
+        with pytest.raises(TypeError, match=expected):
+            plan.bind(args, kwargs)
+    else:
+        assert dict(zip(code.co_varnames, plan.bind(args, kwargs))) == expected
+
+
+LOOP_CODE = r"""
+def total(n):
+    result = 0
+    i = 0
+    while i < n:
+        result = result + i
+        i = i + 1
+    return result
+print(total(10))
+"""
+
+
+def test_superinstructions_keep_output_and_reduce_dispatches() -> None:
+    code = vm_runner.compile_code(LOOP_CODE)
+    counts = []
+    for superinstructions in (False, True):
+        machine = vm.VirtualMachine(superinstructions=superinstructions, count_dispatches=True)
+        out, err, exc = vm_runner.execute(code, machine.run)
+        assert out == '45\n'
+        assert exc is None
+        counts.append(machine.dispatch_count)
+    assert counts[1] < counts[0]
+
+
+SHADOWED_BUILTIN_CODE = r"""
+def f():
+    return len('abc')
+print(f())
+len = lambda x: 42
+print(f())
+del len
+print(f())
+x = 1
+del x
+len = lambda x: 0
+print(f())
+"""
+
+
+def test_global_inline_cache_is_invalidated_by_namespace_changes() -> None:
+    code = vm_runner.compile_code(SHADOWED_BUILTIN_CODE)
+    out, err, exc = vm_runner.execute(code, vm.VirtualMachine().run)
+    assert exc is None
+    assert out == '3\n42\n3\n0\n'
+
+
+MIXED_TYPES_CODE = r"""
+def subtract(a, b):
+    return a - b
+for i in range(20):
+    subtract(i, 1)
+print(subtract(3, 1), subtract({1, 2}, {2}), subtract(2.5, 1))
+"""
+
+
+def test_quickening_specialises_and_deoptimises() -> None:
+    code = vm_runner.compile_code(MIXED_TYPES_CODE)
+    vm.DECODE_CACHE.clear()
+    machine = vm.VirtualMachine(quickening=True)
+    out, err, exc = vm_runner.execute(code, machine.run)
+    assert exc is None
+    assert out == "2 {1} 1.5\n"
+    assert machine.specialisations >= 1
+    assert machine.deoptimisations >= 1
+
+
+def test_adaptive_streams_are_not_shared_between_machines() -> None:
+    code = vm_runner.compile_code(MIXED_TYPES_CODE)
+    first, second = vm.VirtualMachine(), vm.VirtualMachine()
+    vm_runner.execute(code, first.run)
+    counters = (first.specialisations, first.deoptimisations)
+    vm_runner.execute(code, second.run)
+    assert (first.specialisations, first.deoptimisations) == counters
+    assert (second.specialisations, second.deoptimisations) == counters
+    assert set(first.adaptive_streams.keys()) == set(second.adaptive_streams.keys())
+    for decoded, stream in first.adaptive_streams.items():
+        assert stream is not second.adaptive_streams[decoded]
+
+
+DEEP_RECURSION_CODE = r"""
+def depth(n):
+    if n == 0:
+        return 0
+    return depth(n - 1) + 1
+print(depth(10000))
+print(sorted((3, 1, 2), key=lambda x: -depth(x)))
+"""
+
+
+def test_deep_recursion_does_not_nest_host_calls() -> None:
+    code = vm_runner.compile_code(DEEP_RECURSION_CODE)
+    out, err, exc = vm_runner.execute(code, vm.VirtualMachine().run)
+    assert exc is None
+    assert out == '10000\n[3, 2, 1]\n'
+
+
+PROFILED_CODE = r"""
+def square(x):
+    return x * x
+total = 0
+for i in range(3):
+    total += square(i)
+print(total)
+"""
+
+
+def test_profiler_reports_operations_lines_and_functions() -> None:
+    code = vm_runner.compile_code(PROFILED_CODE)
+    machine = vm.VirtualMachine(profile=True)
+    out, err, exc = vm_runner.execute(code, machine.run)
+    assert exc is None
+    assert out == '5\n'
+
+    assert machine.profiler is not None
+    report = machine.profiler.report()
+    assert report['operations']['FOR_ITER']['count'] == 4
+    assert report['lines']['<stdin>:6'] == 3
+    assert [stats['calls'] for name, stats in report['functions'].items() if name.startswith('square ')] == [3]
+    stacks = dict(line.rsplit(' ', 1) for line in machine.profiler.collapsed_stacks().splitlines())
+    assert set(stacks) == {'<module>', '<module>;square'}
+
+
+def test_profiler_is_disabled_by_default() -> None:
+    assert vm.VirtualMachine().profiler is None
+
+
+@pytest.mark.parametrize('options', [{'optimise': True}, {'superinstructions': False, 'quickening': False}],
+                         ids=['optimise', 'unfused'])
+@pytest.mark.parametrize('test', cases.TEST_CASES, ids=[test.name for test in cases.TEST_CASES])
+def test_execution_options_keep_output(test: cases.Case, options: MachineOptions) -> None:
+    code = vm_runner.compile_code(test.text_code)
+    expected = vm_runner.execute(code, vm.VirtualMachine().run)
+    out, err, exc = vm_runner.execute(code, vm.VirtualMachine(**options).run)
+    assert out == expected[0]
+    assert exc == expected[2]
+
+
+THREADED_JUMPS_CODE = r"""
+def odd_numbers(n):
+    for i in range(n):
+        if i % 2:
+            if i > 0:
+                print(i)
+        else:
+            continue
+odd_numbers(4)
+"""
+
+
+def test_optimiser_threads_jumps_and_removes_dead_code() -> None:
+    code = vm_runner.compile_code(THREADED_JUMPS_CODE)
+    machine = vm.VirtualMachine(optimise=True)
+    out, err, exc = vm_runner.execute(code, machine.run)
+    assert exc is None
+    assert out == '1\n3\n'
+
+    report = vm.optimisation_report(code)
+    removed = [count for name, count in report.items() if name.startswith('odd_numbers ')]
+    assert removed == [2]
+
+
+EXCEPTIONS_CODE = r"""
+def fail(n):
+    if n == 0:
+        raise ValueError('zero')
+    return fail(n - 1)
+def guarded(n):
+    try:
+        return fail(n)
+    finally:
+        print('cleanup', n)
+try:
+    guarded(3)
+except KeyError:
+    print('wrong handler')
+except ValueError as e:
+    print('caught', e)
+finally:
+    print('finally')
+try:
+    try:
+        fail(0)
+    except ValueError:
+        raise
+except Exception as e:
+    print('reraised', type(e).__name__)
+"""
+
+
+@pytest.mark.parametrize('options', [{}, {'optimise': True}, {'quickening': False}],
+                         ids=['plain', 'optimise', 'unquickened'])
+def test_exceptions_cross_frames_and_blocks(options: MachineOptions) -> None:
+    code = vm_runner.compile_code(EXCEPTIONS_CODE)
+    out, err, exc = vm_runner.execute(code, vm.VirtualMachine(**options).run)
+    assert exc is None
+    assert out == 'cleanup 3\ncaught zero\nfinally\nreraised ValueError\n'
+
+
+WITH_BLOCKS_CODE = r"""
+import contextlib
+from functools import wraps
+class Suppress:
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, value, traceback):
+        print('exit', exc_type is not None, 'boom' in str(value))
+        return exc_type is ValueError
+with Suppress():
+    raise ValueError('boom')
+def traced(func):
+    @wraps(func)
+    def wrapper(*args):
+        return func(*args)
+    return wrapper
+@contextlib.contextmanager
+@traced
+def managed(value):
+    print('enter')
+    yield value
+    print('leave')
+with managed(1) as x:
+    print('body', x)
+"""
+
+
+@pytest.mark.parametrize('options', [{}, {'optimise': True}], ids=['plain', 'optimise'])
+def test_with_blocks_of_imported_context_managers(options: MachineOptions) -> None:
+    code = vm_runner.compile_code(WITH_BLOCKS_CODE)
+    out, err, exc = vm_runner.execute(code, vm.VirtualMachine(**options).run)
+    assert exc is None
+    assert out == 'exit True True\nenter\nbody 1\nleave\n'
+
+
+GENERATORS_CODE = r"""
+def chain(n):
+    if n == 0:
+        yield 'bottom'
+        return 'done'
+    result = yield from chain(n - 1)
+    return result
+for value in chain(3000):
+    print(value)
+def echo():
+    try:
+        while True:
+            try:
+                received = yield
+                print('got', received)
+            except KeyError:
+                print('handled')
+    finally:
+        print('closed')
+g = echo()
+next(g)
+g.send(1)
+g.throw(KeyError)
+g.close()
+async def one():
+    return 1
+async def two():
+    return await one() + 1
+try:
+    two().send(None)
+except StopIteration as e:
+    print('awaited', e.value)
+print(list(x * x for x in range(4)))
+"""
+
+
+@pytest.mark.parametrize('options', [{}, {'optimise': True}, {'profile': True},
+                                     {'count_dispatches': True}],
+                         ids=['plain', 'optimise', 'profile', 'count'])
+def test_generators_resume_frames_in_place(options: MachineOptions) -> None:
+    code = vm_runner.compile_code(GENERATORS_CODE)
+    out, err, exc = vm_runner.execute(code, vm.VirtualMachine(**options).run)
+    assert exc is None
+    assert out == 'bottom\ngot 1\nhandled\nclosed\nawaited 2\n[0, 1, 4, 9]\n'
+
+
+ASYNC_CODE = r"""
+class Ticker:
+    def __init__(self, n):
+        self.n = n
+    def __aiter__(self):
+        return self
+    async def __anext__(self):
+        if self.n == 0:
+            raise StopAsyncIteration
+        self.n -= 1
+        return self.n
+class Session:
+    async def __aenter__(self):
+        print('enter')
+        return 'session'
+    async def __aexit__(self, exc_type, value, traceback):
+        print('exit', exc_type.__name__ if exc_type else None)
+        return exc_type is KeyError
+async def main():
+    async with Session() as session:
+        async for tick in Ticker(2):
+            print(session, tick)
+        raise KeyError('suppressed')
+    return [tick async for tick in Ticker(3)]
+try:
+    main().send(None)
+except StopIteration as stop:
+    print('result', stop.value)
+for values in [iter([1, 2, 3]), (1,), 1]:
+    try:
+        first, second = values
+    except (ValueError, TypeError) as e:
+        print(e)
+"""
+
+
+@pytest.mark.parametrize('options', [{}, {'optimise': True}, {'profile': True}], ids=['plain', 'optimise', 'profile'])
+def test_async_for_and_async_with(options: MachineOptions) -> None:
+    code = vm_runner.compile_code(ASYNC_CODE)
+    out, err, exc = vm_runner.execute(code, vm.VirtualMachine(**options).run)
+    assert exc is None
+    assert out == ('enter\nsession 1\nsession 0\nexit KeyError\nresult [2, 1, 0]\n'
+                   'too many values to unpack (expected 2)\nnot enough values to unpack (expected 2, got 1)\n'
+                   'cannot unpack non-iterable int object\n')
+
+
+GENERATOR_CLEANUP_CODE = r"""
+def numbers():
+    try:
+        yield 1
+        yield 2
+    finally:
+        print('cleanup')
+for x in numbers():
+    print(x)
+    break
+g = numbers()
+next(g)
+del g
+def stops():
+    yield 1
+    raise StopIteration
+try:
+    for x in stops():
+        print(x)
+except RuntimeError as e:
+    print(e, type(e.__cause__).__name__)
+try:
+    list(stops())
+except RuntimeError as e:
+    print(e)
+"""
+
+
+@pytest.mark.parametrize('options', [{}, {'optimise': True}, {'profile': True}],
+                         ids=['plain', 'optimise', 'profile'])
+def test_abandoned_generators_are_closed_and_stop_iteration_is_converted(options: MachineOptions) -> None:
+    code = vm_runner.compile_code(GENERATOR_CLEANUP_CODE)
+    out, err, exc = vm_runner.execute(code, vm.VirtualMachine(**options).run)
+    assert exc is None
+    assert out == ('1\ncleanup\ncleanup\n1\ngenerator raised StopIteration StopIteration\n'
+                   'generator raised StopIteration\n')
+
+
+CACHED_PROGRAM_CODE = r"""
+def describe(values):
+    try:
+        return f'{len(values)} values, first {values[0]:>3}'
+    except IndexError:
+        return 'empty'
+print(describe((1, 2)), describe(()), 2 ** 10)
+"""
+
+
+def test_disk_cache_restores_decoded_programs(tmp_path: tp.Any, monkeypatch: tp.Any) -> None:
+    code = vm_runner.compile_code(CACHED_PROGRAM_CODE)
+    codes = vm.nested_codes(code)
+    disk = vm.DiskCache(str(tmp_path))
+    assert disk.load(code, codes) is None
+
+    decoded = [vm.DecodedCode(nested) for nested in codes]
+    disk.store(code, codes, decoded)
+    loaded = disk.load(code, codes)
+    assert loaded is not None
+    for original, restored in zip(decoded, loaded):
+        assert restored.instructions == original.instructions
+        assert restored.optimised.instructions == original.optimised.instructions
+        assert restored.block_chains == original.block_chains
+        assert restored.cache_layout == original.cache_layout
+    assert vm.DiskCache(str(tmp_path), version='other').load(code, codes) is None
+
+    expected = vm_runner.execute(code, vm.VirtualMachine().run)
+    for _ in range(2):  # the first run saves the program, the second one loads it
+        monkeypatch.setattr(vm, 'DECODE_CACHE', vm.DecodeCache(vm.DiskCache(str(tmp_path / 'vm'))))
+        assert vm_runner.execute(code, vm.VirtualMachine(optimise=True).run) == expected
+        assert vm.DECODE_CACHE.info() == vm.DecodeCacheInfo(hits=0, misses=2, size=2)
+    assert len(list((tmp_path / 'vm').iterdir())) == 1
+
+
+def test_disk_cache_is_opt_in_bounded_and_treats_broken_files_as_misses(tmp_path: tp.Any, monkeypatch: tp.Any) -> None:
+    monkeypatch.delenv('VM_CACHE_DIR', raising=False)
+    assert vm.DiskCache.default() is None
+    monkeypatch.setenv('VM_CACHE_DIR', str(tmp_path))
+    default = vm.DiskCache.default()
+    assert default is not None and default.directory == str(tmp_path)
+
+    disk = vm.DiskCache(str(tmp_path / 'vm'), max_files=2)
+    programs = [vm_runner.compile_code(f'print({number})') for number in range(3)]
+    for age, code in enumerate(programs):
+        codes = vm.nested_codes(code)
+        disk.store(code, codes, [vm.DecodedCode(nested) for nested in codes])
+        os.utime(disk.path(code), (age, age))
+    assert disk.load(programs[0], vm.nested_codes(programs[0])) is None  # the least recently used one is removed
+    assert disk.load(programs[2], vm.nested_codes(programs[2])) is not None
+
+    code = programs[2]
+    for broken in [b'', b'garbage', marshal.dumps([1]), marshal.dumps([(([1], [code], []),) + (None,) * 9])]:
+        with open(disk.path(code), 'wb') as file:
+            file.write(broken)
+        assert disk.load(code, vm.nested_codes(code)) is None
+
+    code = vm_runner.compile_code('print(f"{1!r}")')  # conversion function of FORMAT_VALUE can't be marshalled
+    codes = vm.nested_codes(code)
+    disk.store(code, codes, [vm.DecodedCode(nested) for nested in codes])
+    assert not os.path.exists(disk.path(code))
+
+
+def test_parallel_runner_matches_serial_run() -> None:
+    selected = cases.TEST_CASES[:12]
+    serial = vm_runner.run_cases(selected, vm.VirtualMachine, processes=1)
+    parallel = vm_runner.run_cases(selected, vm.VirtualMachine, processes=2)
+    assert [result.name for result in parallel] == [case.name for case in selected]
+    assert [result[:7] for result in parallel] == [result[:7] for result in serial]
+    assert all(result.vm_time > 0 for result in parallel)
+
+
+RUNAWAY_CODE = r"""
+def spin():
+    total = 0
+    while True:
+        try:
+            total += 1
+        except Exception:
+            pass
+print('start')
+spin()
+"""
+
+
+def test_execution_budget_stops_runaway_loop() -> None:
+    code = vm_runner.compile_code(RUNAWAY_CODE)
+    machine = vm.VirtualMachine(max_instructions=1000)
+    with pytest.raises(vm.ExecutionBudgetExceeded) as info:
+        machine.run(code)
+    exceeded: vm.ExecutionBudgetExceeded = info.value
+    assert exceeded.instructions == machine.instructions_used == 1000
+    assert [name for name, line in exceeded.stack] == ['<module>', 'spin']
+    assert exceeded.profile is None
+
+    machine = vm.VirtualMachine(time_limit=0.01, profile=True)
+    out, err, exc = vm_runner.execute(code, machine.run)
+    assert out == 'start\n'
+    assert exc == vm.ExecutionBudgetExceeded
+    assert machine.instructions_used > 0
+
+
+BUDGETED_GENERATOR_CODE = r"""
+def numbers():
+    number = 0
+    while True:
+        for _ in range(100):
+            number += 1
+        yield number
+generator = numbers()
+box.append(generator)
+"""
+
+
+@pytest.mark.parametrize('driver', ['for number in generator:\n    pass\n', 'sum(generator)\n'],
+                         ids=['for', 'host'])
+@pytest.mark.parametrize('options', [{}, {'profile': True}], ids=['budgeted', 'profiled'])
+def test_budget_exceeded_in_generator_finishes_it(driver: str, options: MachineOptions) -> None:
+    code = vm_runner.compile_code(BUDGETED_GENERATOR_CODE + driver)
+    machine = vm.VirtualMachine(max_instructions=1000, stdout=io.StringIO(), **options)
+    box: list[tp.Any] = []
+    machine.builtins['box'] = box
+    with pytest.raises(vm.ExecutionBudgetExceeded) as info:
+        machine.run(code)
+    assert info.value.stack[-1][0] == 'numbers'
+    generator, = box
+    assert not generator.gi_running
+    generator.close()
+    assert list(generator) == []
+
+
+@pytest.mark.parametrize('options', [
+    {'count_dispatches': True, 'profile': True},
+    {'count_dispatches': True, 'time_limit': 1.0}, {'count_dispatches': True, 'sample_interval': 0.1},
+])
+def test_options_running_different_loops_are_not_combined(options: dict[str, tp.Any]) -> None:
+    with pytest.raises(ValueError):
+        vm.VirtualMachine(**options)
+
+
+CLOSURES_CODE = r"""
+def counter(start):
+    def increment():
+        nonlocal start
+        start += 1
+        return start
+    def peek():
+        return start
+    return increment, peek
+increment, peek = counter(10)
+increment()
+increment()
+print(peek(), id(increment.__closure__[0]) == id(peek.__closure__[0]))
+def late():
+    callbacks = []
+    for n in range(3):
+        callbacks.append(lambda: n)
+    return callbacks[0](), callbacks[2]()
+print(late())
+def logged(f):
+    def wrapper(*args, **kwargs):
+        print('call', f.__name__)
+        return f(*args, **kwargs)
+    return wrapper
+@logged
+def add(a, b=0):
+    return a + b
+print(add(1, b=2))
+def broken():
+    def inner():
+        return value
+    try:
+        inner()
+    except NameError as e:
+        print(type(e).__name__)
+    value = 1
+    return inner()
+print(broken())
+"""
+
+
+@pytest.mark.parametrize('options', [{}, {'optimise': True}],
+                         ids=['plain', 'optimise'])
+def test_cells_are_shared_between_frames(options: MachineOptions) -> None:
+    code = vm_runner.compile_code(CLOSURES_CODE)
+    out, err, exc = vm_runner.execute(code, vm.VirtualMachine(**options).run)
+    assert exc is None
+    assert out == '12 True\n(2, 2)\ncall add\n3\nNameError\n1\n'
+
+
+CLASSES_CODE = r"""
+class Shape:
+    def __init__(self, name):
+        self.name = name
+    def describe(self):
+        return self.name + ' ' + str(self.sides())
+    def sides(self):
+        return 0
+class Square(Shape):
+    def __init__(self):
+        super().__init__('square')
+    def sides(self):
+        return 4
+class Slotted:
+    __slots__ = ('x',)
+    def get(self):
+        return 1
+class Meta(type):
+    def kind(cls):
+        return 'meta'
+class WithMeta(metaclass=Meta):
+    def greet(self):
+        return 'instance'
+s = Square()
+for i in range(3):
+    print(s.describe())
+    if i == 0:
+        Square.sides = lambda self: 5
+    if i == 1:
+        del Square.sides
+s.describe = lambda: 'own'
+print(s.describe(), Slotted().get(), WithMeta.kind(), WithMeta().greet(), type(WithMeta).__name__)
+"""
+
+
+@pytest.mark.parametrize('options', [{}, {'optimise': True}], ids=['plain', 'optimise'])
+def test_classes_are_built(options: MachineOptions) -> None:
+    code = vm_runner.compile_code(CLASSES_CODE)
+    machine = vm.VirtualMachine(**options)
+    out, err, exc = vm_runner.execute(code, machine.run)
+    assert exc is None
+    assert out == 'square 4\nsquare 5\nsquare 0\nown 1 meta instance Meta\n'
+
+
+CLASS_SETATTR_CODE = r"""
+class Base:
+    def f(self):
+        return 1
+class A(Base):
+    pass
+class Other:
+    def f(self):
+        return 4
+class Meta(type):
+    def __setattr__(cls, name, value):
+        super().__setattr__(name, value)
+class B(metaclass=Meta):
+    def f(self):
+        return 'b'
+a, b = A(), B()
+for i in range(5):
+    print(a.f(), b.f())
+    if i == 0:
+        setattr(A, 'f', lambda self: 2)
+    if i == 1:
+        type.__setattr__(Base, 'f', lambda self: 3)
+        delattr(A, 'f')
+    if i == 2:
+        B.f = lambda self: 'meta'
+    if i == 3:
+        A.__bases__ = (Other,)
+"""
+
+
+@pytest.mark.parametrize('options', [{}, {'optimise': True}], ids=['plain', 'optimise'])
+def test_methods_follow_setattr_on_classes(options: MachineOptions) -> None:
+    code = vm_runner.compile_code(CLASS_SETATTR_CODE)
+    out, err, exc = vm_runner.execute(code, vm.VirtualMachine(**options).run)
+    assert exc is None
+    assert out == '1 b\n2 b\n3 b\n3 meta\n4 meta\n'
+
+
+def test_machines_run_in_threads_with_own_output(capsys: tp.Any) -> None:
+    programs = [f"for i in range({n}):\n    print({n}, i)\n" for n in range(1, 9)] + ["print('before')\n1 / 0\n"]
+    results = vm_runner.run_threaded(programs * 4, vm.VirtualMachine, threads=8)
+    expected = [''.join(f'{n} {i}\n' for i in range(n)) for n in range(1, 9)] + ['before\n']
+    assert [out for out, err, exc in results] == expected * 4
+    failed: list[tp.Optional[type]] = [None] * 8
+    failed.append(ZeroDivisionError)
+    assert [exc for out, err, exc in results] == failed * 4
+    assert 'ZeroDivisionError: division by zero' in results[8][1]
+    assert capsys.readouterr() == ('', '')  # nothing is written to sys.stdout / sys.stderr
+
+
+ANALYSED_CODE = """
+def count(n):
+    total = 0
+    i = 0
+    text = ''
+    while i < 10:
+        total += i
+        text = text + 'x'
+        i += 1
+    n = n + total
+    return total, text, n
+
+print(count(1.5))
+"""
+
+
+def test_analysis_proves_local_types_and_checks_stack_depth() -> None:
+    code = vm_runner.compile_code(ANALYSED_CODE)
+    function_code = next(const for const in code.co_consts if isinstance(const, types.CodeType))
+    decoded = vm.DecodedCode(function_code)
+    analysis = decoded.analysis
+    assert analysis.local_types == {'total': int, 'i': int, 'text': str}  # not argument `n`
+    assert 0 < analysis.max_depth <= function_code.co_stacksize
+    assert analysis.depths[0] == 0 and analysis.block_depths[0] >= 1
+
+    stream = decoded.quickened_stream(vm.STREAM_SUPERINSTRUCTIONS | vm.STREAM_ADAPTIVE)
+    unguarded = sorted(handler.__name__ for handler, arg in stream if handler.__name__.endswith('_unguarded_op'))
+    assert unguarded == ['binary_add_str_unguarded_op', 'compare_op_pop_jump_if_false_int_unguarded_op',
+                         'inplace_add_int_unguarded_op', 'inplace_add_int_unguarded_op']
+    out, err, exc = vm_runner.execute(code, vm.VirtualMachine().run)
+    assert exc is None
+    assert out == "(45, 'xxxxxxxxxx', 46.5)\n"
+
+
+WIDENED_CODE = """
+def add(c, a):
+    return (c and 1 or a) + 1
+
+print(add(True, None), add(False, 2.5))
+"""
+
+
+def test_analysis_widens_operand_types_at_joins() -> None:
+    code = vm_runner.compile_code(WIDENED_CODE)
+    function_code = next(const for const in code.co_consts if isinstance(const, types.CodeType))
+    decoded = vm.DecodedCode(function_code)
+    add = decoded.opcodes.index(dis.opmap['BINARY_ADD'])
+    assert decoded.analysis.operand_types[add] is None  # int through `c and 1` is reached first, then `a` joins
+
+    stream = decoded.quickened_stream(vm.STREAM_SUPERINSTRUCTIONS | vm.STREAM_ADAPTIVE)
+    assert not [handler for handler, arg in stream if handler.__name__.endswith('_unguarded_op')]
+    out, err, exc = vm_runner.execute(code, vm.VirtualMachine().run)
+    assert exc is None
+    assert out == "2 3.5\n"
+
+
+SAMPLED_CODE = """
+def inner(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+def outer():
+    return inner(3000) + inner(1000)
+
+def key(x):
+    return inner(200) - x
+
+print(outer())
+print(sorted((3, 1, 2), key=key))
+"""
+
+
+@pytest.mark.parametrize('options', [{}, {'profile': True}, {'max_instructions': 10 ** 6}, {'optimise': True},
+                                     {'quickening': False, 'superinstructions': False}],
+                         ids=['plain', 'profile', 'budget', 'optimise', 'unfused'])
+def test_sampler_collects_collapsed_stacks(options: MachineOptions) -> None:
+    code = vm_runner.compile_code(SAMPLED_CODE)
+    machine = vm.VirtualMachine(sample_every=100, **options)
+    out, err, exc = vm_runner.execute(code, machine.run)
+    assert exc is None
+    assert out == '4998000\n[3, 2, 1]\n'
+    sampler = machine.sampler
+    assert sampler is not None
+    assert sampler.samples == sampler.passed // 100 > 0
+    # `key` is called by host `sorted` in a nested run loop, its stack continues with the caller's one
+    assert set(sampler.stacks) <= {'<module>', '<module>;outer', '<module>;outer;inner', '<module>;key',
+                                   '<module>;key;inner'}
+    assert sampler.stacks['<module>;outer;inner'] > sampler.stacks['<module>;key;inner'] > 0
+    assert machine.loop_frames == []
+    lines = sampler.collapsed_stacks().splitlines()
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == sampler.samples
+
+
+def test_scorer_updates_level_stats_incrementally() -> None:
+    tests = [case.text_code for case in cases.TEST_CASES[:40]]
+    scorer = vm_scorer.Scorer(tests[:20])
+    for test in tests[20:]:
+        scorer.add_test(test)
+    full = vm_scorer.Scorer(tests)
+    assert scorer.get_levels_stats() == full.get_levels_stats()
+    assert scorer.get_total_stats() == full.get_total_stats()
+    assert [scorer.score(test) for test in tests] == [full.score(test) for test in tests]
+    assert scorer.total_score() == pytest.approx(sum(full.score(test) for test in tests))
+    assert scorer.get_operations(tests[0]) is full.get_operations(tests[0])  # compiled once
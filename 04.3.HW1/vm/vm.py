@@ -4,14 +4,30 @@ You need extend/rewrite code to pass all cases.
 """
 
 import builtins
+import collections
+import copy
 import dis
+import functools
+import hashlib
+import itertools
+import json
+import marshal
+import operator
+import os
+import sys
+import threading
+import time
 import types
 import typing as tp
+import weakref
 
 from typing import Any
 
 CO_VARARGS = 4
 CO_VARKEYWORDS = 8
+CO_GENERATOR = 0x20
+CO_COROUTINE = 0x80
+CO_ITERABLE_COROUTINE = 0x100
 
 ERR_TOO_MANY_POS_ARGS = 'Too many positional arguments'
 ERR_TOO_MANY_KW_ARGS = 'Too many keyword arguments'
@@ -20,6 +36,129 @@ ERR_MISSING_POS_ARGS = 'Missing positional arguments'
 ERR_MISSING_KWONLY_ARGS = 'Missing keyword-only arguments'
 ERR_POSONLY_PASSED_AS_KW = 'Positional-only argument passed as keyword argument'
 
+COMPARE_OPERATIONS: dict[str, tp.Callable[[tp.Any, tp.Any], tp.Any]] = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class _Unbound:
+    def __repr__(self) -> str:
+        return '<unbound>'
+
+
+UNBOUND: tp.Any = _Unbound()  # value of fast local which is not assigned yet
+NO_CELLS: list[types.CellType] = []  # cells of frames without cell and free variables, never modified
+NO_KWARGS: dict[str, tp.Any] = {}  # shared empty keyword arguments of calls, never mutated
+
+
+class BindingPlan:
+    """
+    Argument binding layout of a function, computed once at MAKE_FUNCTION time.
+    Binding fills fast locals array of the new frame directly
+    """
+
+    def __init__(self, code: types.CodeType, defaults: tp.Optional[tuple[tp.Any, ...]],
+                 kwdefaults: tp.Optional[dict[str, tp.Any]]) -> None:
+        varnames = code.co_varnames
+        self.nlocals = code.co_nlocals
+        self.argcount = code.co_argcount
+        self.kwonly_end = code.co_argcount + code.co_kwonlyargcount
+
+        self.varargs_slot = -1
+        self.varkw_slot = -1
+        next_slot = self.kwonly_end
+        if code.co_flags & CO_VARARGS:
+            self.varargs_slot = next_slot
+            next_slot += 1
+        if code.co_flags & CO_VARKEYWORDS:
+            self.varkw_slot = next_slot
+            next_slot += 1
+        self.nargs = next_slot
+
+        # arguments which may be passed by keyword: positional-or-keyword and keyword-only ones
+        self.keyword_slots = {varnames[slot]: slot for slot in range(code.co_posonlyargcount, self.kwonly_end)}
+        self.posonly_names = frozenset(varnames[:code.co_posonlyargcount])
+
+        # default values in their slots, UNBOUND for arguments without defaults and for plain locals
+        self.template: list[tp.Any] = [UNBOUND] * self.nlocals
+        self.defaults_start = self.argcount
+        if defaults:
+            self.defaults_start -= len(defaults)
+            self.template[self.defaults_start:self.argcount] = defaults
+        if kwdefaults:
+            for slot in range(self.argcount, self.kwonly_end):
+                self.template[slot] = kwdefaults.get(varnames[slot], UNBOUND)
+
+        # purely positional calls are bound by a single copy of template
+        # if there are no *args, **kwargs and every keyword-only argument has a default
+        self.positional_fast = (self.nargs == self.kwonly_end and
+                                all(value is not UNBOUND for value in self.template[self.argcount:self.kwonly_end]))
+
+    def bind(self, args: tp.Sequence[tp.Any], kwargs: dict[str, tp.Any]) -> list[tp.Any]:
+        """
+        Bind values from `args` and `kwargs` to fast locals of a new frame
+        :param args: positional arguments to be bound
+        :param kwargs: keyword arguments to be bound
+        :return: fast locals if binding was successful,
+                 raise TypeError with one of `ERR_*` error descriptions otherwise
+        """
+        n = len(args)
+        if not kwargs and self.positional_fast and self.defaults_start <= n <= self.argcount:
+            fast_locals = self.template.copy()
+            fast_locals[:n] = args
+            return fast_locals
+
+        argcount = self.argcount
+        if n > argcount and self.varargs_slot < 0:
+            raise TypeError(ERR_TOO_MANY_POS_ARGS)
+
+        fast_locals = [UNBOUND] * self.nlocals
+        fast_locals[:min(n, argcount)] = args[:argcount]
+        if self.varargs_slot >= 0:
+            fast_locals[self.varargs_slot] = tuple(args[argcount:])
+        varkw: tp.Optional[dict[str, tp.Any]] = None
+        if self.varkw_slot >= 0:
+            varkw = {}
+            fast_locals[self.varkw_slot] = varkw
+
+        unexpected = []
+        for key, value in kwargs.items():
+            slot = self.keyword_slots.get(key)
+            if slot is not None:
+                if fast_locals[slot] is not UNBOUND:
+                    raise TypeError(ERR_MULT_VALUES_FOR_ARG)
+                fast_locals[slot] = value
+            elif key in self.posonly_names:
+                if varkw is None:
+                    raise TypeError(ERR_POSONLY_PASSED_AS_KW)
+                varkw[key] = value
+            else:
+                unexpected.append(key)
+
+        template = self.template
+        for slot in range(self.defaults_start, self.kwonly_end):
+            if fast_locals[slot] is UNBOUND:
+                fast_locals[slot] = template[slot]
+
+        # `is` comparison only: `in` would call __eq__ of argument values
+        if any(value is UNBOUND for value in fast_locals[:argcount]):
+            raise TypeError(ERR_MISSING_POS_ARGS)
+        if any(value is UNBOUND for value in fast_locals[argcount:self.kwonly_end]):
+            raise TypeError(ERR_MISSING_KWONLY_ARGS)
+
+        if unexpected:
+            if varkw is None:
+                raise TypeError(ERR_TOO_MANY_KW_ARGS)
+            for key in unexpected:
+                varkw[key] = kwargs[key]
+
+        return fast_locals
+
 
 def bind_args(code: types.CodeType, defaults, kwdefaults, *args: Any, **kwargs: Any) -> dict[str, Any]:  # type: ignore
     """Bind values from `args` and `kwargs` to corresponding arguments of `func`
@@ -30,103 +169,339 @@ def bind_args(code: types.CodeType, defaults, kwdefaults, *args: Any, **kwargs:
     :return: `dict[argument_name] = argument_value` if binding was successful,
              raise TypeError with one of `ERR_*` error descriptions otherwise
     """
-    result: dict[Any, Any] = {}
-
-    num_pos = code.co_posonlyargcount
-    num_usual = code.co_argcount - code.co_posonlyargcount
-    num_total = len(code.co_varnames)
-
-    args_created = False
-    kwargs_created = False
-    args_name = ""
-    kwargs_name = ""
-    akw_num = 0
-
-    flags = code.co_flags
-    if bool(flags & CO_VARARGS) and bool(flags & CO_VARKEYWORDS):
-        akw_num = 2
-    elif bool(flags & CO_VARARGS):
-        akw_num = 1
-    elif bool(flags & CO_VARKEYWORDS):
-        akw_num = 1
-
-    num_local = len(code.co_varnames) - akw_num - code.co_kwonlyargcount - code.co_argcount
-    num_total -= num_local
-
-    if bool(flags & CO_VARARGS) and bool(flags & CO_VARKEYWORDS):
-        args_created = True
-        kwargs_created = True
-        args_name = code.co_varnames[num_total - 2]
-        kwargs_name = code.co_varnames[num_total - 1]
-        result[args_name] = ()
-        result[kwargs_name] = {}
-        num_total -= 2
-
-    elif bool(flags & CO_VARARGS):
-        args_created = True
-        args_name = code.co_varnames[num_total - 1]
-        result[args_name] = ()
-        num_total -= 1
-
-    elif bool(flags & CO_VARKEYWORDS):
-        kwargs_created = True
-        kwargs_name = code.co_varnames[num_total - 1]
-        result[kwargs_name] = {}
-        num_total -= 1
-
-    usual_in_kwargs = 0  # number of usual (middle) variables in kwargs
-    for kw_name in kwargs:
-        if kw_name in code.co_varnames[:num_total]:
-            usual_in_kwargs += 1
-
-    if len(args) > num_pos + num_usual and not args_created:
-        raise TypeError(ERR_TOO_MANY_POS_ARGS)
-    if not args_created:
-        for i in range(len(args)):  # setting given in args arguments to it's places
-            result[code.co_varnames[i]] = args[i]
-    else:
-        for i in range(min(len(args), num_pos + num_usual)):  # case args_created
-            result[code.co_varnames[i]] = args[i]
-        if len(args) > num_pos + num_usual:
-            result[args_name] = tuple(args[num_pos + num_usual:])
-
-    for key, value in kwargs.items():  # setting positional kwargs to it's places
-        if key in code.co_varnames[num_pos:num_total]:
-            if key in result:
-                raise TypeError(ERR_MULT_VALUES_FOR_ARG)
-            result[key] = value
-        elif key in code.co_varnames[:num_pos] and not kwargs_created:
-            raise TypeError(ERR_POSONLY_PASSED_AS_KW)
-        elif key in code.co_varnames[:num_pos] and kwargs_created:
-            result[kwargs_name][key] = kwargs[key]
-
-    pos_usual_without_default = code.co_argcount  # check if not given position args have default value
-    if defaults is not None:
-        pos_usual_without_default -= len(defaults)
-    for i in range(pos_usual_without_default, code.co_argcount):
-        if code.co_varnames[i] not in result and defaults is not None:
-            result[code.co_varnames[i]] = defaults[i - pos_usual_without_default]
-
-    if kwdefaults is not None:  # check if not given name_only args have default value
-        for arg_name in code.co_varnames[num_pos + num_usual:num_total]:
-            if arg_name not in result and arg_name in kwdefaults:
-                result[arg_name] = kwdefaults[arg_name]
-
-    for arg_name in code.co_varnames[:num_pos + num_usual]:  # check if every position arg is given
-        if arg_name not in result:
-            raise TypeError(ERR_MISSING_POS_ARGS)
+    plan = BindingPlan(code, defaults, kwdefaults)
+    return dict(zip(code.co_varnames[:plan.nargs], plan.bind(args, kwargs)))
 
-    for arg_name in code.co_varnames[num_pos + num_usual:num_total]:  # check if every position arg is given
-        if arg_name not in result:
-            raise TypeError(ERR_MISSING_KWONLY_ARGS)
 
-    for key in kwargs:
-        if key not in result and not kwargs_created:
-            raise TypeError(ERR_TOO_MANY_KW_ARGS)
-        if key not in result and kwargs_created:
-            result[kwargs_name][key] = kwargs[key]
+class NameCache:
+    """
+    Inline cache of LOAD_GLOBAL / LOAD_NAME instruction: namespace where the name was found last time.
+    It stays valid while the set of global names is the same,
+    which is checked by size of globals and number of deletions of names in virtual machine
+    """
+    __slots__ = ('name', 'size', 'deletions', 'namespace')
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.size = -1
+        self.deletions = -1
+        self.namespace: dict[str, tp.Any] = {}
+
+
+class MethodCache:
+    """
+    Inline cache of LOAD_METHOD instruction: unbound method found on a type of the object last time.
+    Only methods of immutable (not heap) types are cached, they never become stale
+    """
+    __slots__ = ('name', 'type', 'method')
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.type: tp.Optional[type] = None
+        self.method: tp.Any = None
+
+
+Cache = tp.Union[NameCache, MethodCache]
+
+
+def _special_method(obj: tp.Any, name: str) -> tp.Any:
+    """
+    :return: method `name` of type of object bound to the object, like lookup of special methods in CPython
+    """
+    try:
+        method = getattr(type(obj), name)
+    except AttributeError:
+        raise AttributeError(name) from None
+    return method.__get__(obj, type(obj)) if hasattr(method, '__get__') else method
+
+
+TPFLAGS_HEAPTYPE = 1 << 9
+METHOD_DESCRIPTOR_TYPES = (types.MethodDescriptorType, types.WrapperDescriptorType)
+
+
+class Function:
+    """
+    Function object created by MAKE_FUNCTION (FunctionType can't be used).
+    Argument binding plan and inline caches are shared by all calls of the function.
+    They live in slots, so `__dict__` keeps only attributes set by code, as for host functions
+    (`functools.update_wrapper` copies it from the wrapped function)
+    """
+    __slots__ = ('vm', 'code', 'builtins', 'globals', 'closure', 'decoded', 'plan', 'caches', 'instructions',
+                 '__dict__', '__weakref__')
+
+    def __init__(self, vm: 'VirtualMachine', code: types.CodeType, qualname: str,
+                 function_builtins: dict[str, tp.Any], function_globals: dict[str, tp.Any],
+                 defaults: tp.Optional[tuple[tp.Any, ...]], kwdefaults: tp.Optional[dict[str, tp.Any]],
+                 closure: tp.Optional[tuple[types.CellType, ...]] = None) -> None:
+        self.vm = vm
+        self.code = code
+        self.builtins = function_builtins
+        self.globals = function_globals
+        self.closure = closure
+        self.decoded = DECODE_CACHE.get(code)
+        if defaults is None and kwdefaults is None:  # e.g. methods defined in class bodies on every run
+            self.plan = self.decoded.binding_plan(code)
+        else:
+            self.plan = BindingPlan(code, defaults, kwdefaults)
+        self.caches = self.decoded.new_caches()
+        self.instructions: tp.Optional[list[Instruction]] = None  # stream run by `vm`, see `VirtualMachine.stream`
+
+        self.__name__ = code.co_name
+        self.__qualname__ = qualname
+        setattr(self, '__module__', function_globals.get('__name__'))  # None without `__name__`, as in CPython
+        self.__doc__ = code.co_consts[0] if code.co_consts and isinstance(code.co_consts[0], str) else None
+        self.__defaults__ = defaults
+        self.__kwdefaults__ = kwdefaults
+        self.__closure__ = closure
+        self.__annotations__: dict[str, tp.Any] = {}
+
+    def frame(self, args: tp.Sequence[tp.Any], kwargs: dict[str, tp.Any]) -> 'Frame':
+        """
+        :return: new frame of the function with bound arguments
+        """
+        instructions = self.instructions
+        if instructions is None:
+            instructions = self.instructions = self.vm.stream(self.decoded)
+        return Frame(self.vm, self.code, self.builtins, self.globals, None,
+                     self.plan.bind(args, kwargs), self.decoded, self.caches, self.closure, instructions)
+
+    def __call__(self, *args: tp.Any, **kwargs: tp.Any) -> tp.Any:
+        """
+        Call from host code (e.g. `sorted` key), calls from VM code don't get here, see `Frame.call`
+        """
+        return self.vm.run_frame(self.frame(args, kwargs))
+
+    def __get__(self, instance: tp.Any, owner: tp.Optional[type] = None) -> tp.Any:
+        if instance is None:
+            return self
+        return types.MethodType(self, instance)
+
+    def __repr__(self) -> str:
+        return f'<function {self.__qualname__} at {id(self):#x}>'
+
+
+class GeneratorFunction(Function):
+    """
+    Function with YIELD_VALUE / YIELD_FROM (or `async def` function): call creates a generator (a coroutine)
+    which owns a new frame of the function, the frame is run only when the generator is resumed
+    """
+    __slots__ = ()
+
+    def __call__(self, *args: tp.Any, **kwargs: tp.Any) -> tp.Any:
+        frame = self.frame(args, kwargs)
+        if self.code.co_flags & CO_COROUTINE:
+            return Coroutine(frame)
+        return Generator(frame)
+
+
+# Who resumed generator frame, it decides where yielded or returned value goes, see `VirtualMachine.leave_generator`
+RESUMED_BY_HOST = 0  # `next` / `send` from host code, frame is run by nested `VirtualMachine.run_frame`
+RESUMED_BY_FOR_ITER = 1  # FOR_ITER of VM frame
+RESUMED_BY_YIELD_FROM = 2  # YIELD_FROM of VM generator frame delegating to this generator
+
+
+class Generator:
+    """
+    Generator of VM function. Its frame is suspended at YIELD_VALUE / YIELD_FROM and resumed in place:
+    instruction index and value stack stay in the frame between resumptions.
+    FOR_ITER and YIELD_FROM of VM frames switch to generator frame in the same loop like calls do,
+    yielded value is delivered to the resuming frame like return value.
+    Host code (`next`, `list`, ...) resumes generator by running its frame in nested `VirtualMachine.run_frame`.
+    Suspended frame refers to its generator by weak proxy, so abandoned generator is closed as soon as it is dropped
+    """
+    __slots__ = ('frame', 'code', 'running', 'suspended', 'resumer', 'target', 'exc_info', 'caller_exc_info',
+                 'proxy', '__weakref__')
+
+    def __init__(self, frame: 'Frame') -> None:
+        self.frame: tp.Optional[Frame] = frame  # None when generator is finished
+        self.code = frame.code
+        self.running = False
+        self.suspended = False  # frame is left by yield, not by return or exception
+        self.resumer = RESUMED_BY_HOST
+        self.target = 0  # instruction index of resuming FOR_ITER to jump to when generator is exhausted
+        # exception handled in generator frame while it is suspended and exception handled by resuming code
+        self.exc_info: tuple[tp.Any, tp.Any, tp.Any] = (None, None, None)
+        self.caller_exc_info: tuple[tp.Any, tp.Any, tp.Any] = (None, None, None)
+        self.proxy = weakref.proxy(self)
+        frame.generator = self.proxy
+
+    def enter(self, frame: 'Frame') -> None:
+        """
+        Mark generator running before its frame is resumed, handled exception of the frame becomes the current one
+        """
+        if self.running:
+            raise ValueError('generator already executing')
+        self.running = True
+        self.suspended = False
+        frame.generator = self
+        vm = frame.vm
+        self.caller_exc_info = vm.exc_info
+        if self.exc_info[1] is not None:
+            vm.exc_info = self.exc_info
+
+    def leave(self) -> None:
+        """
+        Generator frame is left by yield, return or exception: restore handled exception of resuming code
+        """
+        frame = self.frame
+        assert frame is not None
+        vm = frame.vm
+        self.running = False
+        if self.suspended and vm.exc_info[1] is not self.caller_exc_info[1]:
+            self.exc_info = vm.exc_info
+        else:
+            self.exc_info = (None, None, None)
+        vm.exc_info = self.caller_exc_info
+        frame.back = None
+        if self.suspended:
+            frame.generator = self.proxy
+        else:
+            self.frame = None
+
+    def resume(self, value: tp.Any, resumer: int, target: int = 0) -> 'Frame':
+        """
+        Prepare suspended frame to continue: value sent into generator becomes the result of yield expression
+        :return: frame of generator
+        """
+        frame = self.frame
+        assert frame is not None
+        if frame.instruction_index:
+            frame.data_stack.append(value)
+        elif value is not None:
+            raise TypeError("can't send non-None value to a just-started generator")
+        self.enter(frame)
+        self.resumer = resumer
+        self.target = target
+        return frame
+
+    def result(self, frame: 'Frame') -> tp.Any:
+        """
+        :return: value yielded by frame resumed from host code, StopIteration is raised if frame returned
+        """
+        if self.suspended:
+            return frame.return_value
+        if frame.return_value is None:
+            raise StopIteration
+        raise StopIteration(frame.return_value)
+
+    def send(self, value: tp.Any) -> tp.Any:
+        frame = self.frame
+        if frame is None:
+            raise StopIteration
+        frame.vm.run_frame(self.resume(value, RESUMED_BY_HOST))
+        return self.result(frame)
+
+    def throw(self, exc_type: tp.Any, value: tp.Any = None, traceback: tp.Any = None) -> tp.Any:
+        """
+        Raise exception at the yield where generator is suspended, generator delegating by YIELD_FROM passes
+        it to the delegate first, like in CPython:
+            https://github.com/python/cpython/blob/3.9/Objects/genobject.c#L385
+        """
+        if isinstance(exc_type, BaseException):
+            exc = exc_type
+        elif isinstance(value, exc_type):
+            exc = value
+        else:
+            exc = exc_type() if value is None else exc_type(value)
+        if traceback is not None:
+            exc = exc.with_traceback(traceback)
+
+        frame = self.frame
+        if frame is None:
+            raise exc
+        if not frame.instruction_index:  # not started: there is no yield to raise at
+            self.frame = None
+            raise exc
+        if self.running:
+            raise ValueError('generator already executing')
+        if frame.instructions[frame.instruction_index][0] is Frame.yield_from_op:
+            receiver = frame.data_stack[-1]
+            try:
+                if isinstance(exc, GeneratorExit):
+                    close = getattr(receiver, 'close', None)
+                    if close is not None:
+                        close()
+                else:
+                    throw = getattr(receiver, 'throw', None)
+                    if throw is not None:
+                        self.running = True
+                        try:
+                            return throw(exc)
+                        finally:
+                            self.running = False
+            except StopIteration as stop:
+                # delegate returned: generator continues after YIELD_FROM with its return value
+                frame.data_stack[-1] = stop.value
+                frame.instruction_index += 1
+                self.enter(frame)
+                self.resumer = RESUMED_BY_HOST
+                frame.vm.run_frame(frame)
+                return self.result(frame)
+            except BaseException as raised:
+                exc = raised
+            frame.instruction_index += 1  # exception is raised by YIELD_FROM
+
+        vm = frame.vm
+        self.enter(frame)
+        self.resumer = RESUMED_BY_HOST
+        handler_frame = vm.handle_exception(frame, exc)
+        if handler_frame is None:
+            raise exc
+        vm.run_frame(handler_frame)
+        return self.result(frame)
+
+    def close(self) -> None:
+        if self.frame is None:
+            return
+        try:
+            self.throw(GeneratorExit)
+        except (GeneratorExit, StopIteration):
+            return
+        raise RuntimeError('generator ignored GeneratorExit')
+
+    def __del__(self) -> None:
+        """
+        Generator suspended at yield is closed when it is dropped, so its `finally` blocks and `with` exits run
+        """
+        frame = self.frame
+        if frame is None or not frame.instruction_index or self.running:
+            return
+        frame.generator = self  # proxy is already cleared when generator is collected by gc
+        self.close()
+
+    def __iter__(self) -> 'Generator':
+        return self
+
+    def __next__(self) -> tp.Any:
+        return self.send(None)
+
+    @property
+    def gi_frame(self) -> tp.Optional['Frame']:
+        return self.frame
+
+    @property
+    def gi_running(self) -> bool:
+        return self.running
+
+    @property
+    def gi_code(self) -> types.CodeType:
+        return self.code
+
+    def __repr__(self) -> str:
+        return f'<generator object {self.code.co_name} at {id(self):#x}>'
 
-    return result
+
+class Coroutine(Generator):
+    """
+    Coroutine of VM `async def` function: a generator which is awaited (resumed by YIELD_FROM) instead of iterated
+    """
+    __slots__ = ()
+
+    def __await__(self) -> 'Coroutine':
+        return self
+
+    def __repr__(self) -> str:
+        return f'<coroutine object {self.code.co_name} at {id(self):#x}>'
 
 
 class Frame:
@@ -137,28 +512,64 @@ class Frame:
     Text description of frame parameters
         https://docs.python.org/3/library/inspect.html?highlight=frame#types-and-members
     """
+    __slots__ = ('vm', 'code', 'builtins', 'globals', 'locals', 'fast_locals', 'cells', 'data_stack', 'return_value',
+                 'decoded', 'instructions', 'caches', 'instruction_index', 'back', 'callee', 'generator')
 
     def __init__(self,
+                 frame_vm: 'VirtualMachine',
                  frame_code: types.CodeType,
                  frame_builtins: dict[str, tp.Any],
                  frame_globals: dict[str, tp.Any],
-                 frame_locals: dict[str, tp.Any]) -> None:
+                 frame_locals: tp.Optional[dict[str, tp.Any]],
+                 frame_fast_locals: tp.Optional[list[tp.Any]] = None,
+                 frame_decoded: tp.Optional['DecodedCode'] = None,
+                 frame_caches: tp.Optional[list[Cache]] = None,
+                 frame_closure: tp.Optional[tuple[types.CellType, ...]] = None,
+                 frame_instructions: tp.Optional[list['Instruction']] = None) -> None:
+        """
+        Function frames have no locals dict (`frame_locals` is None),
+        their variables live in `fast_locals` indexed by position in `co_varnames`.
+        Variables shared with nested functions live in `cells` indexed by position in `co_cellvars + co_freevars`,
+        cells of free variables come from `frame_closure` and are shared with the frame which created them.
+        Functions pass their decoded code, inline caches and instructions,
+        other frames take them from `DECODE_CACHE` and the machine
+        """
+        self.vm = frame_vm
         self.code = frame_code
         self.builtins = frame_builtins
         self.globals = frame_globals
         self.locals = frame_locals
+        if frame_fast_locals is None:
+            frame_fast_locals = [UNBOUND] * frame_code.co_nlocals
+        self.fast_locals = frame_fast_locals
         self.data_stack: tp.Any = []
         self.return_value = None
-        self.bytecode_counter = 0
+        if frame_decoded is None:
+            frame_decoded = DECODE_CACHE.get(frame_code)
+        self.decoded = frame_decoded
+        if frame_decoded.ncellvars or frame_closure:
+            self.cells = frame_decoded.new_cells(frame_fast_locals, frame_closure)
+        else:
+            self.cells = NO_CELLS
+        if frame_instructions is None:
+            frame_instructions = frame_vm.stream(frame_decoded)
+        self.instructions: list['Instruction'] = frame_instructions
+        if frame_caches is None:
+            frame_caches = self.decoded.new_caches()
+        self.caches = frame_caches
+        self.instruction_index: int = 0
+        self.back: tp.Optional[Frame] = None  # calling frame, receives return value
+        self.callee: tp.Optional[Frame] = None  # frame of called function, set by call handler to switch to it
+        self.generator: tp.Optional[Generator] = None  # generator which owns the frame
 
     def top(self) -> tp.Any:
         return self.data_stack[-1]
 
-    def pop(self) -> tp.Any:
+    def pop1(self) -> tp.Any:
         return self.data_stack.pop()
 
-    def push(self, *values: tp.Any) -> None:
-        self.data_stack.extend(values)
+    def push1(self, value: tp.Any) -> None:
+        self.data_stack.append(value)
 
     def popn(self, n: int) -> tp.Any:
         """
@@ -167,25 +578,43 @@ class Frame:
         """
         if n > 0:
             returned = self.data_stack[-n:]
-            self.data_stack[-n:] = []
+            del self.data_stack[-n:]
             return returned
         else:
             return []
 
     def run(self) -> tp.Any:
-        instructions = list(dis.get_instructions(self.code))
-        while self.bytecode_counter < 2 * len(instructions):
-            # print("*" * 100)
-            # print(self.bytecode_counter)
-            instruction = instructions[self.bytecode_counter // 2]
-            getattr(self, instruction.opname.lower() + "_op")(
-                instruction.argval)
-            self.bytecode_counter += 2
-            if instruction.opname == "RETURN_VALUE":
-                break
-        return self.return_value
+        """
+        Execute frame with functions called from it, see `VirtualMachine.run_frame`
+        """
+        return self.vm.run_frame(self)
+
+    def call(self, f: tp.Any, args: tp.Sequence[tp.Any], kwargs: dict[str, tp.Any]) -> tp.Optional[bool]:
+        """
+        Call `f` and push the result.
+        VM functions (and methods bound to them) are not called directly: their new frame is set as `callee`
+        and True is returned to let `VirtualMachine.run_frame` switch to it, return value is pushed on return
+        """
+        f_type = type(f)
+        if f_type is types.MethodType and type(f.__func__) is Function:
+            args = (f.__self__, *args)
+            f = f.__func__
+            f_type = Function
+        if f_type is Function:
+            self.callee = f.frame(args, kwargs)
+            return True
+        self.data_stack.append(f(*args, **kwargs))
+        return None
+
+    def extended_arg_op(self, arg: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-EXTENDED_ARG
 
-    def call_function_op(self, arg: int) -> None:
+        Argument is already merged into the next instruction by `dis`, so here is nothing to do
+        """
+
+    def call_function_op(self, arg: int) -> tp.Optional[bool]:
         """
         Operation description:
             https://docs.python.org/release/3.9.7/library/dis.html#opcode-CALL_FUNCTION
@@ -194,44 +623,180 @@ class Frame:
             https://github.com/python/cpython/blob/3.9/Python/ceval.c#L3496
         """
         arguments = self.popn(arg)
-        f = self.pop()
-        self.push(f(*arguments))
-
-    def call_function_kw_op(self, argc: int) -> None:
-        tos = self.pop()
+        f = self.pop1()
+        if type(f) is Function:
+            self.callee = f.frame(arguments, NO_KWARGS)
+            return True
+        if type(f) is types.MethodType:
+            return self.call(f, arguments, NO_KWARGS)
+        if f is super and not arguments:
+            self.push1(self.zero_argument_super())
+            return None
+        self.push1(f(*arguments))
+        return None
+
+    def zero_argument_super(self) -> super:
+        """
+        `super()` in a method: class from `__class__` cell and the first argument of the frame,
+        host `super` can't find them as VM frames are not Python frames
+        """
+        decoded = self.decoded
+        if not self.code.co_argcount:
+            raise RuntimeError('super(): no arguments')
+        if '__class__' not in self.code.co_freevars:
+            raise RuntimeError('super(): __class__ cell not found')
+        first = self.fast_locals[0]
+        for index, slot in decoded.cell_args:
+            if slot == 0:  # the first argument is a cell variable
+                first = self.cells[index].cell_contents
+        return super(self.cells[decoded.cell_names.index('__class__', decoded.ncellvars)].cell_contents, first)
+
+    def call_function_kw_op(self, argc: int) -> tp.Optional[bool]:
+        tos = self.pop1()
         kwargs = {}
         values = self.popn(len(tos))
         for name, value in zip(tos, values):
             kwargs[name] = value
         args = self.popn(argc - len(tos))
-        f = self.pop()
-        self.push(f(*args, **kwargs))
+        f = self.pop1()
+        return self.call(f, args, kwargs)
+
+    def call_function_ex_op(self, flags: int) -> tp.Optional[bool]:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-CALL_FUNCTION_EX
 
-    # def call_function_ex_op(self, flags: int):
-    #
+        Operation realization:
+            https://github.com/python/cpython/blob/3.9/Python/ceval.c#L3620
+        """
+        kwargs = dict(self.pop1()) if flags & 0x01 else NO_KWARGS
+        args = self.pop1()
+        f = self.pop1()
+        return self.call(f, args if type(args) is tuple else tuple(args), kwargs)
 
     def find(self, name: str) -> tp.Any:
-        if name in self.builtins:
-            return self.builtins[name]
-        elif name in self.locals:
+        if self.locals is not None and name in self.locals:
             return self.locals[name]
         elif name in self.globals:
             return self.globals[name]
-        raise NameError
+        elif name in self.builtins:
+            return self.builtins[name]
+        raise NameError(f"name '{name}' is not defined")
 
-    def load_name_op(self, arg: str) -> None:
+    def find_global(self, cache: NameCache) -> tp.Any:
         """
-        Partial realization
+        Find name in globals or builtins and remember the namespace in inline cache
+        """
+        name = cache.name
+        if name in self.globals:
+            cache.namespace = self.globals
+        elif name in self.builtins:
+            cache.namespace = self.builtins
+        else:
+            raise NameError(f"name '{name}' is not defined")
+        cache.size = len(self.globals)
+        cache.deletions = self.vm.name_deletions
+        return cache.namespace[name]
 
+    def load_name_op(self, slot: int) -> None:
+        """
         Operation description:
             https://docs.python.org/release/3.9.7/library/dis.html#opcode-LOAD_NAME
 
         Operation realization:
             https://github.com/python/cpython/blob/3.9/Python/ceval.c#L2416
         """
-        self.push(self.find(arg))
+        cache: NameCache = self.caches[slot]  # type: ignore
+        if self.locals is not self.globals:  # class body: locals are searched first, not cached
+            self.push1(self.find(cache.name))
+        elif cache.size == len(self.globals) and cache.deletions == self.vm.name_deletions:
+            self.push1(cache.namespace[cache.name])
+        else:
+            self.push1(self.find_global(cache))
+
+    def load_fast_op(self, index: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-LOAD_FAST
+        """
+        value = self.fast_locals[index]
+        if value is UNBOUND:
+            raise UnboundLocalError(
+                f"local variable '{self.code.co_varnames[index]}' referenced before assignment")
+        self.push1(value)
+
+    def store_fast_op(self, index: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-STORE_FAST
+        """
+        self.fast_locals[index] = self.pop1()
+
+    def delete_fast_op(self, index: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-DELETE_FAST
+        """
+        if self.fast_locals[index] is UNBOUND:
+            raise UnboundLocalError(
+                f"local variable '{self.code.co_varnames[index]}' referenced before assignment")
+        self.fast_locals[index] = UNBOUND
+
+    def unbound_cell(self, index: int) -> NameError:
+        """
+        :return: error of reading or deleting an empty cell
+        """
+        name = self.decoded.cell_names[index]
+        if index < self.decoded.ncellvars:
+            return UnboundLocalError(f"local variable '{name}' referenced before assignment")
+        return NameError(f"free variable '{name}' referenced before assignment in enclosing scope")
+
+    def load_closure_op(self, index: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-LOAD_CLOSURE
+        """
+        self.push1(self.cells[index])
+
+    def load_deref_op(self, index: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-LOAD_DEREF
+        """
+        try:
+            self.push1(self.cells[index].cell_contents)
+        except ValueError:
+            raise self.unbound_cell(index) from None
+
+    def load_classderef_op(self, index: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-LOAD_CLASSDEREF
+        """
+        name = self.decoded.cell_names[index]
+        if self.locals is not None and name in self.locals:
+            self.push1(self.locals[name])
+        else:
+            self.load_deref_op(index)
+
+    def store_deref_op(self, index: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-STORE_DEREF
+        """
+        self.cells[index].cell_contents = self.pop1()
 
-    def load_global_op(self, arg: str) -> None:
+    def delete_deref_op(self, index: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-DELETE_DEREF
+        """
+        try:
+            del self.cells[index].cell_contents
+        except ValueError:
+            raise self.unbound_cell(index) from None
+
+    def load_global_op(self, slot: int) -> None:
         """
         Operation description:
             https://docs.python.org/release/3.9.7/library/dis.html#opcode-LOAD_GLOBAL
@@ -239,10 +804,11 @@ class Frame:
         Operation realization:
             https://github.com/python/cpython/blob/3.9/Python/ceval.c#L2480
         """
-        if arg in self.globals:
-            self.push(self.globals[arg])
-        elif arg in self.builtins:
-            self.push(self.builtins[arg])
+        cache: NameCache = self.caches[slot]  # type: ignore
+        if cache.size == len(self.globals) and cache.deletions == self.vm.name_deletions:
+            self.push1(cache.namespace[cache.name])
+        else:
+            self.push1(self.find_global(cache))
 
     def load_const_op(self, arg: tp.Any) -> None:
         """
@@ -252,11 +818,11 @@ class Frame:
         Operation realization:
             https://github.com/python/cpython/blob/3.9/Python/ceval.c#L1346
         """
-        self.push(arg)
+        self.push1(arg)
         b = 3
         max(b, 2)  # __build_class__, к моему великому сожалению, не имеет так называемой документации............
 
-    def return_value_op(self, arg: tp.Any) -> None:
+    def return_value_op(self, arg: tp.Any) -> bool:
         """
         Operation description:
             https://docs.python.org/release/3.9.7/library/dis.html#opcode-RETURN_VALUE
@@ -264,7 +830,8 @@ class Frame:
         Operation realization:
             https://github.com/python/cpython/blob/3.9/Python/ceval.c#L1911
         """
-        self.return_value = self.pop()
+        self.return_value = self.pop1()
+        return True
 
     def pop_top_op(self, arg: tp.Any) -> None:
         """
@@ -274,15 +841,15 @@ class Frame:
         Operation realization:
             https://github.com/python/cpython/blob/3.9/Python/ceval.c#L1361
         """
-        self.pop()
+        self.pop1()
 
     def rot_two_op(self, arg: str) -> None:
-        tos, tos1 = self.pop(), self.pop()
-        self.push(tos, tos1)
+        stack = self.data_stack
+        stack[-1], stack[-2] = stack[-2], stack[-1]
 
     def rot_three_op(self, arg: str) -> None:
-        tos, tos1, tos2 = self.pop(), self.pop(), self.pop()
-        self.push(tos, tos2, tos1)
+        stack = self.data_stack
+        stack[-1], stack[-2], stack[-3] = stack[-2], stack[-3], stack[-1]
 
     def make_function_op(self, arg: int) -> None:
         """
@@ -298,29 +865,27 @@ class Frame:
         Call function in cpython:
             https://github.com/python/cpython/blob/3.9/Python/ceval.c#L4950
         """
-        name = self.pop()  # the qualified name of the function (at TOS)  # noqa
-        code = self.pop()  # the code associated with the function (at TOS1)
-
-        # TODO: use arg to parse function defaults
-
+        name = self.pop1()  # the qualified name of the function (at TOS)
+        code = self.pop1()  # the code associated with the function (at TOS1)
+
+        closure = None
+        if (arg & 0x08) == 0x08:
+            closure = self.pop1()
+        annotations = None
+        if (arg & 0x04) == 0x04:
+            annotations = self.pop1()
         kw_defaults = None
         if (arg & 0x02) == 0x02:
-            kw_defaults = self.pop()
+            kw_defaults = self.pop1()
         defaults = None
         if (arg & 0x01) == 0x01:
-            defaults = self.pop()
-
-        def f(*args: tp.Any, **kwargs: tp.Any) -> tp.Any:
-            # TODO: parse input arguments using code attributes such as co_argcount
+            defaults = self.pop1()
 
-            parsed_args: dict[str, tp.Any] = bind_args(code, defaults, kw_defaults, *args, **kwargs)
-            f_locals = dict(self.locals)
-            f_locals.update(parsed_args)
-
-            frame = Frame(code, self.builtins, self.globals, f_locals)  # Run code in prepared environment
-            return frame.run()
-
-        self.push(f)
+        function_type = GeneratorFunction if code.co_flags & (CO_GENERATOR | CO_COROUTINE) else Function
+        function = function_type(self.vm, code, name, self.builtins, self.globals, defaults, kw_defaults, closure)
+        if annotations is not None:
+            function.__annotations__ = dict(zip(annotations[::2], annotations[1::2]))
+        self.push1(function)
 
     def store_name_op(self, arg: str) -> None:
         """
@@ -330,265 +895,415 @@ class Frame:
         Operation realization:
             https://github.com/python/cpython/blob/3.9/Python/ceval.c#L2280
         """
-        const = self.pop()
-        self.locals[arg] = const
+        const = self.pop1()
+        self.locals[arg] = const  # type: ignore
 
     def store_global_op(self, arg: str) -> None:
         """
         Operation description:
             https://docs.python.org/release/3.9.7/library/dis.html#opcode-STORE_GLOBAL
         """
-        const = self.pop()
+        const = self.pop1()
         self.globals[arg] = const
 
+    def delete_name_op(self, arg: str) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-DELETE_NAME
+        """
+        if arg not in self.locals:  # type: ignore
+            raise NameError(f"name '{arg}' is not defined")
+        del self.locals[arg]  # type: ignore
+        self.vm.name_deletions += 1
+
+    def delete_global_op(self, arg: str) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-DELETE_GLOBAL
+        """
+        if arg not in self.globals:
+            raise NameError(f"name '{arg}' is not defined")
+        del self.globals[arg]
+        self.vm.name_deletions += 1
+
+    def import_name_op(self, name: str) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-IMPORT_NAME
+
+        Operation realization:
+            https://github.com/python/cpython/blob/3.9/Python/ceval.c#L5126
+        """
+        level, fromlist = self.popn(2)
+        import_function = self.builtins.get('__import__')
+        if import_function is None:
+            raise ImportError('__import__ not found')
+        self.push1(import_function(name, self.globals, self.locals, fromlist, level))
+
+    def import_from_op(self, name: str) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-IMPORT_FROM
+
+        Operation realization:
+            https://github.com/python/cpython/blob/3.9/Python/ceval.c#L5170
+        """
+        module = self.top()
+        try:
+            self.push1(getattr(module, name))
+            return
+        except AttributeError:
+            pass
+        module_name = getattr(module, '__name__', None)  # submodule which is imported, but not set as attribute yet
+        if isinstance(module_name, str) and f'{module_name}.{name}' in sys.modules:
+            self.push1(sys.modules[f'{module_name}.{name}'])
+            return
+        raise ImportError(f"cannot import name '{name}' from '{module_name}'", name=module_name)
+
+    def load_attr_op(self, arg: str) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-LOAD_ATTR
+        """
+        self.push1(getattr(self.pop1(), arg))
+
+    def store_attr_op(self, arg: str) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-STORE_ATTR
+        """
+        tos = self.pop1()
+        tos1 = self.pop1()
+        setattr(tos, arg, tos1)
+
+    def delete_attr_op(self, arg: str) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-DELETE_ATTR
+        """
+        tos = self.pop1()
+        delattr(tos, arg)
+
+    def load_method_op(self, slot: int) -> None:
+        """
+        Push unbound method and object if method is found on immutable type of the object,
+        otherwise push UNBOUND and attribute value
+
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-LOAD_METHOD
+
+        Operation realization:
+            https://github.com/python/cpython/blob/3.9/Python/ceval.c#L3450
+        """
+        cache: MethodCache = self.caches[slot]  # type: ignore
+        tos = self.pop1()
+        tos_type = type(tos)
+        if tos_type is cache.type:
+            self.data_stack.append(cache.method)
+            self.data_stack.append(tos)
+            return
+
+        if not tos_type.__flags__ & TPFLAGS_HEAPTYPE and not hasattr(tos, '__dict__'):
+            for klass in tos_type.__mro__:
+                if cache.name in klass.__dict__:
+                    method = klass.__dict__[cache.name]
+                    if isinstance(method, METHOD_DESCRIPTOR_TYPES):
+                        cache.type = tos_type
+                        cache.method = method
+                        self.data_stack.append(method)
+                        self.data_stack.append(tos)
+                        return
+                    break
+        self.data_stack.append(UNBOUND)
+        self.data_stack.append(getattr(tos, cache.name))
+
+    def call_method_op(self, argc: int) -> tp.Optional[bool]:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-CALL_METHOD
+        """
+        arguments = self.popn(argc)
+        tos = self.pop1()
+        method = self.pop1()
+        if method is UNBOUND:
+            if type(tos) is Function or type(tos) is types.MethodType:
+                return self.call(tos, arguments, NO_KWARGS)
+            self.push1(tos(*arguments))
+        elif type(method) is Function:
+            self.callee = method.frame((tos, *arguments), NO_KWARGS)
+            return True
+        else:
+            self.push1(method(tos, *arguments))
+        return None
+
     def unpack_sequence_op(self, count: int) -> None:
-        tos = self.pop()
-        for i in range(1, count + 1):
-            self.push(tos[-i])
+        """
+        Operation realization:
+            https://github.com/python/cpython/blob/3.9/Python/ceval.c#L2451
+        """
+        tos = self.pop1()
+        if type(tos) is not tuple and type(tos) is not list:
+            try:
+                iterator = iter(tos)
+            except TypeError:
+                raise TypeError(f'cannot unpack non-iterable {type(tos).__name__} object') from None
+            tos = list(itertools.islice(iterator, count + 1))  # no more than needed to tell there are too many
+        if len(tos) > count:
+            raise ValueError(f'too many values to unpack (expected {count})')
+        if len(tos) < count:
+            raise ValueError(f'not enough values to unpack (expected {count}, got {len(tos)})')
+        self.data_stack.extend(reversed(tos))
 
     def compare_op_op(self, op: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        if op == "==":
-            return self.push(tos1 == tos)
-        elif op == "<":
-            return self.push(tos1 < tos)
-        elif op == ">":
-            return self.push(tos1 > tos)
-        elif op == "<=":
-            return self.push(tos1 <= tos)
-        elif op == ">=":
-            return self.push(tos1 >= tos)
-        elif op == "!=":
-            return self.push(tos1 != tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(COMPARE_OPERATIONS[op](tos1, tos))
+
+    def is_op_op(self, invert: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-IS_OP
+        """
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1((tos1 is tos) != bool(invert))
+
+    def contains_op_op(self, invert: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-CONTAINS_OP
+        """
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1((tos1 in tos) != bool(invert))
 
     def inplace_add_op(self, arg: str) -> None:
         """
         Operation description:
             https://docs.python.org/release/3.9.7/library/dis.html#opcode-INPLACE_ADD
         """
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos1 += tos
-        self.push(tos1)
+        self.push1(tos1)
 
     def inplace_power_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos = tos1 ** tos
-        self.push(tos)
+        self.push1(tos)
 
     def inplace_multiply_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos1 *= tos
-        self.push(tos1)
+        self.push1(tos1)
 
     def inplace_floor_divide_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos1 //= tos
-        self.push(tos1)
+        self.push1(tos1)
 
     def inplace_true_divide_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos1 /= tos
-        self.push(tos1)
+        self.push1(tos1)
 
     def inplace_modulo_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos1 %= tos
-        self.push(tos1)
+        self.push1(tos1)
 
     def inplace_subtract_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos1 -= tos
-        self.push(tos1)
+        self.push1(tos1)
 
     def inplace_matrix_multiply_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos1 @= tos
-        self.push(tos1)
+        self.push1(tos1)
 
     def inplace_lshift_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos1 <<= tos
-        self.push(tos1)
+        self.push1(tos1)
 
     def inplace_rshift_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos1 >>= tos
-        self.push(tos1)
+        self.push1(tos1)
 
     def inplace_and_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos1 &= tos
-        self.push(tos1)
+        self.push1(tos1)
 
     def inplace_xor_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos1 ^= tos
-        self.push(tos1)
+        self.push1(tos1)
 
     def inplace_or_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos1 |= tos
-        self.push(tos1)
+        self.push1(tos1)
 
     def binary_add_op(self, arg: str) -> None:
         """
         Operation description:
             https://docs.python.org/release/3.9.7/library/dis.html#opcode-binary_ADD
         """
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 + tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 + tos)
 
     def binary_power_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 ** tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 ** tos)
 
     def binary_multiply_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 * tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 * tos)
 
     def binary_floor_divide_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 // tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 // tos)
 
     def binary_true_divide_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 / tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 / tos)
 
     def binary_modulo_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 % tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 % tos)
 
     def binary_subtract_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 - tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 - tos)
 
     def binary_matrix_multiply_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 @ tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 @ tos)
 
     def binary_lshift_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 << tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 << tos)
 
     def binary_rshift_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 >> tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 >> tos)
 
     def binary_and_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 & tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 & tos)
 
     def binary_xor_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 ^ tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 ^ tos)
 
     def binary_or_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1 | tos)
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1 | tos)
 
     def unary_positive_op(self, arg: str) -> None:
-        tos = self.pop()
-        self.push(+tos)
+        tos = self.pop1()
+        self.push1(+tos)
 
     def unary_negative_op(self, arg: str) -> None:
-        tos = self.pop()
-        self.push(-tos)
+        tos = self.pop1()
+        self.push1(-tos)
 
     def unary_not_op(self, arg: str) -> None:
-        tos = self.pop()
-        self.push(not tos)
+        tos = self.pop1()
+        self.push1(not tos)
 
     def unary_invert_op(self, arg: str) -> None:
-        tos = self.pop()
-        self.push(~tos)
+        tos = self.pop1()
+        self.push1(~tos)
 
     def binary_subscr_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         tos = tos1[tos]
-        self.push(tos)
+        self.push1(tos)
 
     def store_subscr_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        tos2 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
+        tos2 = self.pop1()
         tos1[tos] = tos2
-        self.push(tos1[tos])
+        self.push1(tos1[tos])
 
     def delete_subscr_op(self, arg: str) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        self.push(tos1[tos])
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.push1(tos1[tos])
         del tos1[tos]
 
     def get_iter_op(self, arg: str) -> None:
-        tos = self.pop()
-        self.push(iter(tos))
+        tos = self.pop1()
+        self.push1(iter(tos))
 
     def build_slice_op(self, argc: int) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.pop1()
         if argc == 2:
-            self.push(slice(tos1, tos))
+            self.push1(slice(tos1, tos))
         else:
-            tos2 = self.pop()
-            self.push(slice(tos2, tos1, tos))
+            tos2 = self.pop1()
+            self.push1(slice(tos2, tos1, tos))
 
     def build_tuple_op(self, count: int) -> None:
-        self.push(tuple(self.popn(count)))
+        self.push1(tuple(self.popn(count)))
 
     def build_list_op(self, count: int) -> None:
-        self.push(list(self.popn(count)))
+        self.push1(list(self.popn(count)))
 
     def build_set_op(self, count: int) -> None:
-        self.push(set(self.popn(count)))
+        self.push1(set(self.popn(count)))
 
     def build_map_op(self, count: int) -> None:
         m = {}
         for i in range(count):
-            a = self.pop()
-            b = self.pop()
+            a = self.pop1()
+            b = self.pop1()
             m[b] = a
-        self.push(m)
+        self.push1(m)
 
     def list_to_tuple_op(self, arg: str) -> None:
-        self.push(tuple(self.pop()))
+        self.push1(tuple(self.pop1()))
 
     def build_string_op(self, count: int) -> None:
-        self.push("".join(list(self.popn(count))))
+        self.push1("".join(list(self.popn(count))))
 
     def format_value_op(self, flags: tuple[tp.Any, tp.Any]) -> None:
         fmt_spec = ""
         if flags[1]:
-            fmt_spec = self.pop()
-        value = self.pop()
+            fmt_spec = self.pop1()
+        value = self.pop1()
         if flags[0] is None:
             pass
         elif (flags[0] & 0x03) == 0x01:
@@ -597,98 +1312,2377 @@ class Frame:
             value = repr(value)
         elif (flags[0] & 0x03) == 0x03:
             value = ascii(value)
-        self.push(format(value, fmt_spec))
+        self.push1(format(value, fmt_spec))
 
     def build_const_key_map_op(self, count: int) -> None:
         m = {}
-        keys = self.pop()
+        keys = self.pop1()
         for key, value in zip(keys, self.popn(count)):
             m[key] = value
-        self.push(m)
+        self.push1(m)
+
+    def list_extend_op(self, i: int) -> None:
+        tos = self.pop1()
+        self.data_stack[-i].extend(tos)
 
     def set_update_op(self, i: int) -> None:
-        tos = self.pop()
-        tosses = self.popn(i - 1)
-        tos1 = self.pop()
-        tos1.update(tos)
-        self.push(tos1)
-        self.push(*tosses)
+        tos = self.pop1()
+        self.data_stack[-i].update(tos)
 
     def dict_update_op(self, i: int) -> None:
-        tos = self.pop()
-        tosses = self.popn(i - 1)
-        tos1 = self.pop()
-        tos1.update(tos)
-        self.push(tos1)
-        self.push(*tosses)
+        tos = self.pop1()
+        self.data_stack[-i].update(tos)
 
     def dict_merge_op(self, i: int) -> None:
-        tos = self.pop()
-        tosses = self.popn(i - 1)
-        tos1 = self.pop()
+        tos = self.pop1()
+        tos1 = self.data_stack[-i]
         for key in tos:
             if key in tos1:
                 raise KeyError
             tos1[key] = tos[key]
-        self.push(tos1)
-        self.push(*tosses)
 
     def jump_forward_op(self, delta: int) -> None:
-        self.bytecode_counter = delta - 2
+        self.instruction_index = delta
 
     def pop_jump_if_true_op(self, target: int) -> None:
-        tos = self.pop()
+        tos = self.pop1()
         if tos:
-            self.bytecode_counter = target - 2
+            self.instruction_index = target
 
     def pop_jump_if_false_op(self, target: int) -> None:
-        tos = self.pop()
+        tos = self.pop1()
         if not tos:
-            self.bytecode_counter = target - 2
+            self.instruction_index = target
 
     # def jump_if_not_exc_match(self, target: int) -> None:
-    #     tos = self.pop()
-    #     tos1 = self.pop()
+    #     tos = self.pop1()
+    #     tos1 = self.pop1()
     #     if tos == tos1:
-    #         self.bytecode_counter = target - 2
+    #         self.instruction_index = target
 
     def jump_if_true_or_pop_op(self, target: int) -> None:
         if self.top():
-            self.bytecode_counter = target - 2
+            self.instruction_index = target
         else:
-            self.pop()
+            self.pop1()
 
     def jump_if_false_or_pop_op(self, target: int) -> None:
         if not self.top():
-            self.bytecode_counter = target - 2
+            self.instruction_index = target
         else:
-            self.pop()
+            self.pop1()
 
     def jump_absolute_op(self, target: int) -> None:
-        self.bytecode_counter = target - 2
+        self.instruction_index = target
+
+    # Checkpoints of sampled code: backward jumps and entries of code count down to the next check of `Sampler`,
+    # see `add_checkpoints`
+
+    def jump_absolute_checkpoint_op(self, target: int) -> None:
+        self.instruction_index = target
+        sampler: Sampler = self.vm.sampler  # type: ignore
+        sampler.countdown -= 1
+        if not sampler.countdown:
+            sampler.checkpoint(self)
+
+    def entry_checkpoint_op(self, instruction: 'Instruction') -> tp.Optional[bool]:
+        sampler: Sampler = self.vm.sampler  # type: ignore
+        sampler.countdown -= 1
+        if not sampler.countdown:
+            sampler.checkpoint(self)
+        handler, arg = instruction
+        return handler(self, arg)
+
+    def for_iter_op(self, target: int) -> tp.Optional[bool]:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-FOR_ITER
 
-    def map_add_op(self, i: int) -> None:
-        tos = self.pop()
-        tos1 = self.pop()
-        tosses = self.popn(i - 1)
-        tos2 = self.pop()
-        tos2[tos1] = tos
-        self.push(tos2)
-        self.push(*tosses)
+        VM generator is resumed in place: its frame is switched to like a called one
+        """
+        iterator = self.data_stack[-1]
+        if type(iterator) is Generator and iterator.frame is not None:
+            self.callee = iterator.resume(None, RESUMED_BY_FOR_ITER, target)
+            return True
+        value = next(iterator, UNBOUND)
+        if value is UNBOUND:
+            self.pop1()
+            self.instruction_index = target
+        else:
+            self.push1(value)
+        return None
 
-    def set_add_op(self, i: int) -> None:
-        tos = self.pop()
-        tosses = self.popn(i - 1)
-        tos1 = self.pop()
-        tos1.add(tos)
-        self.push(tos1)
-        self.push(*tosses)
+    # Generators: frame is left by yield like by return, see `VirtualMachine.leave_generator`
+
+    def yield_value_op(self, arg: tp.Any) -> bool:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-YIELD_VALUE
+        """
+        self.return_value = self.pop1()
+        self.generator.suspended = True  # type: ignore
+        return True
+
+    def yield_from_op(self, arg: tp.Any) -> tp.Optional[bool]:
+        """
+        Send value to the delegate, yield its result and repeat YIELD_FROM when resumed until delegate returns
+
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-YIELD_FROM
+
+        Operation realization:
+            https://github.com/python/cpython/blob/3.9/Python/ceval.c#L2183
+        """
+        value = self.pop1()
+        receiver = self.data_stack[-1]
+        if isinstance(receiver, Generator) and receiver.frame is not None:
+            self.callee = receiver.resume(value, RESUMED_BY_YIELD_FROM)
+            return True
+        try:  # host coroutines are not iterators, they are resumed by `send` only
+            if value is None and type(receiver) is not types.CoroutineType:
+                result = next(receiver)
+            else:
+                result = receiver.send(value)
+        except StopIteration as stop:
+            self.data_stack[-1] = stop.value
+            return None
+        self.instruction_index -= 1
+        self.return_value = result
+        self.generator.suspended = True  # type: ignore
+        return True
+
+    def get_yield_from_iter_op(self, arg: tp.Any) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-GET_YIELD_FROM_ITER
+        """
+        iterable = self.data_stack[-1]
+        if isinstance(iterable, Coroutine):
+            if not self.code.co_flags & (CO_COROUTINE | CO_ITERABLE_COROUTINE):
+                raise TypeError("cannot 'yield from' a coroutine object in a non-coroutine generator")
+        elif not isinstance(iterable, (Generator, types.GeneratorType)):
+            self.data_stack[-1] = iter(iterable)
+
+    def get_awaitable_op(self, arg: tp.Any) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-GET_AWAITABLE
+        """
+        awaitable = self.data_stack[-1]
+        if not isinstance(awaitable, (Coroutine, types.CoroutineType)):
+            try:
+                self.data_stack[-1] = _special_method(awaitable, '__await__')()
+            except AttributeError:
+                raise TypeError(f"object {type(awaitable).__name__} can't be used in 'await' expression") from None
+
+    def get_aiter_op(self, arg: tp.Any) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-GET_AITER
+        """
+        iterable = self.data_stack[-1]
+        try:
+            get_aiter = _special_method(iterable, '__aiter__')
+        except AttributeError:
+            raise TypeError(f"'async for' requires an object with __aiter__ method, "
+                            f"got {type(iterable).__name__}") from None
+        iterator = get_aiter()
+        if not hasattr(type(iterator), '__anext__'):
+            raise TypeError(f"'async for' received an object from __aiter__ that does not implement __anext__: "
+                            f"{type(iterator).__name__}")
+        self.data_stack[-1] = iterator
+
+    def get_anext_op(self, arg: tp.Any) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-GET_ANEXT
+        """
+        awaitable = _special_method(self.data_stack[-1], '__anext__')()
+        if not isinstance(awaitable, (Coroutine, types.CoroutineType)):
+            try:
+                awaitable = _special_method(awaitable, '__await__')()
+            except AttributeError:
+                raise TypeError(f"'async for' received an invalid object from __anext__: "
+                                f"{type(awaitable).__name__}") from None
+        self.push1(awaitable)
+
+    def dup_top_op(self, arg: tp.Any) -> None:
+        self.data_stack.append(self.data_stack[-1])
+
+    def dup_top_two_op(self, arg: tp.Any) -> None:
+        self.data_stack.extend(self.data_stack[-2:])
+
+    def rot_four_op(self, arg: tp.Any) -> None:
+        stack = self.data_stack
+        stack[-1], stack[-2], stack[-3], stack[-4] = stack[-2], stack[-3], stack[-4], stack[-1]
+
+    # Exceptions: blocks of SETUP_FINALLY / SETUP_WITH are known statically, so they are not kept in runtime.
+    # Handler of raised exception is found in exception table of code, see `VirtualMachine.handle_exception`
+
+    def setup_finally_op(self, target: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-SETUP_FINALLY
+
+        Block is in exception table already, so here is nothing to do
+        """
+
+    def pop_block_op(self, arg: tp.Any) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-POP_BLOCK
+
+        Block is in exception table already, so here is nothing to do
+        """
+
+    def setup_with_op(self, target: int) -> tp.Optional[bool]:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-SETUP_WITH
+
+        Operation realization:
+            https://github.com/python/cpython/blob/3.9/Python/ceval.c#L3375
+        """
+        manager = self.pop1()
+        enter = _special_method(manager, '__enter__')
+        self.push1(_special_method(manager, '__exit__'))
+        return self.call(enter, (), NO_KWARGS)
+
+    def before_async_with_op(self, arg: tp.Any) -> tp.Optional[bool]:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-BEFORE_ASYNC_WITH
+        """
+        manager = self.pop1()
+        enter = _special_method(manager, '__aenter__')
+        self.push1(_special_method(manager, '__aexit__'))
+        return self.call(enter, (), NO_KWARGS)
+
+    def setup_async_with_op(self, target: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-SETUP_ASYNC_WITH
+
+        Block is in exception table already, so here is nothing to do
+        """
+
+    def with_except_start_op(self, arg: tp.Any) -> tp.Optional[bool]:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-WITH_EXCEPT_START
+        """
+        stack = self.data_stack
+        return self.call(stack[-7], (stack[-1], stack[-2], stack[-3]), NO_KWARGS)
+
+    def pop_except_op(self, arg: tp.Any) -> None:
+        """
+        Restore exception which was handled before the current one
+
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-POP_EXCEPT
+        """
+        stack = self.data_stack
+        self.vm.exc_info = (stack[-1], stack[-2], stack[-3])
+        del stack[-3:]
+
+    def end_async_for_op(self, arg: tp.Any) -> None:
+        """
+        Handler of `async for`: StopAsyncIteration ends the loop, other exceptions are reraised
+
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-END_ASYNC_FOR
+
+        Operation realization:
+            https://github.com/python/cpython/blob/3.9/Python/ceval.c#L2284
+        """
+        stack = self.data_stack
+        if not issubclass(stack[-1], StopAsyncIteration):
+            raise stack[-2].with_traceback(stack[-3])
+        del stack[-3:]
+        self.vm.exc_info = (stack[-1], stack[-2], stack[-3])
+        del stack[-4:]  # previous exception and async iterator
+
+    def jump_if_not_exc_match_op(self, target: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-JUMP_IF_NOT_EXC_MATCH
+        """
+        tos = self.pop1()
+        tos1 = self.pop1()
+        for klass in tos if isinstance(tos, tuple) else (tos,):
+            if not isinstance(klass, type) or not issubclass(klass, BaseException):
+                raise TypeError('catching classes that do not inherit from BaseException is not allowed')
+        if not issubclass(tos1, tos):
+            self.instruction_index = target
+
+    def reraise_op(self, arg: tp.Any) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-RERAISE
+        """
+        self.pop1()
+        value = self.pop1()
+        traceback = self.pop1()
+        raise value.with_traceback(traceback)
+
+    def raise_varargs_op(self, argc: int) -> None:
+        """
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-RAISE_VARARGS
+        """
+        if argc == 0:
+            exc_type, value, traceback = self.vm.exc_info
+            if value is None:
+                raise RuntimeError('No active exception to reraise')
+            raise value.with_traceback(traceback)
+        cause = self.pop1() if argc == 2 else None
+        exc = self.pop1()
+        if argc == 2:
+            raise exc from cause
+        raise exc
+
+    def load_assertion_error_op(self, arg: tp.Any) -> None:
+        self.push1(AssertionError)
+
+    def load_build_class_op(self, arg: tp.Any) -> None:
+        """
+        Push `VirtualMachine.build_class` unless `__build_class__` is replaced in builtins
+
+        Operation description:
+            https://docs.python.org/release/3.9.7/library/dis.html#opcode-LOAD_BUILD_CLASS
+
+        Operation realization:
+            https://github.com/python/cpython/blob/3.9/Python/ceval.c#L2178
+        """
+        build_class = self.builtins.get('__build_class__')
+        if build_class is None:
+            raise NameError('__build_class__ not found')
+        self.push1(self.vm.build_class if build_class is builtins.__build_class__ else build_class)
+
+    # Superinstructions: fused sequences of operations, see `fuse`.
+    # Argument is a tuple of arguments of fused operations
+
+    def load_fast_load_fast_op(self, arg: tuple[int, int]) -> None:
+        first, second = arg
+        tos1 = self.fast_locals[first]
+        tos = self.fast_locals[second]
+        if tos1 is UNBOUND or tos is UNBOUND:  # one of loads raises UnboundLocalError
+            self.load_fast_op(first)
+            self.load_fast_op(second)
+        self.data_stack.append(tos1)
+        self.data_stack.append(tos)
+
+    def load_fast_load_fast_binary_add_op(self, arg: tuple[int, int, tp.Any]) -> None:
+        first, second, _ = arg
+        tos1 = self.fast_locals[first]
+        tos = self.fast_locals[second]
+        if tos1 is UNBOUND or tos is UNBOUND:  # one of loads raises UnboundLocalError
+            self.load_fast_op(first)
+            self.load_fast_op(second)
+        self.push1(tos1 + tos)
+
+    def load_fast_load_const_op(self, arg: tuple[int, tp.Any]) -> None:
+        index, const = arg
+        self.load_fast_op(index)
+        self.push1(const)
+
+    def load_const_store_fast_op(self, arg: tuple[tp.Any, int]) -> None:
+        const, index = arg
+        self.fast_locals[index] = const
+
+    def load_const_store_name_op(self, arg: tuple[tp.Any, str]) -> None:
+        const, name = arg
+        self.locals[name] = const  # type: ignore
+
+    def store_fast_load_fast_op(self, arg: tuple[int, int]) -> None:
+        first, second = arg
+        self.fast_locals[first] = self.pop1()
+        self.load_fast_op(second)
+
+    def compare_op_pop_jump_if_false_op(self, arg: tuple[str, int]) -> None:
+        op, target = arg
+        tos = self.pop1()
+        tos1 = self.pop1()
+        if not COMPARE_OPERATIONS[op](tos1, tos):
+            self.instruction_index = target
+
+    def compare_op_pop_jump_if_true_op(self, arg: tuple[str, int]) -> None:
+        op, target = arg
+        tos = self.pop1()
+        tos1 = self.pop1()
+        if COMPARE_OPERATIONS[op](tos1, tos):
+            self.instruction_index = target
+
+    def load_const_return_value_op(self, arg: tuple[tp.Any, None]) -> bool:
+        self.return_value = arg[0]
+        return True
+
+    # Quickening: adaptive operations specialise themselves for types of operands, see `quicken`
+
+    def adaptive_op(self, state: 'AdaptiveState') -> tp.Optional[bool]:
+        """
+        Run generic operation, after warmup replace itself in instructions with specialisation for current operands
+        """
+        if state.countdown:
+            state.countdown -= 1
+            return state.generic(self, state.arg)
+
+        tos_type = type(self.data_stack[-1])
+        specialised = None
+        if type(self.data_stack[-2]) is tos_type:
+            specialised = SPECIALISATIONS.get((state.generic, state.key, tos_type))
+        if specialised is None:
+            state.backoff = min(2 * state.backoff, QUICKENING_MAX_BACKOFF)
+            state.countdown = state.backoff
+            return state.generic(self, state.arg)
+
+        self.vm.specialisations += 1
+        self.instructions[self.instruction_index - 1] = (specialised, state)
+        return specialised(self, state)
+
+    def deoptimise(self, state: 'AdaptiveState') -> tp.Optional[bool]:
+        """
+        Called by specialised operation when type guard fails: return adaptive operation back and run generic one
+        """
+        self.vm.deoptimisations += 1
+        state.backoff = min(2 * state.backoff, QUICKENING_MAX_BACKOFF)
+        state.countdown = state.backoff
+        self.instructions[self.instruction_index - 1] = (Frame.adaptive_op, state)
+        return state.generic(self, state.arg)
+
+    def list_append_op(self, i: int) -> None:
+        tos = self.pop1()
+        self.data_stack[-i].append(tos)
+
+    def map_add_op(self, i: int) -> None:
+        tos = self.pop1()
+        tos1 = self.pop1()
+        self.data_stack[-i][tos1] = tos
+
+    def set_add_op(self, i: int) -> None:
+        tos = self.pop1()
+        self.data_stack[-i].add(tos)
+
+
+Handler = tp.Callable[[Frame, tp.Any], tp.Optional[bool]]
+Instruction = tuple[Handler, tp.Any]
+
+
+def _missing_operation(opname: str) -> Handler:
+    """
+    Handler for operations without realization, fails only when operation is executed
+    """
+    def missing(frame: Frame, arg: tp.Any) -> None:
+        raise AttributeError(f"Operation {opname} is not supported")
+    missing.__name__ = opname.lower() + '_op'
+    return missing
+
+
+def operation_name(handler: Handler) -> str:
+    """
+    :return: name of operation executed by handler, e.g. 'LOAD_FAST' or 'BINARY_ADD_INT' for specialisation
+    """
+    return handler.__name__.removesuffix('_op').upper()
+
+
+# Dispatch table: handler for each opcode, `None` for opcodes without realization
+OPERATIONS: list[tp.Optional[Handler]] = [getattr(Frame, opname.lower() + "_op", None) for opname in dis.opname]
+
+# Operations which argval is a bytecode offset, it is converted to instruction index while decoding
+JUMP_OPERATIONS = frozenset(dis.hasjrel + dis.hasjabs)
+
+# Operations with inline cache, argument is converted to cache slot while decoding
+CACHED_OPERATIONS: dict[int, tp.Callable[[str], Cache]] = {
+    dis.opmap['LOAD_GLOBAL']: NameCache,
+    dis.opmap['LOAD_NAME']: NameCache,
+    dis.opmap['LOAD_METHOD']: MethodCache,
+}
+
+QUICKENING_WARMUP = 8  # executions of adaptive operation before the first specialisation attempt
+QUICKENING_MAX_BACKOFF = 1024  # max executions of generic operation between failed specialisation attempts
+
+
+class AdaptiveState:
+    """
+    Argument of adaptive operation and of its specialisations
+    """
+    __slots__ = ('generic', 'arg', 'key', 'countdown', 'backoff')
+
+    def __init__(self, generic: Handler, arg: tp.Any, key: tp.Any) -> None:
+        self.generic = generic  # generic handler
+        self.arg = arg  # argument of generic handler
+        self.key = key  # part of argument which selects specialisation, e.g. comparison operator
+        self.countdown = QUICKENING_WARMUP
+        self.backoff = QUICKENING_WARMUP
+
+
+def _specialised_binary(operation: tp.Callable[[tp.Any, tp.Any], tp.Any], operand_type: type) -> Handler:
+    def specialised(frame: Frame, state: AdaptiveState) -> tp.Optional[bool]:
+        stack = frame.data_stack
+        tos = stack[-1]
+        tos1 = stack[-2]
+        if type(tos) is not operand_type or type(tos1) is not operand_type:
+            return frame.deoptimise(state)
+        del stack[-1]
+        stack[-1] = operation(tos1, tos)
+        return None
+    return specialised
+
+
+def _specialised_compare_jump(operation: tp.Callable[[tp.Any, tp.Any], bool], operand_type: type,
+                              jump_if: bool) -> Handler:
+    def specialised(frame: Frame, state: AdaptiveState) -> tp.Optional[bool]:
+        stack = frame.data_stack
+        tos = stack[-1]
+        tos1 = stack[-2]
+        if type(tos) is not operand_type or type(tos1) is not operand_type:
+            return frame.deoptimise(state)
+        del stack[-2:]
+        if operation(tos1, tos) is jump_if:
+            frame.instruction_index = state.arg[1]
+        return None
+    return specialised
+
+
+# Operations which can be quickened -> function extracting specialisation key from argument
+QUICKENED_OPERATIONS: dict[Handler, tp.Callable[[tp.Any], tp.Any]] = {}
+
+# (generic handler, specialisation key, type of both operands) -> specialised handler
+SPECIALISATIONS: dict[tuple[Handler, tp.Any, type], Handler] = {}
+
+_BINARY_OPERATIONS: dict[Handler, tp.Callable[[tp.Any, tp.Any], tp.Any]] = {}
+_generic: Handler
+for _generic, _operation, _operand_types in [
+    (Frame.binary_add_op, operator.add, (int, str)),
+    (Frame.inplace_add_op, operator.iadd, (int, str)),
+    (Frame.binary_subtract_op, operator.sub, (int,)),
+    (Frame.inplace_subtract_op, operator.isub, (int,)),
+    (Frame.binary_multiply_op, operator.mul, (int,)),
+    (Frame.inplace_multiply_op, operator.imul, (int,)),
+    (Frame.binary_floor_divide_op, operator.floordiv, (int,)),
+    (Frame.binary_modulo_op, operator.mod, (int,)),
+]:
+    QUICKENED_OPERATIONS[_generic] = lambda arg: None
+    _BINARY_OPERATIONS[_generic] = _operation
+    for _operand_type in _operand_types:
+        SPECIALISATIONS[_generic, None, _operand_type] = _specialised_binary(_operation, _operand_type)
+
+QUICKENED_OPERATIONS[Frame.compare_op_op] = lambda op: op
+QUICKENED_OPERATIONS[Frame.compare_op_pop_jump_if_false_op] = lambda arg: arg[0]
+QUICKENED_OPERATIONS[Frame.compare_op_pop_jump_if_true_op] = lambda arg: arg[0]
+for _op, _operation in COMPARE_OPERATIONS.items():
+    for _operand_type in (int, str):
+        SPECIALISATIONS[Frame.compare_op_op, _op, _operand_type] = _specialised_binary(_operation, _operand_type)
+        SPECIALISATIONS[Frame.compare_op_pop_jump_if_false_op, _op, _operand_type] = _specialised_compare_jump(
+            _operation, _operand_type, False)
+        SPECIALISATIONS[Frame.compare_op_pop_jump_if_true_op, _op, _operand_type] = _specialised_compare_jump(
+            _operation, _operand_type, True)
+
+for (_generic, _, _operand_type), _specialised in SPECIALISATIONS.items():
+    _specialised.__name__ = f'{_generic.__name__.removesuffix("_op")}_{_operand_type.__name__}_op'
+
+
+def _unguarded_binary(operation: tp.Callable[[tp.Any, tp.Any], tp.Any]) -> Handler:
+    def unguarded(frame: Frame, state: AdaptiveState) -> tp.Optional[bool]:
+        stack = frame.data_stack
+        tos = stack.pop()
+        stack[-1] = operation(stack[-1], tos)
+        return None
+    return unguarded
+
+
+def _unguarded_compare_jump(operation: tp.Callable[[tp.Any, tp.Any], bool], jump_if: bool) -> Handler:
+    def unguarded(frame: Frame, state: AdaptiveState) -> tp.Optional[bool]:
+        stack = frame.data_stack
+        tos = stack.pop()
+        if operation(stack.pop(), tos) is jump_if:
+            frame.instruction_index = state.arg[1]
+        return None
+    return unguarded
+
+
+# Specialisations for operands of types proven by `analyse`: the same keys as `SPECIALISATIONS`, no type guards
+UNGUARDED_SPECIALISATIONS: dict[tuple[Handler, tp.Any, type], Handler] = {}
+for (_generic, _key, _operand_type), _specialised in SPECIALISATIONS.items():
+    if _generic is Frame.compare_op_pop_jump_if_false_op or _generic is Frame.compare_op_pop_jump_if_true_op:
+        _unguarded = _unguarded_compare_jump(COMPARE_OPERATIONS[_key], _generic is Frame.compare_op_pop_jump_if_true_op)
+    elif _generic is Frame.compare_op_op:
+        _unguarded = _unguarded_binary(COMPARE_OPERATIONS[_key])
+    else:
+        _unguarded = _unguarded_binary(_BINARY_OPERATIONS[_generic])
+    _unguarded.__name__ = _specialised.__name__.removesuffix('_op') + '_unguarded_op'
+    UNGUARDED_SPECIALISATIONS[_generic, _key, _operand_type] = _unguarded
+
+# Quickened operation -> opcode of the instruction (of the first fused one), see `DecodedCode.build_stream`
+QUICKENED_OPCODES: dict[Handler, int] = {
+    handler: (dis.opmap['COMPARE_OP'] if handler in (Frame.compare_op_pop_jump_if_false_op,
+                                                     Frame.compare_op_pop_jump_if_true_op)
+              else OPERATIONS.index(handler))
+    for handler in QUICKENED_OPERATIONS
+}
+
+
+def quicken(instructions: list[Instruction],
+            operand_types: tp.Optional[list[tp.Optional[type]]] = None) -> list[Instruction]:
+    """
+    Copy instructions replacing generic arithmetic and comparison operations with adaptive ones.
+    Adaptive operation rewrites itself in the copy with a specialisation for operand types it keeps seeing
+    (int or str), specialisation rewrites itself back when its type guard fails.
+    Operations with operand types proven by `analyse` get specialisations without type guards at once
+    :param instructions: instructions to copy
+    :param operand_types: type of both operands of every instruction if it is provable, see `CodeAnalysis`
+    :return: adaptive instructions
+    """
+    adaptive: list[Instruction] = []
+    for index, (handler, arg) in enumerate(instructions):
+        key_of = QUICKENED_OPERATIONS.get(handler)
+        if key_of is None:
+            adaptive.append((handler, arg))
+            continue
+        key = key_of(arg)
+        unguarded = None
+        operand_type = operand_types[index] if operand_types is not None else None
+        if operand_type is not None:
+            unguarded = UNGUARDED_SPECIALISATIONS.get((handler, key, operand_type))
+        adaptive.append((unguarded or Frame.adaptive_op, AdaptiveState(handler, arg, key)))
+    return adaptive
+
+
+def add_checkpoints(instructions: list[Instruction]) -> list[Instruction]:
+    """
+    Copy instructions making backward JUMP_ABSOLUTE (the end of every loop iteration) and the first instruction
+    (entry of function, unless it is a loop start anyway) checkpoints of `Sampler`.
+    Sampled code runs in the usual loop and pays only for a countdown at checkpoints
+    :param instructions: instructions to copy
+    :return: instructions with checkpoints
+    """
+    checkpointed = list(instructions)
+    loop_starts = set()
+    for index, (handler, arg) in enumerate(instructions):
+        if handler is Frame.jump_absolute_op and arg <= index:
+            checkpointed[index] = (Frame.jump_absolute_checkpoint_op, arg)
+            loop_starts.add(arg)
+    if checkpointed and 0 not in loop_starts:
+        checkpointed[0] = (Frame.entry_checkpoint_op, checkpointed[0])
+    return checkpointed
+
+
+# Blocks around instruction, outermost first: (handler index, stack level) for SETUP_FINALLY / SETUP_WITH /
+# SETUP_ASYNC_WITH block,
+# (EXCEPT_HANDLER, stack level) for block of handler which runs now (it keeps handled exception on the stack)
+BlockChain = tuple[tuple[int, int], ...]
+EXCEPT_HANDLER = -1
+
+SETUP_FINALLY = dis.opmap['SETUP_FINALLY']
+SETUP_WITH = dis.opmap['SETUP_WITH']
+SETUP_ASYNC_WITH = dis.opmap['SETUP_ASYNC_WITH']
+SETUP_OPCODES = frozenset([SETUP_FINALLY, SETUP_WITH, SETUP_ASYNC_WITH])
+END_ASYNC_FOR = dis.opmap['END_ASYNC_FOR']
+POP_BLOCK = dis.opmap['POP_BLOCK']
+POP_EXCEPT = dis.opmap['POP_EXCEPT']
+# Operations after which the next instruction is not executed
+NO_FALLTHROUGH = frozenset([dis.opmap['JUMP_ABSOLUTE'], dis.opmap['JUMP_FORWARD'], dis.opmap['RETURN_VALUE'],
+                            dis.opmap['RAISE_VARARGS'], dis.opmap['RERAISE']])
+
+
+def _block_chains(decoded: 'DecodedCode') -> list[BlockChain]:
+    """
+    Static analysis of blocks: every instruction is reached with the same blocks and stack depth
+    whatever path it is reached by (this is how CPython compiler works since 3.8)
+    :param decoded: decoded code, not optimised and not fused
+    :return: blocks around every instruction, unreachable instructions have no blocks
+    """
+    opcodes = decoded.opcodes
+    if not any(opcode in SETUP_OPCODES for opcode in opcodes):
+        return [()] * len(opcodes)
+
+    chains: list[tp.Optional[BlockChain]] = [None] * len(opcodes)
+    pending: list[tuple[int, int, BlockChain]] = [(0, 0, ())]  # (index, stack depth, blocks)
+    while pending:
+        index, depth, chain = pending.pop()
+        while index < len(opcodes) and chains[index] is None:
+            chains[index] = chain
+            opcode = opcodes[index]
+            oparg = decoded.opargs[index]
+            if opcode in SETUP_OPCODES:
+                # handler is entered with 3 values of previous exception and 3 values of the raised one,
+                # result of awaited `__aenter__` on the stack is above the block of SETUP_ASYNC_WITH
+                handler = decoded.instructions[index][1]
+                level = depth - 1 if opcode == SETUP_ASYNC_WITH else depth
+                pending.append((handler, level + 6, chain + ((EXCEPT_HANDLER, level),)))
+                chain = chain + ((handler, level),)
+            elif opcode == POP_BLOCK or opcode == POP_EXCEPT or opcode == END_ASYNC_FOR:
+                chain = chain[:-1]
+            elif opcode in JUMP_OPERATIONS:
+                pending.append((decoded.instructions[index][1], depth + dis.stack_effect(opcode, oparg, jump=True),
+                                chain))
+            if opcode in NO_FALLTHROUGH:
+                break
+            if opcode in JUMP_OPERATIONS:
+                depth += dis.stack_effect(opcode, oparg, jump=False)
+            elif opcode >= dis.HAVE_ARGUMENT:
+                depth += dis.stack_effect(opcode, oparg)
+            else:
+                depth += dis.stack_effect(opcode)
+            index += 1
+    return [chain or () for chain in chains]
+
+
+# Static analysis of stack depth and types, see `analyse`
+class _NotStored:
+    def __repr__(self) -> str:
+        return '<not stored>'
+
+
+NOT_STORED: tp.Any = _NotStored()  # type of local which has no stores found yet, below int and str
+ABSTRACT_TYPES = (int, str)  # types tracked by `analyse`, any other value has type None
+
+INT_CLOSED_OPCODES = frozenset(dis.opmap[name] for name in [  # int and int give int
+    'BINARY_ADD', 'INPLACE_ADD', 'BINARY_SUBTRACT', 'INPLACE_SUBTRACT', 'BINARY_MULTIPLY', 'INPLACE_MULTIPLY',
+    'BINARY_FLOOR_DIVIDE', 'INPLACE_FLOOR_DIVIDE', 'BINARY_MODULO', 'INPLACE_MODULO', 'BINARY_LSHIFT',
+    'INPLACE_LSHIFT', 'BINARY_RSHIFT', 'INPLACE_RSHIFT', 'BINARY_AND', 'INPLACE_AND', 'BINARY_OR', 'INPLACE_OR',
+    'BINARY_XOR', 'INPLACE_XOR'])
+ADD_OPCODES = frozenset([dis.opmap['BINARY_ADD'], dis.opmap['INPLACE_ADD']])  # str and str give str
+MULTIPLY_OPCODES = frozenset([dis.opmap['BINARY_MULTIPLY'], dis.opmap['INPLACE_MULTIPLY']])  # str and int give str
+BINARY_OPCODES = frozenset(opcode for name, opcode in dis.opmap.items()
+                           if name.startswith(('BINARY_', 'INPLACE_')) or name == 'COMPARE_OP')
+UNARY_INT_OPCODES = frozenset([dis.opmap['UNARY_POSITIVE'], dis.opmap['UNARY_NEGATIVE'], dis.opmap['UNARY_INVERT']])
+PUSH_UNKNOWN_OPCODES = frozenset(dis.opmap[name] for name in [
+    'LOAD_GLOBAL', 'LOAD_NAME', 'LOAD_DEREF', 'LOAD_CLASSDEREF', 'LOAD_CLOSURE', 'LOAD_BUILD_CLASS',
+    'LOAD_ASSERTION_ERROR'])
+POP_OPCODES = frozenset(dis.opmap[name] for name in ['POP_TOP', 'STORE_NAME', 'STORE_GLOBAL', 'STORE_DEREF'])
+LOAD_CONST = dis.opmap['LOAD_CONST']
+LOAD_FAST = dis.opmap['LOAD_FAST']
+STORE_FAST = dis.opmap['STORE_FAST']
+DELETE_FAST = dis.opmap['DELETE_FAST']
+LOAD_ATTR = dis.opmap['LOAD_ATTR']
+LOAD_METHOD = dis.opmap['LOAD_METHOD']
+CALL_FUNCTION = dis.opmap['CALL_FUNCTION']
+CALL_METHOD = dis.opmap['CALL_METHOD']
+DUP_TOP = dis.opmap['DUP_TOP']
+ROT_TWO = dis.opmap['ROT_TWO']
+ROT_THREE = dis.opmap['ROT_THREE']
+FOR_ITER = dis.opmap['FOR_ITER']
+COMPARE_OP = dis.opmap['COMPARE_OP']
+POP_JUMPS = frozenset([dis.opmap['POP_JUMP_IF_FALSE'], dis.opmap['POP_JUMP_IF_TRUE']])
+JUMPS_OR_POP = frozenset([dis.opmap['JUMP_IF_FALSE_OR_POP'], dis.opmap['JUMP_IF_TRUE_OR_POP']])
+NO_SUCCESSOR = frozenset([dis.opmap['RETURN_VALUE'], dis.opmap['RAISE_VARARGS'], dis.opmap['RERAISE']])
+
+
+def _join(first: tp.Any, second: tp.Any) -> tp.Any:
+    if first is NOT_STORED or first is second:
+        return second
+    if second is NOT_STORED:
+        return first
+    return None
+
+
+def _binary_type(opcode: int, left: tp.Any, right: tp.Any) -> tp.Any:
+    """
+    :return: type of result of binary operation on values of abstract types, see `analyse`
+    """
+    if left is NOT_STORED or right is NOT_STORED:  # optimistic: the operand gets the type of the other one
+        if left is right:
+            return NOT_STORED
+        left = right = right if left is NOT_STORED else left
+    if left is int and right is int and opcode in INT_CLOSED_OPCODES:
+        return int
+    if left is str and right is str and opcode in ADD_OPCODES:
+        return str
+    if opcode in MULTIPLY_OPCODES and {left, right} == {int, str}:
+        return str
+    return None
+
+
+class CodeAnalysis(tp.NamedTuple):
+    """
+    Result of `analyse` for a code object
+    """
+    depths: list[int]  # stack depth before every instruction, -1 for unreachable ones
+    block_depths: dict[int, int]  # first instruction of basic block -> max stack depth inside the block
+    max_depth: int
+    local_types: dict[str, type]  # fast locals which are provably int or str whenever they are bound
+    operand_types: list[tp.Optional[type]]  # type of both operands of binary operation or comparison if provable
+
+
+def _flow(decoded: 'DecodedCode', local_types: list[tp.Any],
+          stores: list[tp.Any]) -> tuple[list[tp.Optional[tuple[tp.Any, ...]]], list[tp.Optional[type]], list[int]]:
+    """
+    Abstract interpretation of instructions with types of fast locals fixed: stack of abstract types before
+    every instruction is joined over all paths to the instruction until nothing changes
+    :param decoded: decoded code, not optimised and not fused
+    :param local_types: assumed type of every fast local
+    :param stores: joined types of values stored to fast locals, updated
+    :return: stacks before instructions, operand types of binary operations, stack depths after instructions
+    """
+    opcodes = decoded.opcodes
+    opargs = decoded.opargs
+    instructions = decoded.instructions
+    n = len(opcodes)
+    stacks: list[tp.Optional[tuple[tp.Any, ...]]] = [None] * n
+    operand_types: list[tp.Optional[type]] = [None] * n
+    depths_after = [0] * n
+    stacks[0] = ()
+    pending = [0]
+    while pending:
+        index = pending.pop()
+        stack = list(stacks[index])  # type: ignore
+        opcode = opcodes[index]
+        oparg = opargs[index]
+        arg = instructions[index][1]
+        successors: list[tuple[int, list[tp.Any]]] = []
+        if opcode == LOAD_CONST:
+            stack.append(type(arg) if type(arg) in ABSTRACT_TYPES else None)
+        elif opcode == LOAD_FAST:
+            stack.append(local_types[arg])
+        elif opcode == STORE_FAST:
+            stores[arg] = _join(stores[arg], stack.pop())
+        elif opcode in BINARY_OPCODES:
+            right = stack.pop()
+            left = stack.pop()
+            # the stack before the instruction only widens, so the last visit sees the joined operand types
+            operand_types[index] = left if left is right and left in ABSTRACT_TYPES else None
+            stack.append(None if opcode == COMPARE_OP else _binary_type(opcode, left, right))
+        elif opcode in UNARY_INT_OPCODES:
+            operand = stack.pop()
+            stack.append(operand if operand is int or operand is NOT_STORED else None)
+        elif opcode in PUSH_UNKNOWN_OPCODES:
+            stack.append(None)
+        elif opcode in POP_OPCODES:
+            stack.pop()
+        elif opcode == LOAD_ATTR:
+            stack[-1] = None
+        elif opcode == LOAD_METHOD:
+            stack[-1:] = [None, None]
+        elif opcode == CALL_FUNCTION or opcode == CALL_METHOD:
+            assert oparg is not None
+            del stack[len(stack) - oparg - (1 if opcode == CALL_FUNCTION else 2):]
+            stack.append(None)
+        elif opcode == DUP_TOP:
+            stack.append(stack[-1])
+        elif opcode == ROT_TWO:
+            stack[-2:] = stack[-1], stack[-2]
+        elif opcode == ROT_THREE:
+            stack[-3:] = stack[-1], stack[-3], stack[-2]
+        elif opcode in POP_JUMPS:
+            stack.pop()
+            successors.append((arg, stack))
+        elif opcode in JUMPS_OR_POP:
+            successors.append((arg, stack.copy()))
+            stack.pop()
+        elif opcode == FOR_ITER:
+            successors.append((arg, stack[:-1]))
+            stack.append(None)
+        elif opcode in JUMP_OPERATIONS:  # handlers of SETUP_* blocks are entered with unknown values on the stack
+            successors.append((arg, [None] * (len(stack) + dis.stack_effect(opcode, oparg, jump=True))))
+            if opcode not in NO_FALLTHROUGH:
+                stack = [None] * (len(stack) + dis.stack_effect(opcode, oparg, jump=False))
+        elif opcode == DELETE_FAST:
+            stores[arg] = None
+        elif opcode not in NO_SUCCESSOR:
+            stack = [None] * (len(stack) + dis.stack_effect(opcode, oparg if opcode >= dis.HAVE_ARGUMENT else None))
+        if opcode not in NO_FALLTHROUGH and index + 1 < n:
+            successors.append((index + 1, stack))
+
+        for successor, successor_stack in successors:
+            depths_after[index] = max(depths_after[index], len(successor_stack))
+            previous = stacks[successor]
+            if previous is None:
+                joined = tuple(successor_stack)
+            elif len(previous) != len(successor_stack):
+                raise SystemError(f'{decoded.name}: instruction {successor} is reached with stack depths '
+                                  f'{len(previous)} and {len(successor_stack)}')
+            else:
+                joined = tuple(_join(old, new) for old, new in zip(previous, successor_stack))
+                if joined == previous:
+                    continue
+            stacks[successor] = joined
+            pending.append(successor)
+    return stacks, operand_types, depths_after
+
+
+def analyse(decoded: 'DecodedCode') -> CodeAnalysis:
+    """
+    Static analysis of stack depth and types of a code object.
+    Fast locals which are not arguments get types of values stored to them: starting with no stores,
+    stacks are interpreted with types of locals found so far until stored types don't change.
+    Only exact int and str are tracked, they are closed under a few operations (int + int, str * int etc.),
+    everything else is None. Max stack depth must not exceed `co_stacksize`, otherwise SystemError is raised
+    :param decoded: decoded code, not optimised and not fused
+    """
+    nlocals = len(decoded.varnames)
+    local_types: list[tp.Any] = [None] * decoded.nargs + [NOT_STORED] * (nlocals - decoded.nargs)
+    while True:
+        stores = [None] * decoded.nargs + [NOT_STORED] * (nlocals - decoded.nargs)
+        _flow(decoded, local_types, stores)
+        joined = [_join(assumed, stored) for assumed, stored in zip(local_types, stores)]
+        if joined == local_types:
+            break
+        local_types = joined
+    local_types = [None if local_type is NOT_STORED else local_type for local_type in local_types]
+    stacks, operand_types, depths_after = _flow(decoded, local_types, [None] * nlocals)
+
+    depths = [-1 if stack is None else len(stack) for stack in stacks]
+    block_depths: dict[int, int] = {}
+    leader = 0
+    for index, opcode in enumerate(decoded.opcodes):
+        if index in decoded.jump_targets or index == 0 or decoded.opcodes[index - 1] in JUMP_OPERATIONS:
+            leader = index
+        if depths[index] >= 0:
+            block_depths[leader] = max(block_depths.get(leader, 0), depths[index], depths_after[index])
+    max_depth = max(block_depths.values(), default=0)
+    if max_depth > decoded.stacksize:
+        raise SystemError(f'{decoded.name}: stack depth {max_depth} exceeds co_stacksize {decoded.stacksize}')
+    return CodeAnalysis(depths, block_depths, max_depth,
+                        {decoded.varnames[slot]: local_type for slot, local_type in enumerate(local_types)
+                         if local_type is not None},
+                        operand_types)
+
+
+# Decoded code saved by `DecodedCode.state`, see `DiskCache`
+DecodedState = tuple[tp.Any, ...]
+# Instructions saved by `_encoded_instructions`: opcodes, arguments and (index, kind, value) of escaped arguments
+EncodedInstructions = tuple[list[int], list[tp.Any], list[tuple[int, int, tp.Any]]]
+
+ARG_CONST = 0  # escaped argument is a code object from `co_consts` saved as its index, so it stays the same object
+
+
+def _encoded_instructions(instructions: list[Instruction], opcodes: list[int],
+                          consts: tuple[tp.Any, ...]) -> EncodedInstructions:
+    """
+    :raise ValueError: some argument can't be saved by marshal, such program is not cached on disk
+    """
+    args: list[tp.Any] = []
+    escaped: list[tuple[int, int, tp.Any]] = []
+    for index, (handler, arg) in enumerate(instructions):
+        if arg is None or type(arg) is int or type(arg) is str:
+            args.append(arg)
+        elif isinstance(arg, types.CodeType):
+            escaped.append((index, ARG_CONST, next(i for i, const in enumerate(consts) if const is arg)))
+            args.append(None)
+        else:
+            marshal.dumps(arg)
+            args.append(arg)
+    return opcodes, args, escaped
+
+
+def _decoded_instructions(encoded: EncodedInstructions,
+                          consts: tuple[tp.Any, ...]) -> tuple[list[Instruction], list[int]]:
+    """
+    :raise ValueError: broken or forged instructions, only code objects of `consts` may be arguments
+    """
+    opcodes, args, escaped = encoded
+    if any(isinstance(arg, types.CodeType) for arg in args):
+        raise ValueError('code object saved as an argument')
+    for index, kind, value in escaped:
+        if kind != ARG_CONST or not isinstance(consts[value], types.CodeType):
+            raise ValueError(f'unknown escaped argument {kind}')
+        args[index] = consts[value]
+    instructions = [(OPERATIONS[opcode] or _missing_operation(dis.opname[opcode]), arg)
+                    for opcode, arg in zip(opcodes, args)]
+    return instructions, opcodes
+
+
+# Guards decoding and lazily built parts of decoded code, which are shared by virtual machines in all threads.
+# Reentrant, as building a stream builds optimised code and superinstructions first
+_DECODE_LOCK = threading.RLock()
+
+
+class DecodedCode:
+    """
+    Code object prepared for execution: decoded instructions, jump targets and name tables.
+    It is built once per code object and shared by all frames, so it must not reference the code object itself.
+    Parts built on first use are built under `_DECODE_LOCK`. Adaptive streams rewrite themselves while they run,
+    so they are not shared: every machine quickens its own copies, see `VirtualMachine.adaptive_streams`
+    """
+
+    def __init__(self, code: types.CodeType, state: tp.Optional['DecodedState'] = None) -> None:
+        """
+        :param code: code object to decode
+        :param state: result of decoding saved by `state` earlier, e.g. loaded from `DiskCache`
+        """
+        self.instructions: list[Instruction] = []
+        self.opcodes: list[int] = []
+        self.jump_targets: set[int] = set()  # indices of instructions which are jump targets
+        # (cache factory, name) of every inline cache, argument of cached instruction is its slot
+        self.cache_layout: list[tuple[tp.Callable[[str], Cache], str]] = []
+        self.line_starts: list[tp.Optional[int]] = []  # source line started by instruction or None
+        self.opargs: list[tp.Optional[int]] = []  # raw arguments, e.g. for `dis.stack_effect`
+        if state is not None:
+            self._restore(code, state)
+            return
+        for instruction in dis.get_instructions(code):
+            handler = OPERATIONS[instruction.opcode] or _missing_operation(instruction.opname)
+            arg = instruction.argval
+            if instruction.opcode in JUMP_OPERATIONS:
+                arg //= 2
+            elif instruction.opcode in dis.haslocal or instruction.opcode in dis.hasfree:
+                arg = instruction.arg  # index in fast locals or in cells of the frame
+            elif instruction.opcode in CACHED_OPERATIONS:
+                arg = len(self.cache_layout)
+                self.cache_layout.append((CACHED_OPERATIONS[instruction.opcode], instruction.argval))
+            if instruction.is_jump_target:
+                self.jump_targets.add(len(self.instructions))
+            self.instructions.append((handler, arg))
+            self.opcodes.append(instruction.opcode)
+            self.line_starts.append(instruction.starts_line)
+            self.opargs.append(instruction.arg)
+
+        # blocks of SETUP_FINALLY / SETUP_WITH around every instruction, see `exception_table`
+        self.block_chains = _block_chains(self)
+        self._init_tables(code)
+
+    def _init_tables(self, code: types.CodeType) -> None:
+        """
+        Fill the part of decoded code which is built from decoded instructions and names of the code object
+        """
+        self.has_blocks = any(self.block_chains)
+        self.origins = list(range(len(self.instructions)))  # instruction index -> index in code object
+        self.index_of = self.origins  # index in code object -> instruction index (of the next one if it's removed)
+        self.exception_tables: list[tp.Optional[list[BlockChain]]] = [None] * 16
+
+        self.name = code.co_name
+        self.names = code.co_names
+        self.varnames = code.co_varnames
+        self.nargs = (code.co_argcount + code.co_kwonlyargcount +
+                      bool(code.co_flags & CO_VARARGS) + bool(code.co_flags & CO_VARKEYWORDS))
+        self.stacksize = code.co_stacksize
+        self.slots = {name: index for index, name in enumerate(code.co_varnames)}  # fast local name -> index
+        self.cell_names = code.co_cellvars + code.co_freevars  # cell index -> name
+        self.ncellvars = len(code.co_cellvars)
+        # cell variables which are arguments: (cell index, fast local index), their cells start with the argument
+        self.cell_args = [(index, self.slots[name]) for index, name in enumerate(code.co_cellvars)
+                          if name in self.slots]
+
+        self._plan: tp.Optional[BindingPlan] = None
+        self._analysis: tp.Optional[CodeAnalysis] = None
+        self._superinstructions: tp.Optional[list[Instruction]] = None
+        self.superinstruction_indices: list[int] = []  # instruction index -> index in `superinstructions`
+        self._superinstruction_line_starts: tp.Optional[list[tp.Optional[int]]] = None
+        self._optimised: tp.Optional[DecodedCode] = None
+        self.removed_instructions = 0  # number of instructions removed by peephole optimiser, see `optimised`
+        # instruction streams by combination of STREAM_* flags, built on first use after `analysis`
+        self.streams: list[tp.Optional[list[Instruction]]] = [None] * 16
+        # adaptive stream which is never run and indices of its adaptive operations, see `quickened_stream`
+        self.adaptive_templates: list[tp.Optional[tuple[list[Instruction], list[int]]]] = [None] * 16
+
+    def state(self, code: types.CodeType) -> 'DecodedState':
+        """
+        Decoded and optimised instructions in marshallable form, see `DiskCache`.
+        Handlers are restored from opcodes; code objects in arguments are saved separately as indices in `co_consts`.
+        :raise ValueError: other argument can't be saved by marshal (e.g. conversion function of FORMAT_VALUE)
+        :param code: code object this decoded code was built for
+        """
+        optimised = self.optimised
+        return (
+            _encoded_instructions(self.instructions, self.opcodes, code.co_consts),
+            self.line_starts, self.opargs, sorted(self.jump_targets),
+            [name for _, name in self.cache_layout], self.block_chains,
+            _encoded_instructions(optimised.instructions, optimised.opcodes, code.co_consts),
+            optimised.line_starts, optimised.origins, optimised.index_of,
+        )
+
+    def _restore(self, code: types.CodeType, state: 'DecodedState') -> None:
+        (instructions, self.line_starts, self.opargs, jump_targets, cached_names, self.block_chains,
+         optimised_instructions, optimised_line_starts, origins, index_of) = state
+        self.instructions, self.opcodes = _decoded_instructions(instructions, code.co_consts)
+        self.jump_targets = set(jump_targets)
+        self.cache_layout = [(CACHED_OPERATIONS[opcode], name) for opcode, name in
+                             zip((opcode for opcode in self.opcodes if opcode in CACHED_OPERATIONS), cached_names)]
+        self._init_tables(code)
+        instructions, opcodes = _decoded_instructions(optimised_instructions, code.co_consts)
+        self._optimised = self.replaced(instructions, opcodes, optimised_line_starts, origins, index_of)
+
+    def new_caches(self) -> list[Cache]:
+        """
+        Empty inline caches for a function (or a module) with this code
+        """
+        return [cache_type(name) for cache_type, name in self.cache_layout]
+
+    def binding_plan(self, code: types.CodeType) -> BindingPlan:
+        """
+        Binding plan of functions with this code and without default values, built on first use
+        """
+        if self._plan is None:
+            self._plan = BindingPlan(code, None, None)
+        return self._plan
+
+    def new_cells(self, fast_locals: list[tp.Any], closure: tp.Optional[tuple[types.CellType, ...]]) -> list[tp.Any]:
+        """
+        Cells of a new frame: new cells of `co_cellvars` followed by cells of `co_freevars` taken from the closure
+        :param fast_locals: bound arguments of the frame, cells of arguments start with their values
+        :param closure: cells of free variables created by frames of enclosing functions
+        """
+        cells = [types.CellType() for _ in range(self.ncellvars)]
+        for index, slot in self.cell_args:
+            cells[index].cell_contents = fast_locals[slot]
+        if closure:
+            cells.extend(closure)
+        return cells
+
+    @property
+    def superinstructions(self) -> list[Instruction]:
+        """
+        Instructions with common sequences fused into superinstructions, built on first use
+        """
+        if self._superinstructions is None:
+            with _DECODE_LOCK:
+                if self._superinstructions is None:
+                    superinstructions, self.superinstruction_indices = fuse(self)
+                    self._superinstructions = superinstructions
+        return self._superinstructions
+
+    @property
+    def analysis(self) -> CodeAnalysis:
+        """
+        Stack depths and provable types of the code, see `analyse`, built on first use
+        """
+        if self._analysis is None:
+            with _DECODE_LOCK:
+                if self._analysis is None:
+                    self._analysis = analyse(self)
+        return self._analysis
+
+    @property
+    def optimised(self) -> 'DecodedCode':
+        """
+        Decoded code after peephole optimiser, built on first use
+        """
+        if self._optimised is None:
+            with _DECODE_LOCK:
+                if self._optimised is None:
+                    self._optimised = optimise(self)
+        return self._optimised
+
+    def replaced(self, instructions: list[Instruction], opcodes: list[int], line_starts: list[tp.Optional[int]],
+                 origins: list[int], index_of: list[int]) -> 'DecodedCode':
+        """
+        :return: copy of decoded code with other instructions, jump arguments must be instruction indices.
+                 `origins` and `index_of` map instructions to original ones and back
+        """
+        decoded = copy.copy(self)
+        decoded.instructions = instructions
+        decoded.opcodes = opcodes
+        decoded.line_starts = line_starts
+        decoded.origins = origins
+        decoded.index_of = index_of
+        decoded.exception_tables = [None] * 16
+        decoded.jump_targets = {arg for (handler, arg), opcode in zip(instructions, opcodes)
+                                if opcode in JUMP_OPERATIONS}
+        decoded._superinstructions = None
+        decoded.superinstruction_indices = []
+        decoded._superinstruction_line_starts = None
+        decoded._optimised = decoded
+        decoded.removed_instructions = len(self.instructions) - len(instructions)
+        decoded.streams = [None] * 16
+        decoded.streams[0] = instructions
+        decoded.adaptive_templates = [None] * 16
+        return decoded
+
+    def build_stream(self, mode: int) -> list[Instruction]:
+        """
+        :param mode: combination of STREAM_* flags without STREAM_ADAPTIVE
+        :return: instructions to execute in this mode
+        """
+        with _DECODE_LOCK:
+            instructions = self.streams[mode]
+            if instructions is not None:
+                return instructions
+            self.analysis  # checks stack depth before the code is executed
+            if mode & STREAM_CHECKPOINTS:
+                instructions = add_checkpoints(self.build_stream(mode & ~STREAM_CHECKPOINTS))
+            else:
+                base = self.optimised if mode & STREAM_OPTIMISED else self
+                instructions = base.superinstructions if mode & STREAM_SUPERINSTRUCTIONS else base.instructions
+            self.streams[mode] = instructions
+            return instructions
+
+    def quickened_stream(self, mode: int) -> list[Instruction]:
+        """
+        :param mode: combination of STREAM_* flags with STREAM_ADAPTIVE
+        :return: new copy of the stream with adaptive operations, see `quicken`.
+                 It is copied from a template quickened once, only states of adaptive operations are new
+        """
+        template = self.adaptive_templates[mode]
+        if template is None:
+            with _DECODE_LOCK:
+                template = self.adaptive_templates[mode]
+                if template is None:
+                    shared = mode & ~STREAM_ADAPTIVE
+                    instructions = self.streams[shared] or self.build_stream(shared)
+                    analysis = self.analysis
+                    _, origins = self.stream_maps(mode)
+                    opcodes = self.opcodes
+                    adaptive = quicken(instructions, [
+                        analysis.operand_types[origin] if QUICKENED_OPCODES.get(handler) == opcodes[origin] else None
+                        for (handler, _), origin in zip(instructions, origins)])
+                    template = self.adaptive_templates[mode] = (adaptive, [
+                        index for index, (handler, _) in enumerate(adaptive) if handler is Frame.adaptive_op])
+        adaptive, indices = template
+        stream = list(adaptive)
+        for index in indices:
+            handler, state = stream[index]
+            stream[index] = (handler, AdaptiveState(state.generic, state.arg, state.key))
+        return stream
+
+    def exception_table(self, mode: int) -> tp.Optional[list['BlockChain']]:
+        """
+        :param mode: combination of STREAM_* flags
+        :return: blocks around every instruction of the stream with handlers as indices in the stream,
+                 None if code has no blocks
+        """
+        if not self.has_blocks:
+            return None
+        table = self.exception_tables[mode]
+        if table is None:
+            with _DECODE_LOCK:
+                table = self.exception_tables[mode]
+                if table is None:
+                    to_stream, origins = self.stream_maps(mode)
+                    converted: dict[BlockChain, BlockChain] = {}
+                    table = []
+                    for origin in origins:
+                        chain = self.block_chains[origin]
+                        if chain not in converted:
+                            converted[chain] = tuple((to_stream[handler] if handler >= 0 else handler, level)
+                                                     for handler, level in chain)
+                        table.append(converted[chain])
+                    self.exception_tables[mode] = table
+        return table
+
+    def stream_maps(self, mode: int) -> tuple[list[int], list[int]]:
+        """
+        :param mode: combination of STREAM_* flags
+        :return: instruction index -> index in the stream, index in the stream -> instruction index
+                 (of the first part of fused instruction)
+        """
+        base = self.optimised if mode & STREAM_OPTIMISED else self
+        if not mode & STREAM_SUPERINSTRUCTIONS:
+            return base.index_of, base.origins
+        base.superinstructions  # builds `superinstruction_indices`
+        fused_of = base.superinstruction_indices
+        to_stream = [fused_of[index] if index < len(fused_of) else fused_of[-1] + 1  # the end of code
+                     for index in base.index_of]
+        first_parts: dict[int, int] = {}
+        for index, fused in enumerate(fused_of):
+            first_parts.setdefault(fused, index)
+        return to_stream, [base.origins[first_parts[fused]] for fused in range(len(first_parts))]
+
+    def stream_line_starts(self, mode: int) -> list[tp.Optional[int]]:
+        """
+        :param mode: combination of STREAM_* flags
+        :return: `line_starts` for instructions of the stream, fused instruction starts the first line of its parts
+        """
+        if mode & STREAM_OPTIMISED and self.optimised is not self:
+            return self.optimised.stream_line_starts(mode)
+        if not mode & STREAM_SUPERINSTRUCTIONS:
+            return self.line_starts
+        if self._superinstruction_line_starts is None:
+            superinstructions = self.superinstructions  # fills `superinstruction_indices`
+            line_starts: list[tp.Optional[int]] = [None] * len(superinstructions)
+            for index in reversed(range(len(self.line_starts))):
+                if self.line_starts[index] is not None:
+                    line_starts[self.superinstruction_indices[index]] = self.line_starts[index]
+            self._superinstruction_line_starts = line_starts
+        return self._superinstruction_line_starts
+
+
+# Fused sequences of operations, longer sequences first
+SUPERINSTRUCTIONS: dict[tuple[int, ...], Handler] = {
+    tuple(dis.opmap[opname] for opname in opnames): getattr(Frame, '_'.join(opnames).lower() + '_op')
+    for opnames in [
+        ('LOAD_FAST', 'LOAD_FAST', 'BINARY_ADD'),
+        ('LOAD_FAST', 'LOAD_FAST'),
+        ('LOAD_FAST', 'LOAD_CONST'),
+        ('LOAD_CONST', 'STORE_FAST'),
+        ('LOAD_CONST', 'STORE_NAME'),
+        ('STORE_FAST', 'LOAD_FAST'),
+        ('COMPARE_OP', 'POP_JUMP_IF_FALSE'),
+        ('COMPARE_OP', 'POP_JUMP_IF_TRUE'),
+        ('LOAD_CONST', 'RETURN_VALUE'),
+    ]
+}
+SUPERINSTRUCTION_LENGTHS = sorted({len(opcodes) for opcodes in SUPERINSTRUCTIONS}, reverse=True)
+
+
+def fuse(decoded: DecodedCode) -> tuple[list[Instruction], list[int]]:
+    """
+    Replace sequences of operations from `SUPERINSTRUCTIONS` with single instructions.
+    Sequence is fused only if none of its operations except the first one is a jump target,
+    jump arguments are remapped to new instruction indices
+    :param decoded: decoded code
+    :return: fused instructions and index of fused instruction for every original instruction
+    """
+    opcodes = decoded.opcodes
+    targets = decoded.jump_targets
+    groups: list[tuple[tp.Optional[Handler], int, int]] = []  # (superinstruction handler, start, length)
+    indices: list[int] = []
+    start = 0
+    while start < len(opcodes):
+        handler: tp.Optional[Handler] = None
+        length = 1
+        for candidate in SUPERINSTRUCTION_LENGTHS:
+            sequence = tuple(opcodes[start:start + candidate])
+            if (len(sequence) == candidate and sequence in SUPERINSTRUCTIONS and
+                    not targets.intersection(range(start + 1, start + candidate))):
+                handler, length = SUPERINSTRUCTIONS[sequence], candidate
+                break
+        indices.extend([len(groups)] * length)
+        groups.append((handler, start, length))
+        start += length
+
+    fused: list[Instruction] = []
+    for handler, start, length in groups:
+        args = []
+        for index in range(start, start + length):
+            arg = decoded.instructions[index][1]
+            if decoded.opcodes[index] in JUMP_OPERATIONS:
+                arg = indices[arg]
+            args.append(arg)
+        if handler is None:
+            fused.append((decoded.instructions[start][0], args[0]))
+        else:
+            fused.append((handler, tuple(args)))
+    return fused, indices
+
+
+NOP = dis.opmap['NOP']
+EXTENDED_ARG = dis.opmap['EXTENDED_ARG']
+POP_TOP = dis.opmap['POP_TOP']
+BUILD_TUPLE = dis.opmap['BUILD_TUPLE']
+RETURN_VALUE = dis.opmap['RETURN_VALUE']
+JUMP_ABSOLUTE = dis.opmap['JUMP_ABSOLUTE']
+POP_JUMP_IF_FALSE = dis.opmap['POP_JUMP_IF_FALSE']
+POP_JUMP_IF_TRUE = dis.opmap['POP_JUMP_IF_TRUE']
+UNCONDITIONAL_JUMPS = frozenset([JUMP_ABSOLUTE, dis.opmap['JUMP_FORWARD']])
+# Instructions without effect at runtime, dropped when optimised code is compacted
+# (SETUP_FINALLY and POP_BLOCK live through optimiser passes, reachability of handlers relies on them)
+REMOVED_OPERATIONS = frozenset([NOP, EXTENDED_ARG, SETUP_FINALLY, POP_BLOCK])
+
+# Operations on constants which are computed by optimiser: opcode -> (number of operands, function)
+_folded_operations: list[tuple[str, int, tp.Callable[..., tp.Any]]] = [
+    ('UNARY_POSITIVE', 1, operator.pos),
+    ('UNARY_NEGATIVE', 1, operator.neg),
+    ('UNARY_NOT', 1, operator.not_),
+    ('UNARY_INVERT', 1, operator.invert),
+    ('BINARY_ADD', 2, operator.add),
+    ('BINARY_SUBTRACT', 2, operator.sub),
+    ('BINARY_MULTIPLY', 2, operator.mul),
+    ('BINARY_TRUE_DIVIDE', 2, operator.truediv),
+    ('BINARY_FLOOR_DIVIDE', 2, operator.floordiv),
+    ('BINARY_MODULO', 2, operator.mod),
+    ('BINARY_SUBSCR', 2, operator.getitem),
+    ('BINARY_AND', 2, operator.and_),
+    ('BINARY_OR', 2, operator.or_),
+    ('BINARY_XOR', 2, operator.xor),
+]
+FOLDED_OPERATIONS: dict[int, tuple[int, tp.Callable[..., tp.Any]]] = {
+    dis.opmap[opname]: (arity, function) for opname, arity, function in _folded_operations
+}
+MAX_FOLDED_SIZE = 256  # folded strings, bytes and tuples are not longer, as well as ints in bits
+
+
+def _fold(opcode: int, operands: list[tp.Any]) -> tuple[bool, tp.Any]:
+    """
+    :return: (True, value) if operation on constant operands may be replaced by a constant, (False, None) otherwise
+    """
+    if opcode == BUILD_TUPLE:
+        return True, tuple(operands)
+    function = FOLDED_OPERATIONS[opcode][1]
+    if function is operator.mul and any(isinstance(operand, (str, bytes, tuple)) for operand in operands):
+        sizes = [len(operand) if isinstance(operand, (str, bytes, tuple)) else operand for operand in operands]
+        if not isinstance(sizes[0] * sizes[1], int) or sizes[0] * sizes[1] > MAX_FOLDED_SIZE:
+            return False, None
+    try:
+        value = function(*operands)
+    except Exception:
+        return False, None  # error is raised in runtime
+    if isinstance(value, (str, bytes, tuple)) and len(value) > MAX_FOLDED_SIZE:
+        return False, None
+    if isinstance(value, int) and value.bit_length() > MAX_FOLDED_SIZE:
+        return False, None
+    return True, value
+
+
+def _operands_count(opcode: int, arg: tp.Any) -> int:
+    if opcode == BUILD_TUPLE:
+        return arg
+    return FOLDED_OPERATIONS[opcode][0] if opcode in FOLDED_OPERATIONS else -1
+
+
+def optimise(decoded: DecodedCode) -> DecodedCode:
+    """
+    Peephole optimiser of decoded instructions, passes are repeated until nothing changes:
+        constant folding: LOAD_CONST chain with unary / binary operation or BUILD_TUPLE becomes one LOAD_CONST,
+            LOAD_CONST with POP_JUMP_IF_* becomes unconditional jump or nothing;
+        jump threading: jump to unconditional jump goes to its target, jump to RETURN_VALUE becomes RETURN_VALUE;
+        removal of unreachable instructions, NOP, EXTENDED_ARG (its argument is merged already),
+            SETUP_FINALLY and POP_BLOCK (handlers are found in the block table), jumps to the next instruction
+            and sequences without effect (LOAD_CONST + POP_TOP, ROT_TWO + ROT_TWO, ...)
+    :param decoded: decoded code
+    :return: optimised copy of decoded code with number of removed instructions in `removed_instructions`
+    """
+    handlers = [handler for handler, arg in decoded.instructions]
+    args = [arg for handler, arg in decoded.instructions]
+    opcodes = list(decoded.opcodes)
+    line_starts = list(decoded.line_starts)
+
+    def set_instruction(index: int, opcode: int, arg: tp.Any = None) -> None:
+        opcodes[index] = opcode
+        args[index] = arg
+        handlers[index] = OPERATIONS[opcode] or _missing_operation(dis.opname[opcode])
+
+    changed = True
+    while changed:
+        changed = False
+        targets = {arg for arg, opcode in zip(args, opcodes) if opcode in JUMP_OPERATIONS}
+
+        for index, opcode in enumerate(opcodes):
+            count = _operands_count(opcode, args[index])
+            if count < 0 or index < count:
+                continue
+            start = index - count
+            if (any(opcodes[operand] != LOAD_CONST for operand in range(start, index)) or
+                    targets.intersection(range(start + 1, index + 1))):
+                continue
+            foldable, value = _fold(opcode, args[start:index])
+            if foldable:
+                for operand in range(start, index):
+                    set_instruction(operand, NOP)
+                set_instruction(index, LOAD_CONST, value)
+                changed = True
+
+        for index, opcode in enumerate(opcodes[:-1]):
+            following = opcodes[index + 1]
+            if index + 1 in targets:
+                continue
+            if opcode == LOAD_CONST and following in (POP_JUMP_IF_FALSE, POP_JUMP_IF_TRUE):
+                if bool(args[index]) == (following == POP_JUMP_IF_TRUE):
+                    set_instruction(index + 1, JUMP_ABSOLUTE, args[index + 1])
+                else:
+                    set_instruction(index + 1, NOP)
+                set_instruction(index, NOP)
+                changed = True
+            elif ((opcode, following) in ((LOAD_CONST, POP_TOP), (DUP_TOP, POP_TOP), (ROT_TWO, ROT_TWO))):
+                set_instruction(index, NOP)
+                set_instruction(index + 1, NOP)
+                changed = True
+
+        for index, opcode in enumerate(opcodes):
+            if opcode not in JUMP_OPERATIONS:
+                continue
+            target = args[index]
+            seen = {index}
+            while opcodes[target] in UNCONDITIONAL_JUMPS and target not in seen:
+                seen.add(target)
+                target = args[target]
+            if opcode in UNCONDITIONAL_JUMPS and opcodes[target] == RETURN_VALUE:
+                set_instruction(index, RETURN_VALUE)
+                changed = True
+            elif target != args[index]:
+                args[index] = target
+                changed = True
+
+        # instructions which can't be reached from the start
+        reachable = [False] * len(opcodes)
+        pending = [0]
+        while pending:
+            index = pending.pop()
+            while index < len(opcodes) and not reachable[index]:
+                reachable[index] = True
+                if opcodes[index] in JUMP_OPERATIONS:
+                    pending.append(args[index])
+                if opcodes[index] in NO_FALLTHROUGH:
+                    break
+                index += 1
+        for index, opcode in enumerate(opcodes):
+            if not reachable[index] and opcode != NOP:
+                set_instruction(index, NOP)
+                changed = True
+
+        # jumps to the next instruction which is not removed
+        for index, opcode in enumerate(opcodes):
+            if opcode in UNCONDITIONAL_JUMPS:
+                following = index + 1
+                while following < len(opcodes) and opcodes[following] in (NOP, EXTENDED_ARG):
+                    following += 1
+                if args[index] == following:
+                    set_instruction(index, NOP)
+                    changed = True
+
+    # remove NOPs: removed instruction is replaced by the next kept one, it also gets its source line
+    new_indices = [0] * (len(opcodes) + 1)
+    kept = 0
+    for index, opcode in enumerate(opcodes):
+        new_indices[index] = kept
+        if opcode not in REMOVED_OPERATIONS:
+            kept += 1
+    new_indices[len(opcodes)] = kept
+
+    instructions: list[Instruction] = []
+    new_opcodes: list[int] = []
+    new_line_starts: list[tp.Optional[int]] = []
+    origins: list[int] = []
+    line: tp.Optional[int] = None
+    for index, opcode in enumerate(opcodes):
+        if line_starts[index] is not None:
+            line = line_starts[index]
+        if opcode in REMOVED_OPERATIONS:
+            continue
+        arg = new_indices[args[index]] if opcode in JUMP_OPERATIONS else args[index]
+        instructions.append((handlers[index], arg))
+        new_opcodes.append(opcode)
+        new_line_starts.append(line)
+        origins.append(decoded.origins[index])
+        line = None
+    return decoded.replaced(instructions, new_opcodes, new_line_starts, origins, new_indices)
+
+
+def optimisation_report(code: types.CodeType) -> dict[str, int]:
+    """
+    :return: number of instructions removed by peephole optimiser for code and every code object nested in it
+    """
+    report = {f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})':
+              DECODE_CACHE.get(code).optimised.removed_instructions}
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            report.update(optimisation_report(const))
+    return report
+
+
+class DecodeCacheInfo(tp.NamedTuple):
+    hits: int
+    misses: int
+    size: int
+
+
+def nested_codes(code: types.CodeType) -> list[types.CodeType]:
+    """
+    :return: code object and all code objects nested in its constants, depth first
+    """
+    codes = [code]
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            codes.extend(nested_codes(const))
+    return codes
+
+
+def _const_key(const: tp.Any) -> str:
+    """
+    :return: text of constant which doesn't depend on the process (`marshal.dumps` does, as well as order of sets)
+    """
+    if isinstance(const, tuple):
+        return f'({",".join(_const_key(item) for item in const)})'
+    if isinstance(const, frozenset):
+        return f'{{{",".join(sorted(_const_key(item) for item in const))}}}'
+    return f'{type(const).__name__}:{const!r}'
+
+
+def _hash_code(code: types.CodeType, digest: tp.Any) -> None:
+    """
+    Update digest with everything decoded code depends on: bytecode, constants, names and line numbers
+    """
+    digest.update(code.co_code)
+    digest.update(code.co_lnotab)
+    digest.update(repr((code.co_names, code.co_varnames, code.co_cellvars, code.co_freevars, code.co_flags,
+                        code.co_argcount, code.co_posonlyargcount, code.co_kwonlyargcount, code.co_nlocals,
+                        code.co_firstlineno)).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(const, digest)
+        else:
+            digest.update(_const_key(const).encode())
+
+
+# Version of decoded code format: any change of this file invalidates `DiskCache`
+with open(__file__, 'rb') as _source:
+    VM_VERSION = hashlib.sha256(_source.read()).hexdigest()[:16]
+
+
+class DiskCache:
+    """
+    Persistent cache of decoded and optimised programs, like `.pyc` files for the virtual machine.
+    A program (code object with all nested ones) is saved to one file named by a hash of the code object
+    (`co_code`, `co_consts`, names, ...) and VM version, so changed code or VM just don't find their files.
+    Files are read with marshal and only code objects of the program itself may appear in loaded instructions,
+    still the directory must be writable only by users trusted to run their code, as `__pycache__` is.
+    The least recently used files are removed when there are more than `max_files`
+    """
+
+    def __init__(self, directory: str, version: str = VM_VERSION, write: bool = True, max_files: int = 1024) -> None:
+        """
+        :param directory: directory for cache files, created on first write
+        :param version: version of VM, part of the key
+        :param write: save decoded programs which are not in cache yet
+        :param max_files: max number of cached programs
+        """
+        self.directory = directory
+        self.version = version
+        self.write = write
+        self.max_files = max_files
+
+    @classmethod
+    def default(cls) -> tp.Optional['DiskCache']:
+        """
+        Cache in `VM_CACHE_DIR` with at most `VM_CACHE_SIZE` programs (1024 by default) if the directory is set,
+        programs are not cached on disk otherwise.
+        It is read-only when writing of bytecode is disabled (`PYTHONDONTWRITEBYTECODE`)
+        """
+        directory = os.environ.get('VM_CACHE_DIR')
+        if not directory:
+            return None
+        return cls(directory, write=not sys.dont_write_bytecode, max_files=int(os.environ.get('VM_CACHE_SIZE', 1024)))
+
+    def path(self, code: types.CodeType) -> str:
+        digest = hashlib.sha256(self.version.encode())
+        _hash_code(code, digest)
+        return os.path.join(self.directory, digest.hexdigest() + '.vmc')
+
+    def load(self, code: types.CodeType, codes: list[types.CodeType]) -> tp.Optional[list[DecodedCode]]:
+        """
+        :param code: code object of a program
+        :param codes: code objects of the program, see `nested_codes`
+        :return: decoded code for every code object of the program, None if program is not in cache
+        """
+        path = self.path(code)
+        try:
+            with open(path, 'rb') as file:
+                states = marshal.loads(file.read())
+            if len(states) != len(codes):
+                return None
+            program = [DecodedCode(nested, state) for nested, state in zip(codes, states)]
+        except Exception:  # missing, broken or foreign file is a miss
+            return None
+        if self.write:
+            try:
+                os.utime(path)  # the file is used recently, see `_evict`
+            except OSError:
+                pass
+        return program
+
+    def store(self, code: types.CodeType, codes: list[types.CodeType], decoded: list[DecodedCode]) -> None:
+        """
+        Save decoded program, file appears atomically, so concurrent readers never see a partial one.
+        Programs with arguments marshal can't save are not saved
+        """
+        if not self.write:
+            return
+        path = self.path(code)
+        try:
+            data = marshal.dumps([entry.state(nested) for nested, entry in zip(codes, decoded)])
+        except ValueError:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temporary = f'{path}.{os.getpid()}.tmp'
+            with open(temporary, 'wb') as file:
+                file.write(data)
+            os.replace(temporary, path)
+            self._evict()
+        except OSError:  # read-only disk or a file removed by another process
+            pass
+
+    def _evict(self) -> None:
+        """
+        Remove the least recently used files (by modification time) above `max_files`
+        """
+        with os.scandir(self.directory) as entries:
+            files = [(entry.stat().st_mtime, entry.path) for entry in entries if entry.name.endswith('.vmc')]
+        if len(files) > self.max_files:
+            files.sort()
+            for _, path in files[:len(files) - self.max_files]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:  # evicted by another process
+                    pass
+
+
+class DecodeCache:
+    """
+    Process-wide cache of decoded code objects shared by all frames and virtual machines in all threads,
+    missed code objects are decoded under `_DECODE_LOCK`.
+    Entries are keyed by identity of code objects: equal code objects (the same source compiled twice) may differ
+    in file names and line tables, so each gets its own entry. An entry is dropped by a finaliser of its code object,
+    so entries live no longer than programs they were built for.
+    With `disk` cache a missed code object is decoded (or loaded) together with code objects nested in it,
+    they wait in `_pending` until they are requested
+    """
+
+    def __init__(self, disk: tp.Optional[DiskCache] = None) -> None:
+        self._entries: dict[int, DecodedCode] = {}  # id of code object -> its decoded code
+        self._pending: dict[int, DecodedCode] = {}
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, code: types.CodeType) -> DecodedCode:
+        decoded = self._entries.get(id(code))
+        if decoded is not None:
+            self.hits += 1
+            return decoded
+        with _DECODE_LOCK:  # other thread may be decoding the same program
+            key = id(code)
+            decoded = self._entries.get(key)
+            if decoded is not None:
+                self.hits += 1
+                return decoded
+            self.misses += 1
+            decoded = self._pending.pop(key, None)
+            if decoded is None:
+                weakref.finalize(code, self._forget, key)
+                decoded = self._decode_program(code) if self.disk is not None else DecodedCode(code)
+            self._entries[key] = decoded
+            return decoded
+
+    def _forget(self, key: int) -> None:
+        """
+        Drop entry of a code object which is garbage collected, its id may be reused by another one
+        """
+        self._entries.pop(key, None)
+        self._pending.pop(key, None)
+
+    def _decode_program(self, code: types.CodeType) -> DecodedCode:
+        """
+        Load code object with nested ones from disk cache, decode and save them if they are not there
+        """
+        assert self.disk is not None
+        codes = nested_codes(code)
+        program = self.disk.load(code, codes)
+        if program is None:
+            program = [DecodedCode(nested) for nested in codes]
+            self.disk.store(code, codes, program)
+        for nested, decoded in zip(codes[1:], program[1:]):
+            key = id(nested)
+            if key not in self._entries and key not in self._pending:
+                weakref.finalize(nested, self._forget, key)
+                self._pending[key] = decoded
+        return program[0]
+
+    def info(self) -> DecodeCacheInfo:
+        return DecodeCacheInfo(self.hits, self.misses, len(self._entries))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._pending.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+DECODE_CACHE = DecodeCache(DiskCache.default())
+
+
+class Profiler:
+    """
+    Instrumentation of VirtualMachine created with `profile=True`, filled by `VirtualMachine.run_frame_profiled`.
+    Times are nanoseconds of `time.perf_counter_ns`, time of operation doesn't include frames run inside it
+    """
+
+    def __init__(self) -> None:
+        self.operations: dict[Handler, list[int]] = collections.defaultdict(lambda: [0, 0])  # [count, time]
+        self.lines: dict[tuple[str, int], int] = collections.Counter()  # (file name, line) -> hits
+        self.functions: dict[types.CodeType, list[int]] = collections.defaultdict(lambda: [0, 0])  # [calls, time]
+        self.active: dict[types.CodeType, int] = collections.Counter()  # code -> number of its running frames
+        self.stacks: dict[str, int] = collections.Counter()  # collapsed stack -> time of operations on its top
+        self.stack = ''  # collapsed stack of the current frame
+        self.nested_time = 0  # time of all frames run inside operations
+
+    def enter(self, code: types.CodeType, stack: str) -> str:
+        """
+        Register call of a frame with `code` on top of `stack`
+        :return: collapsed stack of the new frame
+        """
+        self.functions[code][0] += 1
+        self.active[code] += 1
+        return f'{stack};{code.co_name}' if stack else code.co_name
+
+    def leave(self, code: types.CodeType, elapsed: int) -> None:
+        """
+        Register exit from a frame which took `elapsed` ns, recursive calls are included into the outermost one only
+        """
+        self.active[code] -= 1
+        if not self.active[code]:
+            self.functions[code][1] += elapsed
+
+    def report(self) -> dict[str, tp.Any]:
+        """
+        :return: JSON-serializable report with operations, source lines and functions
+        """
+        operations: dict[str, dict[str, int]] = {}
+        for handler, (count, elapsed) in self.operations.items():
+            stats = operations.setdefault(operation_name(handler), {'count': 0, 'time_ns': 0})
+            stats['count'] += count
+            stats['time_ns'] += elapsed
+        return {
+            'operations': operations,
+            'lines': {f'{filename}:{line}': hits for (filename, line), hits in sorted(self.lines.items())},
+            'functions': {
+                f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})': {'calls': calls, 'time_ns': elapsed}
+                for code, (calls, elapsed) in self.functions.items()
+            },
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.report(), indent=2)
+
+    def collapsed_stacks(self) -> str:
+        """
+        :return: stacks in collapsed format of flamegraph.pl: `<module>;f;g <ns>` per line
+        """
+        return ''.join(f'{stack} {elapsed}\n' for stack, elapsed in sorted(self.stacks.items()))
+
+
+SAMPLE_CHECK_INTERVAL = 64  # checkpoints between reads of the clock by `Sampler` with `interval`
+
+
+class Sampler:
+    """
+    Sampling profiler of VirtualMachine created with `sample_every` or `sample_interval`.
+    Sampled code runs in the usual run loop, its backward jumps and entries of functions are checkpoints
+    (see `add_checkpoints`) which count down `countdown`. When it reaches zero, `checkpoint` records the stack
+    of interpreted frames if `every` checkpoints are passed and / or `interval` ns of wall time are elapsed
+    since the previous sample. Stacks of nested run loops (VM functions called by host code) are prefixed
+    with the stack of the frame which runs the host code
+    """
+
+    def __init__(self, every: tp.Optional[int] = None, interval: tp.Optional[int] = None) -> None:
+        self.every = every
+        self.interval = interval
+        self.stacks: dict[str, int] = collections.Counter()  # collapsed stack -> samples
+        self.samples = 0
+        self.passed = 0  # checkpoints passed by the run before the current countdown
+        self.period = 0  # checkpoints of the current countdown
+        self.countdown = 0  # checkpoints left to pass before the next call of `checkpoint`
+        self.next_checkpoint = 0
+        self.next_time = 0
+        self.restart()
+
+    def restart(self) -> None:
+        """
+        Start counting checkpoints and time between samples anew, for the outermost `VirtualMachine.run`
+        """
+        self.passed = 0
+        self.period = self.countdown = 1  # the first checkpoint starts the clock
+        self.next_checkpoint = self.every or 0
+        self.next_time = 0
+
+    def stack(self, frame: Frame) -> str:
+        """
+        Frames which run now in enclosing run loops are taken from `VirtualMachine.loop_frames`
+        :return: collapsed stack of frame in the innermost run loop, outermost function first
+        """
+        names = []
+        frames: list[tp.Optional[Frame]] = [frame, *frame.vm.loop_frames[-2::-1]]  # the innermost loop runs `frame`
+        for current in frames:
+            while current is not None:
+                names.append(current.code.co_name)
+                current = current.back
+        names.reverse()
+        return ';'.join(names)
+
+    def checkpoint(self, frame: Frame) -> None:
+        """
+        Countdown is over: record stack of `frame` if it is time for a sample and start the next countdown
+        :param frame: frame which runs now
+        """
+        self.passed += self.period
+        passed = self.passed
+        period = SAMPLE_CHECK_INTERVAL
+        sampled = False
+        if self.every is not None:
+            if passed >= self.next_checkpoint:
+                sampled = True
+                self.next_checkpoint = passed + self.every
+            period = self.next_checkpoint - passed
+        if self.interval is not None:
+            now = time.perf_counter_ns()
+            if now >= self.next_time:
+                sampled = sampled or bool(self.next_time)  # the first check only starts the clock
+                self.next_time = now + self.interval
+            period = min(period, SAMPLE_CHECK_INTERVAL)
+        if sampled:
+            self.stacks[self.stack(frame)] += 1
+            self.samples += 1
+        self.period = self.countdown = period
+
+    def collapsed_stacks(self) -> str:
+        """
+        :return: stacks in collapsed format of flamegraph.pl: `<module>;f;g <samples>` per line
+        """
+        return ''.join(f'{stack} {samples}\n' for stack, samples in sorted(self.stacks.items()))
+
+
+STREAM_SUPERINSTRUCTIONS = 1
+STREAM_ADAPTIVE = 2
+STREAM_OPTIMISED = 4
+STREAM_CHECKPOINTS = 8
+
+BUDGET_CHECK_INTERVAL = 1024  # dispatches between checks of execution budget, the clock is read only then
+
+
+class ExecutionBudgetExceeded(RuntimeError):
+    """
+    Raised when VirtualMachine runs out of `max_instructions` or `time_limit`.
+    Handlers of interpreted code don't catch it. It carries what was done so far:
+    number of dispatched instructions, elapsed seconds, stack of (function name, line) of interrupted frames
+    (outermost first, frames of the innermost run loop only) and report of profiler if VM was profiled
+    """
+
+    def __init__(self, message: str, instructions: int, elapsed: float,
+                 stack: list[tuple[str, tp.Optional[int]]], profile: tp.Optional[dict[str, tp.Any]]) -> None:
+        super().__init__(message)
+        self.instructions = instructions
+        self.elapsed = elapsed
+        self.stack = stack
+        self.profile = profile
+
+
+class VirtualMachine:
+    def __init__(self, superinstructions: bool = True, quickening: bool = True,
+                 count_dispatches: bool = False, profile: bool = False, optimise: bool = False,
+                 max_instructions: tp.Optional[int] = None, time_limit: tp.Optional[float] = None,
+                 stdout: tp.Optional[tp.TextIO] = None,
+                 sample_every: tp.Optional[int] = None, sample_interval: tp.Optional[float] = None) -> None:
+        """
+        Virtual machine keeps all state of its runs, so machines may run in different threads at the same time
+        (one run of a machine at a time, nested runs from host code called by interpreted code are allowed)
+
+        :param superinstructions: execute code with fused superinstructions, see `fuse`
+        :param quickening: specialise arithmetic and comparison operations for operand types, see `quicken`
+        :param count_dispatches: count executed instructions in `dispatch_count`, can't be combined with `profile`,
+                                 budget or sampling, which run other loops
+        :param profile: collect operations, lines and functions statistics in `profiler`
+        :param optimise: execute code after peephole optimiser, see `optimise`
+        :param max_instructions: budget of dispatched instructions of a `run`
+        :param time_limit: budget of wall time of a `run` in seconds, checked every `BUDGET_CHECK_INTERVAL` dispatches.
+                           Out of budget `ExecutionBudgetExceeded` is raised
+        :param stdout: stream for `print` of interpreted code instead of `sys.stdout`
+        :param sample_every: record stack of interpreted frames in `sampler` every `sample_every` checkpoints,
+                             which are backward jumps and entries of functions (not instructions),
+                             see `add_checkpoints`
+        :param sample_interval: record stack of interpreted frames in `sampler` every `sample_interval` seconds
+        :raises ValueError: if options which run different loops are combined
+        """
+        budgeted = max_instructions is not None or time_limit is not None
+        sampled = sample_every is not None or sample_interval is not None
+        if count_dispatches and (profile or budgeted or sampled):
+            raise ValueError("count_dispatches can't be combined with profile, budget or sampling")
+        self.superinstructions = superinstructions
+        self.quickening = quickening
+        self.optimise = optimise
+        self.stream_mode = ((STREAM_SUPERINSTRUCTIONS if superinstructions else 0) |
+                            (STREAM_ADAPTIVE if quickening else 0) |
+                            (STREAM_OPTIMISED if optimise else 0) |
+                            (STREAM_CHECKPOINTS if sampled else 0))
+        self.count_dispatches = count_dispatches
+        self.dispatch_count = 0
+        # decoded code -> its adaptive stream, which only this machine rewrites, so it specialises for
+        # operands of this machine's runs and `specialisations` / `deoptimisations` count only them.
+        # Keys are weak: a stream is dropped with decoded code, which `DECODE_CACHE` drops with its code object.
+        # Functions keep their stream, so calls don't look it up here
+        self.adaptive_streams: weakref.WeakKeyDictionary[DecodedCode, list[Instruction]] = weakref.WeakKeyDictionary()
+        self.specialisations = 0
+        self.deoptimisations = 0
+        self.name_deletions = 0  # part of namespace version checked by inline caches of LOAD_GLOBAL / LOAD_NAME
+        self.profiler: tp.Optional[Profiler] = Profiler() if profile else None
+        self.sampler: tp.Optional[Sampler] = None
+        if sampled:
+            self.sampler = Sampler(sample_every, None if sample_interval is None else int(sample_interval * 1e9))
+        self.exc_info: tuple[tp.Any, tp.Any, tp.Any] = (None, None, None)  # exception which is handled now
+        self.max_instructions = max_instructions
+        self.time_limit = time_limit
+        self.budgeted = budgeted
+        self.instructions_used = 0  # instructions dispatched by budgeted run, updated at budget checks
+        self.started = time.monotonic()
+        self.running = 0  # depth of nested `run` calls
+        self.loop_frames: list[Frame] = []  # frame which runs now in every active run loop, outermost first
+        self.stdout = stdout
+        self.builtins: dict[str, tp.Any] = builtins.globals()['__builtins__']
+        if stdout is not None:  # own builtins with `print` writing to the sink, `print(file=...)` still works
+            self.builtins = dict(self.builtins, print=functools.partial(builtins.print, file=stdout))
+
+    def stream(self, decoded: DecodedCode) -> list[Instruction]:
+        """
+        :return: instructions which this machine runs for decoded code: its own adaptive stream when it quickens,
+                 the stream shared by all machines with the same `stream_mode` otherwise
+        """
+        mode = self.stream_mode
+        if mode & STREAM_ADAPTIVE:
+            instructions = self.adaptive_streams.get(decoded)
+            if instructions is None:
+                instructions = self.adaptive_streams[decoded] = decoded.quickened_stream(mode)
+            return instructions
+        return decoded.streams[mode] or decoded.build_stream(mode)
+
+    def build_class(self, func: Function, name: str, *bases: tp.Any,
+                    metaclass: tp.Any = None, **kwds: tp.Any) -> tp.Any:
+        """
+        `__build_class__` for class bodies compiled to VM functions: the body runs in a frame with the class
+        namespace as locals, arguments binding of a function call is not needed
+        Realization:
+            https://github.com/python/cpython/blob/3.9/Python/bltinmodule.c#L144
+        """
+        original_bases = bases
+        bases = types.resolve_bases(bases)
+        if metaclass is None:
+            metaclass = type(bases[0]) if bases else type
+        if isinstance(metaclass, type):  # the most derived metaclass of bases
+            for base in bases:
+                base_metaclass = type(base)
+                if issubclass(metaclass, base_metaclass):
+                    continue
+                if issubclass(base_metaclass, metaclass):
+                    metaclass = base_metaclass
+                    continue
+                raise TypeError('metaclass conflict: the metaclass of a derived class must be '
+                                'a (non-strict) subclass of the metaclasses of all its bases')
+        prepare = getattr(metaclass, '__prepare__', None)
+        namespace = prepare(name, bases, **kwds) if prepare is not None else {}
+        self.run_frame(Frame(self, func.code, func.builtins, func.globals, namespace,
+                             None, func.decoded, func.caches, func.closure))
+        if bases is not original_bases:
+            namespace['__orig_bases__'] = original_bases
+        return metaclass(name, bases, namespace, **kwds)  # `type` fills `__class__` cell from `__classcell__`
+
+    def check_budget(self, frame: Frame) -> int:
+        """
+        Raise `ExecutionBudgetExceeded` if budget of instructions or time is exhausted
+        :param frame: frame which runs now
+        :return: number of instructions to dispatch before the next check
+        """
+        elapsed = time.monotonic() - self.started
+        exceeded = None
+        if self.max_instructions is not None and self.instructions_used >= self.max_instructions:
+            exceeded = f'instruction budget of {self.max_instructions} is exhausted'
+        elif self.time_limit is not None and elapsed >= self.time_limit:
+            exceeded = f'time budget of {self.time_limit} s is exhausted'
+        if exceeded is not None:
+            stack = []
+            current: tp.Optional[Frame] = frame
+            index = frame.instruction_index  # the budget is checked before the instruction is dispatched
+            while current is not None:
+                line_starts = current.decoded.stream_line_starts(self.stream_mode)
+                if current is not frame:
+                    index = current.instruction_index - 1  # calling instruction
+                while index > 0 and line_starts[index] is None:
+                    index -= 1
+                stack.append((current.code.co_name, line_starts[index] if index >= 0 else None))
+                current = current.back
+            stack.reverse()
+            profile = self.profiler.report() if self.profiler is not None else None
+            self.leave_frames(frame)
+            raise ExecutionBudgetExceeded(exceeded, self.instructions_used, elapsed, stack, profile)
+        if self.max_instructions is None:
+            return BUDGET_CHECK_INTERVAL
+        return min(BUDGET_CHECK_INTERVAL, self.max_instructions - self.instructions_used)
+
+    def leave_frames(self, frame: Frame) -> None:
+        """
+        Frame and its callers are left by exception which interpreted code can't handle (`ExecutionBudgetExceeded`):
+        running generators among them are finished, so they can be closed or collected later.
+        Frames of generators which are left already (by `check_budget` of nested run) are skipped
+        """
+        current: tp.Optional[Frame] = frame
+        while current is not None:
+            back = current.back
+            generator = current.generator
+            if generator is not None and generator.running:
+                generator.leave()
+            current = back
+
+    def handle_exception(self, frame: Frame, exc: BaseException) -> tp.Optional[Frame]:
+        """
+        Unwind blocks around the instruction before `instruction_index` of frame and of its callers
+        (blocks are looked up in exception table) until a handler of SETUP_FINALLY / SETUP_WITH block is found.
+        Handler gets previous exception and the raised one on the stack, like in CPython:
+            https://github.com/python/cpython/blob/3.9/Python/ceval.c#L3932
+        :return: frame to continue at the handler, None if frames have no handler and exception is to be reraised
+        """
+        if type(exc) is ExecutionBudgetExceeded:
+            self.leave_frames(frame)
+            return None
+        handled = self.exc_info[1]
+        if handled is not None and handled is not exc and exc.__context__ is None:
+            exc.__context__ = handled
+        raised = exc
+        current: tp.Optional[Frame] = frame
+        while current is not None:
+            frame = current
+            table = frame.decoded.exception_table(self.stream_mode)
+            if table is not None:
+                stack = frame.data_stack
+                for handler, level in reversed(table[frame.instruction_index - 1]):
+                    if handler == EXCEPT_HANDLER:
+                        self.exc_info = (stack[level + 2], stack[level + 1], stack[level])
+                        del stack[level:]
+                        continue
+                    del stack[level:]
+                    exc_type, value, traceback = self.exc_info
+                    stack.extend((traceback, value, exc_type, exc.__traceback__, exc, type(exc)))
+                    self.exc_info = (type(exc), exc, exc.__traceback__)
+                    frame.instruction_index = handler
+                    return frame
+            back = frame.back
+            if frame.generator is not None:
+                frame.generator.leave()  # exception finishes generator and goes to the frame which resumed it
+                if isinstance(exc, StopIteration):  # PEP 479
+                    kind = 'coroutine' if isinstance(frame.generator, Coroutine) else 'generator'
+                    error = RuntimeError(f'{kind} raised StopIteration')
+                    error.__cause__ = error.__context__ = exc
+                    error.__suppress_context__ = True
+                    exc = error
+            current = back
+        if exc is not raised:
+            raise exc
+        return None
+
+    def leave_generator(self, frame: Frame) -> tp.Optional[Frame]:
+        """
+        Generator frame yielded or returned: deliver the value to the frame which resumed it.
+        Value yielded to YIELD_FROM of delegating generator is yielded by that generator too,
+        so a chain of delegating generators is left at once
+        :return: frame to continue, None if generator was resumed by host code (it takes the value from generator)
+        """
+        while True:
+            generator: Generator = frame.generator  # type: ignore
+            back = frame.back
+            generator.leave()
+            if back is None:
+                return None
+            if generator.resumer == RESUMED_BY_FOR_ITER:
+                if generator.suspended:
+                    back.data_stack.append(frame.return_value)
+                else:
+                    back.data_stack.pop()
+                    back.instruction_index = generator.target
+                return back
+            if not generator.suspended:
+                back.data_stack[-1] = frame.return_value
+                return back
+            back.instruction_index -= 1  # YIELD_FROM is repeated when delegating generator is resumed
+            back.return_value = frame.return_value
+            back.generator.suspended = True  # type: ignore
+            frame = back
+
+    def next_frame(self, frame: Frame) -> tp.Optional[Frame]:
+        """
+        Epilogue shared by run loops: handler of frame returned True, so switch to the function it called,
+        to the calling frame (return value is pushed to it) or to the frame which resumed the generator
+        :return: frame to continue, None if the frame the loop started with is left
+        """
+        callee = frame.callee
+        if callee is not None:
+            frame.callee = None
+            callee.back = frame
+            return callee
+        if frame.generator is not None:
+            return self.leave_generator(frame)
+        back = frame.back
+        if back is not None:
+            back.data_stack.append(frame.return_value)
+        return back
+
+    def run_frame(self, frame: Frame) -> tp.Any:
+        """
+        Execute frame and frames of VM functions called from it in a single loop over explicit frame stack
+        (linked by `Frame.back`), so calls in interpreted code don't nest host calls.
+        Handler returns True to leave current frame: it either called a function (`callee` is set) or returned.
+        Every loop keeps its current frame in `loop_frames`, so a loop started by host code knows the frames
+        of enclosing loops, see `Sampler.stack`
+        :return: return value of the frame
+        """
+        loop_frames = self.loop_frames
+        loop_frames.append(frame)
+        try:
+            if self.profiler is not None:
+                return self.run_frame_profiled(frame, self.profiler)
+            if self.budgeted:
+                return self.run_frame_budgeted(frame)
+            if self.count_dispatches:
+                return self.run_frame_counting(frame)
+            while True:
+                instructions = frame.instructions
+                try:
+                    while True:
+                        handler, arg = instructions[frame.instruction_index]
+                        frame.instruction_index += 1
+                        if handler(frame, arg):
+                            break
+                except BaseException as exc:
+                    handler_frame = self.handle_exception(frame, exc)
+                    if handler_frame is None:
+                        raise
+                    frame = loop_frames[-1] = handler_frame
+                    continue
+                back = self.next_frame(frame)
+                if back is None:
+                    return frame.return_value
+                frame = loop_frames[-1] = back
+        finally:
+            loop_frames.pop()
+
+    def run_frame_counting(self, frame: Frame) -> tp.Any:
+        """
+        Same as `run_frame`, but counts dispatched instructions in `dispatch_count`
+        """
+        loop_frames = self.loop_frames  # see `run_frame`
+        dispatched = 0
+        try:
+            while True:
+                instructions = frame.instructions
+                try:
+                    while True:
+                        handler, arg = instructions[frame.instruction_index]
+                        frame.instruction_index += 1
+                        dispatched += 1
+                        if handler(frame, arg):
+                            break
+                except BaseException as exc:
+                    handler_frame = self.handle_exception(frame, exc)
+                    if handler_frame is None:
+                        raise
+                    frame = loop_frames[-1] = handler_frame
+                    continue
+                back = self.next_frame(frame)
+                if back is None:
+                    return frame.return_value
+                frame = loop_frames[-1] = back
+        finally:
+            self.dispatch_count += dispatched
+
+    def run_frame_budgeted(self, frame: Frame) -> tp.Any:
+        """
+        Same as `run_frame`, but the budget is checked before every `BUDGET_CHECK_INTERVAL`-th dispatch
+        (and before the one over `max_instructions`), so only a countdown is paid per instruction
+        """
+        loop_frames = self.loop_frames  # see `run_frame`
+        period = self.check_budget(frame)  # instructions between checks
+        ticks = iter(range(period, 0, -1))  # shared by all frames, so frame switches don't restart the countdown
+        left = period + 1  # instructions of the period which are not dispatched yet, plus one
+        try:
+            while True:
+                instructions = frame.instructions
+                try:
+                    while True:
+                        for left in ticks:  # cheaper than a countdown by hand
+                            handler, arg = instructions[frame.instruction_index]
+                            frame.instruction_index += 1
+                            if handler(frame, arg):
+                                break
+                        else:  # the period is over
+                            self.instructions_used += period
+                            period, left = 0, 1  # already counted if the budget is exhausted
+                            period = self.check_budget(frame)
+                            ticks = iter(range(period, 0, -1))
+                            left = period + 1
+                            continue
+                        break
+                except BaseException as exc:
+                    handler_frame = self.handle_exception(frame, exc)
+                    if handler_frame is None:
+                        raise
+                    frame = loop_frames[-1] = handler_frame
+                    continue
+                back = self.next_frame(frame)
+                if back is None:
+                    return frame.return_value
+                frame = loop_frames[-1] = back
+        finally:
+            self.instructions_used += period - left + 1
+
+    def run_frame_profiled(self, frame: Frame, profiler: Profiler) -> tp.Any:
+        """
+        Same as `run_frame`, but every operation is timed and recorded in `profiler`,
+        budget is checked like in `run_frame_budgeted`
+        """
+        loop_frames = self.loop_frames  # see `run_frame`
+        clock = time.perf_counter_ns
+        operations = profiler.operations
+        lines = profiler.lines
+        stacks = profiler.stacks
+        checked = self.budgeted
+        period = countdown = self.check_budget(frame) if checked else -1  # never reaches 0 without checks
+        started = clock()
+        stack = profiler.enter(frame.code, profiler.stack)
+        # (frame, its stack, stack of calling frame, start time) for frames run by this loop
+        entered = [(frame, stack, profiler.stack, started)]
+        try:
+            while True:
+                profiler.stack = stack
+                instructions = frame.instructions
+                line_starts = frame.decoded.stream_line_starts(self.stream_mode)
+                filename = frame.code.co_filename
+                try:
+                    while True:
+                        if not countdown:
+                            self.instructions_used += period
+                            period = 0  # already counted if the budget is exhausted
+                            period = countdown = self.check_budget(frame)
+                        countdown -= 1
+                        index = frame.instruction_index
+                        handler, arg = instructions[index]
+                        line = line_starts[index]
+                        if line is not None:
+                            lines[filename, line] += 1
+                        frame.instruction_index = index + 1
+                        nested_time = profiler.nested_time
+                        start = clock()
+                        stop = handler(frame, arg)
+                        elapsed = clock() - start - (profiler.nested_time - nested_time)
+                        stats = operations[handler]
+                        stats[0] += 1
+                        stats[1] += elapsed
+                        stacks[stack] += elapsed
+                        if stop:
+                            break
+                except BaseException as exc:
+                    handler_frame = self.handle_exception(frame, exc)
+                    if handler_frame is None:
+                        raise
+                    while entered[-1][0] is not handler_frame:
+                        left, _, _, start = entered.pop()
+                        profiler.leave(left.code, clock() - start)
+                    frame = loop_frames[-1] = handler_frame
+                    stack = entered[-1][1]
+                    continue
+                callee = frame.callee
+                back = self.next_frame(frame)
+                if back is None:
+                    return frame.return_value
+                if back is callee:
+                    callee_stack = profiler.enter(callee.code, stack)
+                    entered.append((callee, callee_stack, stack, clock()))
+                    stack = callee_stack
+                else:
+                    while entered[-1][0] is not back:
+                        left, _, stack, start = entered.pop()
+                        profiler.leave(left.code, clock() - start)
+                frame = loop_frames[-1] = back
+        finally:
+            if checked:
+                self.instructions_used += period - countdown
+            finished = clock()
+            while entered:
+                left, _, stack, start = entered.pop()
+                profiler.leave(left.code, finished - start)
+            profiler.stack = stack
+            profiler.nested_time += finished - started
 
-class VirtualMachine:
     def run(self, code_obj: types.CodeType) -> None:
         """
         :param code_obj: code for interpreting
         """
         globals_context: dict[str, tp.Any] = {}
-        frame = Frame(code_obj, builtins.globals()['__builtins__'], globals_context, globals_context)
-        return frame.run()
+        frame = Frame(self, code_obj, self.builtins, globals_context, globals_context)
+        if not self.running:  # budget and sampling are shared with nested runs
+            self.instructions_used = 0
+            self.started = time.monotonic()
+            if self.sampler is not None:
+                self.sampler.restart()
+        exc_info = self.exc_info
+        self.exc_info = (None, None, None)
+        self.running += 1
+        try:
+            return self.run_frame(frame)
+        finally:
+            self.running -= 1
+            self.exc_info = exc_info
@@ -0,0 +1,252 @@
+"""
+Benchmark of VirtualMachine against CPython over all test cases from `cases.py`.
+Every case is run many times by `VirtualMachine().run` and by `eval`, for every case
+slowdown of the VM, nanoseconds per dispatched instruction and tracemalloc peak of the VM run are reported.
+Cases which slowdown grew more than threshold since JSON baseline are reported as regressions and the exit
+status is 1 (slowdown is compared, not time, as it depends less on the machine and its load).
+Results are saved as the new baseline only with `--update-baseline`, so a regression is reported until it is fixed
+or accepted explicitly.
+With `--modes` every case is run plain, with superinstructions and with superinstructions and quickening,
+time and number of dispatched instructions are reported, as well as decoding time without disk cache
+and with a warm one, see `vm.DiskCache`.
+With `--sampling` cases are run with and without sampling profiler (`sample_every` option), see `vm.Sampler`.
+Usage:
+    $ python vm_benchmark.py [--baseline vm_benchmark.json] [--threshold 0.25] [--repeats 10] [--update-baseline]
+    $ python vm_benchmark.py --modes
+    $ python vm_benchmark.py --sampling
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import typing as tp
+
+import cases
+import vm
+import vm_runner
+
+N_REPEATS = 10
+DEFAULT_THRESHOLD = 0.25  # relative growth of slowdown which is a regression
+MIN_COMPARED_US = 100.  # shorter VM runs are too noisy to be compared with baseline
+SAMPLE_EVERY = 100  # checkpoints (loop iterations and calls) between samples of `--sampling`
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vm_benchmark.json')
+
+
+def run_silently(machine: vm.VirtualMachine, code: types.CodeType) -> None:
+    """
+    Run code in virtual machine with captured output, errors of interpreted code are ignored
+    """
+    with vm_runner.redirected(out=io.StringIO(), err=io.StringIO()):
+        try:
+            machine.run(code)
+        except Exception:
+            pass
+
+
+def measure(code: types.CodeType, repeats: int = N_REPEATS, **options: tp.Any) -> float:
+    """
+    Run code in virtual machine several times
+    :param code: code to run
+    :param repeats: number of runs
+    :param options: options of virtual machine
+    :return: best wall time of single run in seconds
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        machine = vm.VirtualMachine(**options)
+        start = time.perf_counter()
+        run_silently(machine, code)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def count_dispatches(code: types.CodeType, **options: tp.Any) -> int:
+    """
+    :return: number of instructions dispatched while running code
+    """
+    machine = vm.VirtualMachine(count_dispatches=True, **options)
+    run_silently(machine, code)
+    return machine.dispatch_count
+
+
+def measure_memory(code: types.CodeType, **options: tp.Any) -> int:
+    """
+    :return: peak of memory traced by tracemalloc while running code, bytes
+    """
+    machine = vm.VirtualMachine(**options)
+    tracemalloc.start()
+    try:
+        run_silently(machine, code)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def measure_startup(codes: list[types.CodeType], disk: tp.Optional[vm.DiskCache]) -> float:
+    """
+    :return: wall time of decoding and optimising all code objects by a new decode cache, seconds
+    """
+    cache = vm.DecodeCache(disk)
+    start = time.perf_counter()
+    for code in codes:
+        for nested in vm.nested_codes(code):
+            cache.get(nested).optimised
+    return time.perf_counter() - start
+
+
+def measure_python(code: types.CodeType, repeats: int = N_REPEATS) -> float:
+    """
+    Run code by CPython (`eval`) several times, every run gets new globals
+    :return: best wall time of single run in seconds
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        globals_context: dict[str, tp.Any] = {}
+        start = time.perf_counter()
+        with vm_runner.redirected(out=io.StringIO(), err=io.StringIO()):
+            try:
+                eval(code, globals_context, globals_context)
+            except Exception:
+                pass
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_case(case: cases.Case, repeats: int = N_REPEATS) -> dict[str, float]:
+    """
+    :return: times of VM and CPython runs, slowdown, number of dispatched instructions,
+             time per instruction and tracemalloc peak of VM run
+    """
+    code = vm_runner.compile_code(case.text_code)
+    vm_time = measure(code, repeats)
+    python_time = measure_python(code, repeats)
+    instructions = count_dispatches(code)
+    return {
+        'vm_us': vm_time * 1e6,
+        'python_us': python_time * 1e6,
+        'slowdown': vm_time / python_time,
+        'instructions': instructions,
+        'ns_per_instruction': vm_time * 1e9 / instructions if instructions else 0.,
+        'peak_kib': measure_memory(code) / 1024,
+    }
+
+
+def find_regressions(previous: dict[str, dict[str, float]], current: dict[str, dict[str, float]],
+                     threshold: float = DEFAULT_THRESHOLD) -> list[tuple[str, float, float]]:
+    """
+    :param previous: baseline results by case name
+    :param current: new results by case name
+    :param threshold: relative growth of slowdown which is a regression, e.g. 0.25 for 25%
+    :return: (case name, previous slowdown, current slowdown) for regressed cases
+             which VM runs are not shorter than `MIN_COMPARED_US`
+    """
+    regressions = []
+    for name, result in current.items():
+        old = previous.get(name)
+        if old is None or min(old['vm_us'], result['vm_us']) < MIN_COMPARED_US:
+            continue
+        if result['slowdown'] > old['slowdown'] * (1 + threshold):
+            regressions.append((name, old['slowdown'], result['slowdown']))
+    return regressions
+
+
+def print_modes() -> None:
+    """
+    Compare execution modes of VM on all cases
+    """
+    totals = [0., 0., 0., 0, 0]
+    print(f"{'case':<50}{'plain, us':>12}{'fused, us':>12}{'quick, us':>12}{'plain ops':>12}{'fused ops':>12}")
+    for case in cases.TEST_CASES:
+        code = vm_runner.compile_code(case.text_code)
+        row = [
+            measure(code, superinstructions=False, quickening=False) * 1e6,
+            measure(code, superinstructions=True, quickening=False) * 1e6,
+            measure(code, superinstructions=True, quickening=True) * 1e6,
+            count_dispatches(code, superinstructions=False),
+            count_dispatches(code, superinstructions=True),
+        ]
+        totals = [total + value for total, value in zip(totals, row)]
+        print(f"{case.name:<50}{row[0]:>12.1f}{row[1]:>12.1f}{row[2]:>12.1f}{row[3]:>12}{row[4]:>12}")
+    print(f"{'Total':<50}{totals[0]:>12.1f}{totals[1]:>12.1f}{totals[2]:>12.1f}{totals[3]:>12}{totals[4]:>12}")
+
+    peaks = {case.name: measure_memory(vm_runner.compile_code(case.text_code)) for case in cases.TEST_CASES}
+    largest = max(peaks, key=peaks.__getitem__)
+    print(f"tracemalloc peaks: {sum(peaks.values()) / 1024:.1f} KiB over all cases, "
+          f"{peaks[largest] / 1024:.1f} KiB max ({largest})")
+
+    codes = [vm_runner.compile_code(case.text_code) for case in cases.TEST_CASES]
+    with tempfile.TemporaryDirectory() as directory:
+        disk = vm.DiskCache(directory)
+        measure_startup(codes, disk)  # fills the cache
+        print(f"startup: {measure_startup(codes, None) * 1e3:.1f} ms decoding, "
+              f"{measure_startup(codes, disk) * 1e3:.1f} ms with warm disk cache")
+
+
+def print_sampling(repeats: int = N_REPEATS, every: int = SAMPLE_EVERY) -> None:
+    """
+    Compare runs of cases with and without sampling profiler of VM
+    """
+    totals = [0., 0.]
+    print(f"{'case':<50}{'plain, us':>12}{'sampled, us':>13}{'overhead':>10}")
+    for case in cases.TEST_CASES:
+        code = vm_runner.compile_code(case.text_code)
+        row = [measure(code, repeats) * 1e6, measure(code, repeats, sample_every=every) * 1e6]
+        totals = [total + value for total, value in zip(totals, row)]
+        print(f"{case.name:<50}{row[0]:>12.1f}{row[1]:>13.1f}{row[1] / row[0] - 1:>10.1%}")
+    print(f"{'Total':<50}{totals[0]:>12.1f}{totals[1]:>13.1f}{totals[1] / totals[0] - 1:>10.1%}")
+
+
+def main(argv: tp.Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark VirtualMachine against CPython over cases.py')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='JSON file with results of previous run')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative growth of slowdown reported as regression')
+    parser.add_argument('--repeats', type=int, default=N_REPEATS, help='runs of every case, the best one counts')
+    parser.add_argument('--update-baseline', action='store_true', help='save new results as baseline')
+    parser.add_argument('--modes', action='store_true', help='compare execution modes of VM instead')
+    parser.add_argument('--sampling', action='store_true', help='compare runs with and without sampling instead')
+    args = parser.parse_args(argv)
+    if args.modes:
+        print_modes()
+        return 0
+    if args.sampling:
+        print_sampling(args.repeats)
+        return 0
+
+    previous: dict[str, dict[str, float]] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            previous = json.load(file)['cases']
+
+    current: dict[str, dict[str, float]] = {}
+    print(f"{'case':<50}{'vm, us':>12}{'python, us':>12}{'slowdown':>10}{'ns/instr':>10}{'peak, KiB':>11}")
+    for case in cases.TEST_CASES:
+        result = current[case.name] = benchmark_case(case, args.repeats)
+        print(f"{case.name:<50}{result['vm_us']:>12.1f}{result['python_us']:>12.1f}{result['slowdown']:>10.1f}"
+              f"{result['ns_per_instruction']:>10.0f}{result['peak_kib']:>11.1f}")
+    slowdowns = sorted(result['slowdown'] for result in current.values())
+    print(f"median slowdown {slowdowns[len(slowdowns) // 2]:.1f}, "
+          f"total {sum(r['vm_us'] for r in current.values()) / sum(r['python_us'] for r in current.values()):.1f}")
+
+    regressions = find_regressions(previous, current, args.threshold)
+    for name, old, new in regressions:
+        print(f"REGRESSION {name}: slowdown {old:.1f} -> {new:.1f}")
+    if previous:
+        print(f"{len(regressions)} regressions over {args.threshold:.0%} against {args.baseline}")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump({'python': sys.version.split()[0], 'repeats': args.repeats, 'cases': current}, file, indent=1)
+    elif not previous:
+        print(f"no baseline in {args.baseline}, save one with --update-baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,8 @@
+import concurrent.futures
 import io
+import os
 import sys
+import time
 import traceback
 import types
 import typing as tp
@@ -93,3 +96,120 @@ def execute(code: types.CodeType,
     out = stdout.getvalue()
     err = stderr.getvalue()
     return out, err, exc_type
+
+
+def execute_isolated(code: types.CodeType,
+                     machine_factory: tp.Callable[..., tp.Any]) -> tuple[str, str, tp.Optional[type[BaseException]]]:
+    """
+    Capture output of virtual machine run like `execute`, but without swapping `sys.stdout` / `sys.stderr`:
+    the machine prints to its own stream, so runs in different threads don't mix their outputs
+    :param code: code object to run
+    :param machine_factory: callable creating virtual machine with `stdout` stream, e.g. `vm.VirtualMachine`
+    :return: output, traceback of exception and its type
+    """
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    exc_type = None
+    try:
+        machine_factory(stdout=stdout).run(code)
+    except Exception as exc:
+        exc_type = type(exc)
+        traceback.print_exception(exc_type, exc, exc.__traceback__, file=stderr)
+    return stdout.getvalue(), stderr.getvalue(), exc_type
+
+
+def run_threaded(codes: tp.Iterable[tp.Union[types.CodeType, str]], machine_factory: tp.Callable[..., tp.Any],
+                 threads: tp.Optional[int] = None) -> list[tuple[str, str, tp.Optional[type[BaseException]]]]:
+    """
+    Run programs by virtual machines in a pool of threads of this process, see `execute_isolated`.
+    Unlike `run_cases` nothing is pickled and decoded code is shared, but the GIL runs one thread at a time
+    :param codes: programs, source or compiled
+    :param machine_factory: callable creating virtual machine with `stdout` stream, e.g. `vm.VirtualMachine`
+    :param threads: number of threads, number of CPUs by default
+    :return: results of `execute_isolated` in order of programs
+    """
+    compiled = [compile_code(code) for code in codes]
+    with concurrent.futures.ThreadPoolExecutor(threads or os.cpu_count()) as executor:
+        return list(executor.map(lambda code: execute_isolated(code, machine_factory), compiled))
+
+
+class CaseResult(tp.NamedTuple):
+    """
+    Comparison of a test case run by virtual machine and by CPython, see `run_case`.
+    Exceptions are kept as type names, so results of worker processes can be sent to the parent
+    """
+    name: str
+    passed: bool
+    vm_out: str
+    vm_err: str
+    vm_exc: tp.Optional[str]
+    py_out: str
+    py_exc: tp.Optional[str]
+    vm_time: float  # wall time of virtual machine run, seconds
+    py_time: float  # wall time of CPython run, seconds
+
+
+def _type_name(exc_type: tp.Optional[type[BaseException]]) -> tp.Optional[str]:
+    return None if exc_type is None else exc_type.__qualname__
+
+
+def run_case(name: str, text_code: str, machine_factory: tp.Callable[[], tp.Any]) -> CaseResult:
+    """
+    Run test case by virtual machine and by CPython and compare them like `test_public.py` does
+    :param name: name of the case
+    :param text_code: source of the case
+    :param machine_factory: callable creating virtual machine, e.g. `vm.VirtualMachine`
+    :return: comparison record
+    """
+    code = compile_code(text_code)
+    tracebacks = io.StringIO()  # `execute` prints traceback of exception outside of its capture
+    with redirected(out=sys.stdout, err=tracebacks):
+        start = time.perf_counter()
+        vm_out, vm_err, vm_exc = execute(code, machine_factory().run)
+        vm_time = time.perf_counter() - start
+        vm_err += tracebacks.getvalue()
+
+        globals_context: dict[str, tp.Any] = {}
+        start = time.perf_counter()
+        py_out, py_err, py_exc = execute(code, eval, globals_context, globals_context)
+        py_time = time.perf_counter() - start
+
+    passed = vm_out == py_out and vm_exc == py_exc
+    return CaseResult(name, passed, vm_out, vm_err, _type_name(vm_exc), py_out, _type_name(py_exc), vm_time, py_time)
+
+
+def run_cases(cases: tp.Iterable[tp.Any], machine_factory: tp.Callable[[], tp.Any],
+              processes: tp.Optional[int] = None) -> list[CaseResult]:
+    """
+    Run test cases in a pool of processes: `sys.stdout` / `sys.stderr` are swapped by every worker for its own case,
+    so cases don't share output streams (and interpreter state) with each other and with the caller
+    :param cases: test cases with `name` and `text_code` (see `cases.Case`)
+    :param machine_factory: picklable callable creating virtual machine, e.g. `functools.partial(vm.VirtualMachine)`
+    :param processes: number of worker processes, number of CPUs by default, 1 runs cases in this process
+    :return: comparison records in order of cases
+    """
+    items = [(case.name, case.text_code) for case in cases]
+    processes = processes or os.cpu_count() or 1
+    if processes == 1:
+        return [run_case(name, text_code, machine_factory) for name, text_code in items]
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        futures = [executor.submit(run_case, name, text_code, machine_factory) for name, text_code in items]
+        return [future.result() for future in futures]
+
+
+if __name__ == "__main__":
+    # Usage: $ python vm_runner.py [processes]
+    import cases as test_cases
+    import vm
+
+    started = time.perf_counter()
+    results = run_cases(test_cases.TEST_CASES, vm.VirtualMachine, int(sys.argv[1]) if len(sys.argv) > 1 else None)
+    elapsed = time.perf_counter() - started
+
+    print(f"{'case':<50}{'result':>8}{'vm, ms':>12}{'python, ms':>12}")
+    for result in results:
+        print(f"{result.name:<50}{'ok' if result.passed else 'FAIL':>8}"
+              f"{result.vm_time * 1e3:>12.2f}{result.py_time * 1e3:>12.2f}")
+    busy = sum(result.vm_time + result.py_time for result in results)
+    print(f"passed {sum(result.passed for result in results)} of {len(results)}, "
+          f"wall time {elapsed:.2f} s, time of cases {busy:.2f} s")
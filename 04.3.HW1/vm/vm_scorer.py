@@ -1,4 +1,5 @@
 import dis
+import hashlib
 import json
 import types
 import typing as tp
@@ -147,12 +148,26 @@ def generate_stub_operations() -> None:
 
 
 class StatData:
-    def __init__(self, code: str, operations: dict[str, int]):
+    def __init__(self, code: str, operations: dict[str, int], level: int):
         self.code = code
         self.operations = operations
+        self.level = level
+
+
+# Operations of test code by hash of its text, shared by all scorers: text is compiled only once
+_OPERATIONS_CACHE: dict[str, dict[str, int]] = {}
+
+
+def _source_hash(text_code: str) -> str:
+    return hashlib.sha1(text_code.encode()).hexdigest()
 
 
 class Scorer:
+    """
+    Scores of tests by their levels. Number of tests of every level and total operations statistics
+    are updated when a test is added, so scoring a test doesn't rescan the tests
+    """
+
     def __init__(
             self,
             tests: list[str],
@@ -161,11 +176,22 @@ class Scorer:
     ):
         self._level_scores = level_scores
         self._operations_levels = operations_levels
-        self._stat = [self._collect(test) for test in tests]
+        self._stat: list[StatData] = []
+        self._level_stats = {level: 0 for level in self._level_scores}
+        self._total_stats = {key: 0 for key in self._operations_levels}
+        for test in tests:
+            self.add_test(test)
+
+    def add_test(self, text_code: str) -> None:
+        stat = self._collect(text_code)
+        self._stat.append(stat)
+        self._level_stats[stat.level] += 1
+        for key, value in stat.operations.items():
+            self._total_stats[key] += value
 
     def _collect(self, text_code: str) -> StatData:
         operations = self.get_operations(text_code)
-        return StatData(text_code, operations)
+        return StatData(text_code, operations, self.get_test_level(operations))
 
     def get_level_operations_count(self) -> tp.Counter[int]:
         return Counter(self._operations_levels.values())
@@ -174,34 +200,21 @@ class Scorer:
         return len(self._operations_levels)
 
     def get_total_stats(self) -> dict[str, int]:
-        total_stat = {key: 0 for key in self._operations_levels}
-
-        for stat in self._stat:
-            for key, value in stat.operations.items():
-                total_stat[key] += value
-
-        return total_stat
+        return dict(self._total_stats)
 
     def get_levels_stats(self) -> dict[int, int]:
-        level_stats = {level: 0 for level in self._level_scores}
-
-        for stat in self._stat:
-            level = self.get_test_level(stat.operations)
-            level_stats[level] += 1
-
-        return level_stats
+        return dict(self._level_stats)
 
     def get_levels_coverage(self) -> dict[int, int]:
-        total_stats = self.get_total_stats()
         level_stats = {level: 0 for level in self._level_scores}
 
         for operation, level in self._operations_levels.items():
-            if total_stats[operation] > 0:
+            if self._total_stats[operation] > 0:
                 level_stats[level] += 1
         return level_stats
 
     def get_operations_coverage(self) -> int:
-        return sum(int(operations_count > 0) for operations_count in self.get_total_stats().values())
+        return sum(int(operations_count > 0) for operations_count in self._total_stats.values())
 
     def get_test_level(self, operations: dict[str, int]) -> int:
         level = 1
@@ -225,8 +238,15 @@ class Scorer:
         return operations
 
     def get_operations(self, text_code: str) -> dict[str, int]:
-        code = compile(text_code, '<stdin>', 'exec')
-        return self._extract_operations(code)
+        """
+        :return: number of every operation in text code, it is cached by hash of the text and must not be changed
+        """
+        key = _source_hash(text_code)
+        operations = _OPERATIONS_CACHE.get(key)
+        if operations is None:
+            code = compile(text_code, '<stdin>', 'exec')
+            operations = _OPERATIONS_CACHE[key] = dict(self._extract_operations(code))
+        return operations
 
     def score(self, text_code: str) -> float:
         """
@@ -234,14 +254,11 @@ class Scorer:
         :param text_code: text code to identify personal score
         :return: score for text code
         """
-        operations = self.get_operations(text_code)
-        total_stats = self.get_levels_stats()
-
-        level = self.get_test_level(operations)
-        return self._level_scores[level] / total_stats[level]
+        level = self.get_test_level(self.get_operations(text_code))
+        return self._level_scores[level] / self._level_stats[level]
 
     def total_score(self) -> float:
-        return sum(self.score(stat.code) for stat in self._stat)
+        return sum(self._level_scores[stat.level] / self._level_stats[stat.level] for stat in self._stat)
 
 
 def dump_tests_stat(stream: tp.TextIO, scorer: Scorer) -> None:
@@ -0,0 +1,143 @@
+import random
+import typing
+
+import numpy as np
+import numpy.typing as npt
+
+from .banner_engine import Banner, BannerStat, NoBannerError
+
+
+class ArrayBannerStorage:
+    """
+    Banner storage for millions of banners with the interface of `BannerStorage`.
+    Costs, clicks and shows are kept in NumPy arrays indexed by position of banner, along with CPC of every banner
+    which is updated on every show and click, so banner with highest CPC is found by a single argmax
+    """
+    def __init__(self, banners: typing.Iterable[Banner], default_ctr: float = 0.1):
+        banners = list(banners)
+        self._init_arrays(
+            [b.banner_id for b in banners],
+            np.array([b.cost for b in banners], dtype=np.int64),
+            np.array([b.stat.clicks for b in banners], dtype=np.int64),
+            np.array([b.stat.shows for b in banners], dtype=np.int64),
+            default_ctr,
+        )
+
+    @classmethod
+    def from_arrays(cls, banner_ids: typing.Sequence[str], costs: npt.ArrayLike,
+                    clicks: typing.Optional[npt.ArrayLike] = None, shows: typing.Optional[npt.ArrayLike] = None,
+                    default_ctr: float = 0.1) -> "ArrayBannerStorage":
+        """
+        Create storage without `Banner` objects
+        :param banner_ids: unique ids of banners
+        :param costs: costs of banners, array-like of the same length
+        :param clicks: clicks of banners, zeros by default
+        :param shows: shows of banners, zeros by default
+        """
+        storage = cls.__new__(cls)
+        n = len(banner_ids)
+        storage._init_arrays(
+            list(banner_ids),
+            np.array(costs, dtype=np.int64),
+            np.zeros(n, dtype=np.int64) if clicks is None else np.array(clicks, dtype=np.int64),
+            np.zeros(n, dtype=np.int64) if shows is None else np.array(shows, dtype=np.int64),
+            default_ctr,
+        )
+        return storage
+
+    def _init_arrays(self, banner_ids: typing.List[str], costs: npt.NDArray[np.int64], clicks: npt.NDArray[np.int64],
+                     shows: npt.NDArray[np.int64], default_ctr: float) -> None:
+        if not len(banner_ids) == len(costs) == len(clicks) == len(shows):
+            raise ValueError("Banner ids, costs, clicks and shows must have the same length!")
+        self._banner_ids = banner_ids
+        self._index = {banner_id: i for i, banner_id in enumerate(banner_ids)}
+        if len(self._index) != len(banner_ids):
+            raise ValueError("Banner ids must be unique!")
+        self._costs = costs
+        self._clicks = clicks
+        self._shows = shows
+        self._default_ctr = default_ctr
+        self._cpc = np.empty(len(banner_ids), dtype=np.float64)
+        self._update_cpc(slice(None))
+
+    def _update_cpc(self, indices: typing.Any) -> None:
+        """
+        Recompute CPC (cost * CTR) of banners at `indices`, CTR of banner without shows is `default_ctr`
+        """
+        shows = self._shows[indices]
+        ctr = np.full(shows.shape, self._default_ctr)
+        np.divide(self._clicks[indices], shows, out=ctr, where=shows != 0)
+        self._cpc[indices] = ctr * self._costs[indices]
+
+    def _update_banner_cpc(self, i: int) -> None:
+        shows = int(self._shows[i])
+        ctr = int(self._clicks[i]) / shows if shows != 0 else self._default_ctr
+        self._cpc[i] = ctr * int(self._costs[i])
+
+    def _position(self, banner_id: str) -> int:
+        try:
+            return self._index[banner_id]
+        except KeyError:
+            raise NoBannerError("Unknown banner {}!".format(banner_id)) from None
+
+    def _positions(self, banner_ids: typing.Iterable[str]) -> npt.NDArray[np.intp]:
+        return np.fromiter((self._position(banner_id) for banner_id in banner_ids), dtype=np.intp)
+
+    def is_empty(self) -> bool:
+        return len(self._banner_ids) == 0
+
+    def add_click(self, banner_id: str) -> None:
+        i = self._position(banner_id)
+        self._clicks[i] += 1
+        self._update_banner_cpc(i)
+
+    def add_show(self, banner_id: str) -> None:
+        i = self._position(banner_id)
+        self._shows[i] += 1
+        self._update_banner_cpc(i)
+
+    def add_clicks(self, banner_ids: typing.Iterable[str]) -> None:
+        """
+        Add a click to every banner of `banner_ids` (repeated ids get several clicks).
+        Nothing is added if some banner is unknown
+        """
+        positions = self._positions(banner_ids)
+        np.add.at(self._clicks, positions, 1)
+        self._update_cpc(positions)
+
+    def add_shows(self, banner_ids: typing.Iterable[str]) -> None:
+        """
+        Add a show to every banner of `banner_ids` (repeated ids get several shows).
+        Nothing is added if some banner is unknown
+        """
+        positions = self._positions(banner_ids)
+        np.add.at(self._shows, positions, 1)
+        self._update_cpc(positions)
+
+    def get_banner(self, banner_id: str) -> Banner:
+        """
+        :return: banner with a copy of its stat, changes of the copy are not saved to the storage
+        """
+        return self._banner_at(self._position(banner_id))
+
+    def _banner_at(self, i: int) -> Banner:
+        return Banner(self._banner_ids[i], int(self._costs[i]), BannerStat(int(self._clicks[i]), int(self._shows[i])))
+
+    def banner_with_highest_cpc(self) -> Banner:
+        """
+        :return: banner with highest CPC(cost per click = cost * CTR)), the first one of equal ones
+        """
+        if self.is_empty():
+            raise NoBannerError("Storage is empty!")
+
+        return self._banner_at(int(np.argmax(self._cpc)))
+
+    def random_banner(self) -> Banner:
+        if self.is_empty():
+            raise NoBannerError("Storage is empty!")
+
+        return self.get_banner(random.choice(self._banner_ids))
+
+    def print_stats(self) -> None:
+        for i, banner_id in enumerate(self._banner_ids):
+            print("Id:", banner_id, "Cost", self._costs[i], "Shows", self._shows[i], "Clicks", self._clicks[i])
@@ -0,0 +1,60 @@
+import random
+import typing
+
+import pytest
+
+from .array_storage import ArrayBannerStorage
+from .banner_engine import NoBannerError
+
+TEST_DEFAULT_CTR = 0.1
+
+
+class ReferenceStorage:
+    """
+    Straightforward storage of stats in dicts to check `ArrayBannerStorage` against
+    """
+    def __init__(self, costs: typing.Dict[str, int]):
+        self.costs = costs
+        self.clicks = dict.fromkeys(costs, 0)
+        self.shows = dict.fromkeys(costs, 0)
+
+    def cpc(self, banner_id: str) -> float:
+        shows = self.shows[banner_id]
+        ctr = self.clicks[banner_id] / shows if shows else TEST_DEFAULT_CTR
+        return ctr * self.costs[banner_id]
+
+    def banner_with_highest_cpc(self) -> str:
+        return max(self.costs, key=self.cpc)  # the first one of equal ones, like `ArrayBannerStorage`
+
+
+def assert_same_stats(storage: ArrayBannerStorage, reference: ReferenceStorage) -> None:
+    for banner_id in reference.costs:
+        banner = storage.get_banner(banner_id)
+        assert (banner.stat.clicks, banner.stat.shows) == (reference.clicks[banner_id], reference.shows[banner_id])
+    assert storage.banner_with_highest_cpc().banner_id == reference.banner_with_highest_cpc()
+
+
+def test_batched_adds_with_repeated_ids_agree_with_reference() -> None:
+    rng = random.Random(0)
+    costs = {"b{}".format(i): rng.randint(1, 100) for i in range(20)}
+    storage = ArrayBannerStorage.from_arrays(list(costs), list(costs.values()), default_ctr=TEST_DEFAULT_CTR)
+    reference = ReferenceStorage(costs)
+    for _ in range(50):
+        shown = rng.choices(list(costs), k=rng.randint(1, 30))
+        clicked = rng.sample(shown, k=rng.randint(0, len(shown))) * 2  # every clicked banner is clicked twice
+        storage.add_shows(shown)
+        storage.add_clicks(clicked)
+        for banner_id in shown:
+            reference.shows[banner_id] += 1
+        for banner_id in clicked:
+            reference.clicks[banner_id] += 1
+        assert_same_stats(storage, reference)
+
+
+@pytest.mark.parametrize("method", ["add_shows", "add_clicks"])
+def test_batch_with_unknown_banner_raises_and_adds_nothing(method: str) -> None:
+    costs = {"b1": 10, "b2": 20}
+    storage = ArrayBannerStorage.from_arrays(list(costs), list(costs.values()), default_ctr=TEST_DEFAULT_CTR)
+    with pytest.raises(NoBannerError):
+        getattr(storage, method)(["b1", "b2", "unknown", "b1"])
+    assert_same_stats(storage, ReferenceStorage(costs))